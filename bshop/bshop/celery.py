@@ -16,10 +16,45 @@ app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 
 # http://docs.celeryproject.org/en/latest/userguide/periodic-tasks.html#crontab-schedules
 app.conf.beat_schedule = {
-    "check_expired_holdfund": {
-        "task": "wallet.tasks.check_expired_holdfund",
-        "schedule": crontab(hour="16", minute="00"),  # utc+8 0:00
-    }
+    "schedule_holdfund_expiry": {
+        "task": "wallet.tasks.schedule_holdfund_expiry",
+        "schedule": crontab(minute="*/10"),
+    },
+    "fold_fund_shards": {
+        "task": "wallet.tasks.fold_fund_shards",
+        "schedule": crontab(minute="*"),
+    },
+    "build_fund_checkpoints": {
+        "task": "wallet.tasks.build_fund_checkpoints",
+        "schedule": crontab(minute=30, hour=0),
+    },
+    "create_partitions": {
+        "task": "wallet.tasks.create_partitions",
+        "schedule": crontab(minute=0, hour=1),
+    },
+    "archive_ledger": {
+        "task": "wallet.tasks.archive_ledger",
+        "schedule": crontab(minute=0, hour=3, day_of_month=1),
+    },
+    # picks up the notifies whose task was lost
+    "settle_payments": {
+        "task": "provider.tasks.settle_payments",
+        "schedule": crontab(minute="*"),
+    },
+    "poll_wechat_orders": {
+        "task": "provider.tasks.poll_wechat_orders",
+        "schedule": 5.0,
+        "options": {"expires": 5},
+    },
+    # sends the retries and the withdrawals whose task was lost
+    "send_withdrawals": {
+        "task": "provider.tasks.send_withdrawals",
+        "schedule": crontab(minute="*"),
+    },
 }
 
 # app.conf.task_routes = {"wallet.tasks.*": {"queue": "wallet"}}
+app.conf.task_routes = {
+    "provider.tasks.settle_payments": {"queue": "settlement"},
+    "provider.tasks.send_withdrawals": {"queue": "withdraw"},
+}
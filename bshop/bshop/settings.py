@@ -71,6 +71,7 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     "common.middleware.AdminTimezoneMiddleware",
     "common.middleware.ParseRemoteAddrMiddleware",
+    "common.middleware.RedisScopeMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -298,6 +299,18 @@ WECHAT_SITE_HOST = env("WECHAT_SITE_HOST", default=None)
 WECHAT_PATCHADMINSITE = False
 # WECHAT_SESSIONSTORAGE = CACHES["wechat"]["BACKEND"]
 
+# Cold storage of the wallet journal, on the local disk under ROOT without an
+# S3 endpoint, the journal is not archived if neither is set
+WALLET_ARCHIVE = {
+    "ENDPOINT": env("WALLET_ARCHIVE_ENDPOINT", default=""),
+    "KEY": env("WALLET_ARCHIVE_KEY", default=""),
+    "SECRET": env("WALLET_ARCHIVE_SECRET", default=""),
+    "BUCKET": env("WALLET_ARCHIVE_BUCKET", default="wallet-archive"),
+    "ROOT": env("WALLET_ARCHIVE_ROOT", default=""),
+}
+# Months of FundAction kept in the database, FundTransfer are kept one more
+WALLET_ARCHIVE_MONTHS = env.int("WALLET_ARCHIVE_MONTHS", default=24)
+
 # Debug Request
 DEBUG_REQUEST = env.bool("DEBUG_REQUEST", default=False)
 if DEBUG_REQUEST:
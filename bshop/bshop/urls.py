@@ -22,6 +22,7 @@ import wechat_django
 import wechat_django.pay.notify  # noqa
 
 from gql.views import graphql_view
+from wallet.views import ledger_export
 
 # NOTE: admin_url must starts with 'admin' for setting admin timezone
 admin_url = "admin" + settings.SUB_ADMIN_URL + "/"
@@ -30,5 +31,6 @@ admin_url = "admin" + settings.SUB_ADMIN_URL + "/"
 urlpatterns = [
     path(admin_url, admin.site.urls),
     path("api/gql", graphql_view),
+    path("api/ledger/export", ledger_export),
     path("wechat/", wechat_django.sites.wechat.urls),
 ] + staticfiles_urlpatterns()
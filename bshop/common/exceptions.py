@@ -78,3 +78,7 @@ class WithdrawError(ErrorResultException):
 
 class NotEnoughBalance(ErrorResultException):
     default_message = "not_enough_balance"
+
+
+class ProviderUnavailable(RequestException):
+    """ Refused by the circuit breaker, the request was not sent """
@@ -1,9 +1,15 @@
 import pytz
+import logging
+from django.conf import settings
 from django.utils import translation
 from django.utils.timezone import activate
 
 from ipware import get_client_ip
 
+from common import redis_client
+
+logger = logging.getLogger(__name__)
+
 
 def ParseRemoteAddrMiddleware(get_response):
     def middleware(request):
@@ -14,6 +20,28 @@ def ParseRemoteAddrMiddleware(get_response):
     return middleware
 
 
+def RedisScopeMiddleware(get_response):
+    """ Batch and count the redis commands of the request """
+
+    def middleware(request):
+        with redis_client.request_scope() as scope:
+            response = get_response(request)
+            scope.flush()
+
+        logger.info(
+            "redis %s %s: %s commands, %s round trips",
+            request.method,
+            request.path,
+            scope.commands,
+            scope.round_trips,
+        )
+        if settings.DEBUG:
+            response["X-Redis-Commands"] = f"{scope.commands}/{scope.round_trips}"
+        return response
+
+    return middleware
+
+
 class AdminTimezoneMiddleware(object):
     def __init__(self, get_response):
         self.get_response = get_response
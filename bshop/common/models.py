@@ -1,17 +1,136 @@
+import os
+import time
+import logging
+import weakref
+import threading
 from decimal import Decimal
-from django.db import models
+from django.db import models, transaction
 
+from common import redis_client
 from common.utils import to_decimal
 from common.base_models import BaseModel, DecimalField
 
+logger = logging.getLogger(__name__)
+
+
+class QuotaCache:
+    """
+    All the SystemQuota of the process, loaded with one query. Changes are
+    published to the CHANNEL and every process listening clears its copy,
+    the TTL bounds the staleness if a message is lost.
+    """
+
+    CHANNEL = "system_quota:invalidate"
+    TTL = 60
+    RETRY_DELAY = 5
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.quotas = None
+        self.loaded_at = 0
+        self.generation = 0
+        self.pid = None
+        self.listener = None
+        # weak references to the on_commit hooks of the changes of the thread
+        self.local = threading.local()
+
+    def get(self, load):
+        self.listen()
+        if self.pending():
+            # the transaction reads its own changes, not cached for the others
+            return load()
+
+        quotas = self.quotas
+        if quotas is not None and time.monotonic() - self.loaded_at < self.TTL:
+            return quotas
+
+        generation = self.generation
+        quotas = load()
+        with self.lock:
+            # not cached if it was invalidated while loading
+            if generation == self.generation:
+                self.quotas, self.loaded_at = quotas, time.monotonic()
+        return quotas
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.quotas = None
+
+    def invalidate(self):
+        """ Clear the cache of this process now and of the others on commit """
+        self.clear()
+
+        def committed():
+            self.committed()
+
+        # a rollback drops the hook, which is then freed
+        self.local.hooks = [*getattr(self.local, "hooks", []), weakref.ref(committed)]
+        transaction.on_commit(committed)
+
+    def pending(self):
+        """ Changed by the transaction of this thread and not committed yet """
+        hooks = getattr(self.local, "hooks", None)
+        if not hooks:
+            return False
+        self.local.hooks = [hook for hook in hooks if hook() is not None]
+        return bool(self.local.hooks)
+
+    def committed(self):
+        self.local.hooks = []
+        self.clear()
+        self.publish()
+
+    def publish(self):
+        try:
+            redis_client.get_redis().publish(self.CHANNEL, os.getpid())
+        except Exception:
+            logger.warning("system quota invalidation not published", exc_info=True)
+
+    def listen(self):
+        # the thread of the parent process does not survive a fork
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.generation += 1
+            self.quotas = None
+            self.listener = threading.Thread(
+                target=self.run, name="system-quota-listener", daemon=True
+            )
+            self.listener.start()
+
+    def run(self):
+        pid = str(os.getpid()).encode()
+        reconnect = False
+        while True:
+            try:
+                pubsub = redis_client.get_redis().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.CHANNEL)
+                if reconnect:
+                    # messages may be lost while not subscribed
+                    self.clear()
+                for message in pubsub.listen():
+                    # already cleared by invalidate in this process
+                    if message["data"] != pid:
+                        logger.debug("system quota invalidated by %s", message["data"])
+                        self.clear()
+            except Exception:
+                logger.warning("system quota listener failed", exc_info=True)
+                reconnect = True
+                time.sleep(self.RETRY_DELAY)
+
+
+quota_cache = QuotaCache()
+
 
 class SystemQuotaManager(models.Manager):
     def get_quota(self, name: str, default=0) -> Decimal:
-        try:
-            sq = self.get(name=name)
-            return sq.quota
-        except self.model.DoesNotExist:
-            pass
+        quotas = quota_cache.get(lambda: dict(self.values_list("name", "quota")))
+        if name in quotas:
+            return quotas[name]
         return to_decimal(default)
 
     def set_quota(self, name: str, value: Decimal):
@@ -28,3 +147,12 @@ class SystemQuota(BaseModel):
 
     def __str__(self):
         return self.name
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        quota_cache.invalidate()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        quota_cache.invalidate()
+        return result
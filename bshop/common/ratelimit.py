@@ -1,48 +1,96 @@
 import logging
+from importlib import import_module
 from ratelimit import ALL
 from functools import wraps
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
 from ratelimit.exceptions import Ratelimited
-from ratelimit.utils import is_ratelimited
+from ratelimit.utils import (
+    EXPIRATION_FUDGE,
+    _ACCESSOR_KEYS,
+    _SIMPLE_KEYS,
+    _make_cache_key,
+    _method_match,
+    _split_rate,
+)
+
+from common import redis_client
 
 logger = logging.getLogger(__name__)
 
 
-def GQLRatelimitKey(group, request):
-    return request.gql_rl_field
+def _key_value(request, group, key, kw):
+    """ Same keys as django-ratelimit, and `gql:<argument>` """
+    if callable(key):
+        return key(group, request)
+    if key.startswith("gql:"):
+        value = kw.get(key.split("gql:")[1], None)
+        if not value:
+            raise ValueError(f"Cannot get key: {key}")
+        return value
+    if key in _SIMPLE_KEYS:
+        return _SIMPLE_KEYS[key](request)
+    if ":" in key:
+        accessor, k = key.split(":", 1)
+        return _ACCESSOR_KEYS[accessor](request, k)
+    if "." in key:
+        mod, attr = key.rsplit(".", 1)
+        return getattr(import_module(mod), attr)(group, request)
+    raise ImproperlyConfigured(f"Could not understand ratelimit key: {key}")
+
+
+def check_ratelimits(request, fn, rules, kw):
+    """
+    Count the request against the rules in one redis round trip, the
+    counters are the keys of django-ratelimit in RATELIMIT_USE_CACHE.
+    Return the rules over their limit.
+    """
+    if not getattr(settings, "RATELIMIT_ENABLE", True):
+        return []
+
+    cache = caches[getattr(settings, "RATELIMIT_USE_CACHE", "default")]
+    checks, commands = [], []
+    for rule in rules:
+        group, key, rate, method, block = rule
+        if not _method_match(request, method):
+            continue
+        group = group or f"{fn.__module__}.{fn.__name__}"
+        limit, period = _split_rate(rate)
+        value = _key_value(request, group, key, kw)
+        cache_key = cache.make_key(_make_cache_key(group, rate, value, method))
+        checks.append((rule, limit))
+        commands += [
+            ("set", (cache_key, 0), {"nx": True, "ex": period + EXPIRATION_FUDGE}),
+            ("incr", (cache_key,), {}),
+        ]
+
+    if not commands:
+        return []
+    counts = redis_client.execute("ratelimit", *commands)[1::2]
+    return [rule for (rule, limit), count in zip(checks, counts) if count > limit]
 
 
 def ratelimit(group=None, key=None, rate=None, method=ALL, block=False):
+    """
+    Stacked ratelimit decorators are merged, so that all their rules are
+    checked together.
+    """
+
     def decorator(fn):
+        rules = [(group, key, rate, method, block)]
+        if hasattr(fn, "ratelimit_rules"):
+            rules += fn.ratelimit_rules
+            fn = fn.__wrapped__
+
         @wraps(fn)
         def _wrapped(root, info, **kw):
             request = info.context
 
-            old_limited = getattr(request, "limited", False)
-
-            if key and key.startswith("gql:"):
-                _key = key.split("gql:")[1]
-                value = kw.get(_key, None)
-                if not value:
-                    raise ValueError(f"Cannot get key: {key}")
-                request.gql_rl_field = value
-
-                new_key = GQLRatelimitKey
-            else:
-                new_key = key
-
-            ratelimited = is_ratelimited(
-                request=request,
-                group=group,
-                fn=fn,
-                key=new_key,
-                rate=rate,
-                method=method,
-                increment=True,
-            )
-
-            request.limited = ratelimited or old_limited
+            limited = check_ratelimits(request, fn, rules, kw)
+            request.limited = bool(limited) or getattr(request, "limited", False)
 
-            if ratelimited and block:
+            if any(block for *_, block in limited):
                 logger.warn(
                     "url:<%s> is denied for <%s> in Ratelimit"
                     % (request.path, request.META["REMOTE_ADDR"])
@@ -50,6 +98,7 @@ def ratelimit(group=None, key=None, rate=None, method=ALL, block=False):
                 raise Ratelimited("rate_limited")
             return fn(root, info, **kw)
 
+        _wrapped.ratelimit_rules = rules
         return _wrapped
 
     return decorator
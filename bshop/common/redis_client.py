@@ -0,0 +1,106 @@
+"""
+Shared redis access by role.
+
+A role maps to a django_redis cache alias, whose connection pool is shared
+by the process. While serving a request, RedisScopeMiddleware sets up a
+RedisScope: the commands of one check go out as a single pipeline, the
+writes whose result is not needed are deferred and flushed in one pipeline
+at the end of the request, and the commands are counted and reported.
+"""
+import logging
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+# role: cache alias
+ROLES = {
+    "default": "default",
+    "idempotency": "default",
+    "lock": "default",
+    "stats": "default",
+    "ratelimit": getattr(settings, "RATELIMIT_USE_CACHE", "default"),
+    "wechat": "wechat",
+}
+
+_local = threading.local()
+
+
+def get_redis(role="default"):
+    alias = ROLES[role]
+    if alias == "default":
+        return get_redis_connection()
+    return get_redis_connection(alias)
+
+
+class RedisScope:
+    def __init__(self):
+        self.commands = 0
+        self.round_trips = 0
+        # role: pipeline
+        self.deferred = {}
+
+    def count(self, commands):
+        self.commands += commands
+        self.round_trips += 1
+
+    def execute(self, role, commands):
+        pipe = get_redis(role).pipeline(transaction=False)
+        for name, args, kwargs in commands:
+            getattr(pipe, name)(*args, **kwargs)
+        self.count(len(commands))
+        return pipe.execute()
+
+    def call(self, role, name, *args, **kwargs):
+        self.count(1)
+        return getattr(get_redis(role), name)(*args, **kwargs)
+
+    def defer(self, role, name, *args, **kwargs):
+        if role not in self.deferred:
+            self.deferred[role] = get_redis(role).pipeline(transaction=False)
+        getattr(self.deferred[role], name)(*args, **kwargs)
+
+    def flush(self):
+        deferred, self.deferred = self.deferred, {}
+        for role, pipe in deferred.items():
+            self.count(len(pipe))
+            try:
+                pipe.execute()
+            except Exception:
+                logger.warning("redis deferred %s commands failed", role, exc_info=True)
+
+
+def current_scope():
+    """ The RedisScope of the request, a throwaway one out of requests """
+    return getattr(_local, "scope", None) or RedisScope()
+
+
+@contextmanager
+def request_scope():
+    scope = _local.scope = RedisScope()
+    try:
+        yield scope
+    finally:
+        _local.scope = None
+        scope.flush()
+
+
+def execute(role, *commands):
+    """ Run the (name, args, kwargs) commands in one round trip """
+    return current_scope().execute(role, commands)
+
+
+def call(role, name, *args, **kwargs):
+    return current_scope().call(role, name, *args, **kwargs)
+
+
+def defer(role, name, *args, **kwargs):
+    """ Send the command with the others at the end of the request """
+    scope = getattr(_local, "scope", None)
+    if scope is None:
+        RedisScope().call(role, name, *args, **kwargs)
+    else:
+        scope.defer(role, name, *args, **kwargs)
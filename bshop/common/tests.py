@@ -1,7 +1,32 @@
-from django.test import TestCase
+import time
+from unittest.mock import Mock, patch
+from django.db import OperationalError, transaction
+from django.test import RequestFactory, TestCase
+from django_fakeredis import FakeRedis
+from django_fakeredis.fakeredis import get_fake_redis
+from ratelimit.exceptions import Ratelimited
 
-from common import exceptions
+from common import exceptions, redis_client
+from common.models import QuotaCache, SystemQuota, quota_cache
 from common.phone import parse_phone
+from common.ratelimit import ratelimit
+from common.utils import (
+    retry_on_db_conflict,
+    get_db_retry_stats,
+    DB_RETRY_MAX,
+    IdempotentResult,
+)
+
+
+class PgError(Exception):
+    def __init__(self, pgcode):
+        self.pgcode = pgcode
+
+
+def db_error(pgcode):
+    e = OperationalError(pgcode)
+    e.__cause__ = PgError(pgcode)
+    return e
 
 
 class CommonTestCase(TestCase):
@@ -12,3 +37,162 @@ class CommonTestCase(TestCase):
         with self.assertRaises(exceptions.InvalidPhone):
             parse_phone("13812345678", default_country=None)
             parse_phone("bad string")
+
+    @FakeRedis("common.redis_client.get_redis_connection")
+    @patch("common.utils.time.sleep")
+    @patch("common.utils.connection", in_atomic_block=False)
+    def test_retry_on_db_conflict(self, *args):
+        errors = [db_error("40P01"), db_error("40001")]
+
+        @retry_on_db_conflict
+        def action():
+            if errors:
+                raise errors.pop(0)
+            return "ok"
+
+        self.assertEqual(action(), "ok")
+        self.assertDictEqual(
+            get_db_retry_stats(), {"action:40P01": 1, "action:40001": 1}
+        )
+
+        @retry_on_db_conflict
+        def deadlock():
+            raise db_error("40P01")
+
+        with self.assertRaises(OperationalError):
+            deadlock()
+        stats = get_db_retry_stats()
+        self.assertEqual(stats["deadlock:40P01"], DB_RETRY_MAX)
+        self.assertEqual(stats["deadlock:exhausted"], 1)
+
+        # other errors are not retried
+        @retry_on_db_conflict
+        def broken():
+            errors.append(1)
+            raise db_error("57014")
+
+        with self.assertRaises(OperationalError):
+            broken()
+        self.assertEqual(errors, [1])
+
+    @patch("common.utils.time.sleep")
+    @patch("common.utils.connection", in_atomic_block=False)
+    @patch("common.utils.redis_client.defer", side_effect=ConnectionError)
+    def test_retry_without_stats(self, *args):
+        errors = [db_error("40P01")]
+
+        @retry_on_db_conflict
+        def action():
+            if errors:
+                raise errors.pop(0)
+            return "ok"
+
+        # the stats are lost, not the retry
+        self.assertEqual(action(), "ok")
+
+    @patch("common.utils.connection", in_atomic_block=True)
+    def test_retry_in_transaction(self, *args):
+        calls = []
+
+        @retry_on_db_conflict
+        def action():
+            calls.append(1)
+            raise db_error("40P01")
+
+        # the outer transaction is aborted, leave the retry to its owner
+        with self.assertRaises(OperationalError):
+            action()
+        self.assertEqual(calls, [1])
+
+    # every role on the fake server
+    @patch("common.redis_client.get_redis_connection", lambda *args: get_fake_redis())
+    def test_redis_scope(self):
+        @ratelimit(key="ip", rate="2/m", block=True)
+        @ratelimit(key="gql:phone", rate="5/m", block=True)
+        def mutate(root, info, phone):
+            return phone
+
+        info = Mock(context=RequestFactory().post("/graphql"))
+        idempotent = IdempotentResult("test")
+        get_fake_redis().flushall()
+
+        with redis_client.request_scope() as scope:
+            self.assertEqual(mutate(None, info, phone="1"), "1")
+            self.assertIsNone(idempotent("r1", 1))
+            idempotent.done("r1", 1, {"success": True})
+            # both rules in one round trip, the result is stored on exit
+            self.assertEqual((scope.commands, scope.round_trips), (6, 2))
+        self.assertEqual((scope.commands, scope.round_trips), (7, 3))
+        self.assertEqual(idempotent("r1", 1), {"success": True})
+
+        # a failed request is released for its retries
+        with redis_client.request_scope():
+            self.assertIsNone(idempotent("r2", 1))
+            with self.assertRaises(ValueError):
+                with idempotent.release_on_error("r2", 1):
+                    raise ValueError
+            with self.assertRaises(idempotent.ResubmittedError):
+                idempotent("r2", 1)
+        self.assertIsNone(idempotent("r2", 1))
+
+        mutate(None, info, phone="2")
+        with self.assertRaises(Ratelimited):
+            mutate(None, info, phone="3")
+        self.assertTrue(info.context.limited)
+
+    @FakeRedis("common.redis_client.get_redis_connection")
+    def test_system_quota_cache(self):
+        quota_cache.clear()
+        SystemQuota.objects.bulk_create([SystemQuota(name="a", quota=1)])
+
+        with self.assertNumQueries(1):
+            self.assertEqual(SystemQuota.objects.get_quota("a"), 1)
+            self.assertEqual(SystemQuota.objects.get_quota("b", default=2), 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(SystemQuota.objects.get_quota("a"), 1)
+
+        # not committed yet, the transaction reads its own changes
+        SystemQuota.objects.set_quota("a", 3)
+        self.assertTrue(quota_cache.pending())
+        with self.assertNumQueries(1):
+            self.assertEqual(SystemQuota.objects.get_quota("a"), 3)
+
+        quota_cache.committed()
+        self.assertFalse(quota_cache.pending())
+        self.assertEqual(SystemQuota.objects.get_quota("a"), 3)
+        with self.assertNumQueries(0):
+            self.assertEqual(SystemQuota.objects.get_quota("a"), 3)
+
+        # a rolled back change is no longer pending in later transactions
+        with self.assertRaises(PgError):
+            with transaction.atomic():
+                SystemQuota.objects.set_quota("a", 4)
+                self.assertTrue(quota_cache.pending())
+                raise PgError("40001")
+        self.assertFalse(quota_cache.pending())
+        self.assertEqual(SystemQuota.objects.get_quota("a"), 3)
+        with transaction.atomic(), self.assertNumQueries(0):
+            self.assertEqual(SystemQuota.objects.get_quota("a"), 3)
+
+        # a change of a released savepoint is pending until the commit
+        with transaction.atomic():
+            with transaction.atomic():
+                SystemQuota.objects.set_quota("a", 5)
+            self.assertTrue(quota_cache.pending())
+        self.assertEqual(SystemQuota.objects.get_quota("a"), 5)
+        quota_cache.committed()
+        self.assertFalse(quota_cache.pending())
+
+    @FakeRedis("common.redis_client.get_redis_connection")
+    def test_system_quota_invalidation(self):
+        cache = QuotaCache()
+        cache.get(lambda: {"a": 1})
+        self.assertTrue(cache.listener.is_alive())
+
+        # published by another process
+        deadline = time.monotonic() + 5
+        while cache.quotas is not None and time.monotonic() < deadline:
+            redis_client.get_redis().publish(cache.CHANNEL, "1")
+            time.sleep(0.05)
+        self.assertIsNone(cache.quotas)
+        self.assertEqual(cache.get(lambda: {"a": 2}), {"a": 2})
@@ -1,5 +1,6 @@
-import boto3
+import os
 import base64
+import shutil
 import hashlib
 import logging
 from io import BytesIO
@@ -36,12 +37,42 @@ def hash_bytes(v):
     return hashlib.md5(v).hexdigest()
 
 
+class LocalClient:
+    """ The part of the S3 client used by Uploader, on the local disk """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def upload_fileobj(self, fileobj, bucket, key):
+        path = self.path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", "wb") as f:
+            shutil.copyfileobj(fileobj, f)
+        os.replace(f"{path}.tmp", path)
+
+    def download_fileobj(self, bucket, key, fileobj):
+        with open(self.path(bucket, key), "rb") as f:
+            shutil.copyfileobj(f, fileobj)
+
+
 class Uploader:
     def __init__(self, **options):
 
         self.options = options
         self.bucket = options.get("BUCKET", None)
 
+        if not options.get("ENDPOINT"):
+            if not options.get("ROOT"):
+                raise ValueError("Need an S3 endpoint or a local root")
+            # no S3 endpoint, store the files under ROOT
+            self.client = LocalClient(options["ROOT"])
+            return
+
+        import boto3
+
         self.client = boto3.client(
             "s3",
             aws_access_key_id=options["KEY"],
@@ -57,7 +88,8 @@ class Uploader:
         return bucket
 
     def gen_file_url(self, bucket, md5):
-        return "%s/%s/%s" % (self.options["ENDPOINT"], bucket, md5)
+        endpoint = self.options.get("ENDPOINT") or f"file://{self.options['ROOT']}"
+        return "%s/%s/%s" % (endpoint, bucket, md5)
 
     def upload_with_base64(self, content, bucket=None):
         bucket = self.get_bucket(bucket)
@@ -91,3 +123,14 @@ class Uploader:
             md5 = hash_bytes(buf)
             self.client.upload_fileobj(BytesIO(buf), bucket, md5)
         return self.gen_file_url(bucket, md5)
+
+    def upload_bytes(self, buf, key=None, bucket=None):
+        bucket = self.get_bucket(bucket)
+        key = key or hash_bytes(buf)
+        self.client.upload_fileobj(BytesIO(buf), bucket, key)
+        return self.gen_file_url(bucket, key)
+
+    def download_bytes(self, key, bucket=None):
+        buf = BytesIO()
+        self.client.download_fileobj(self.get_bucket(bucket), key, buf)
+        return buf.getvalue()
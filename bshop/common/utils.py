@@ -2,19 +2,29 @@ import pytz
 import copy
 import time
 import json
+import random
+import logging
 import decimal
 import urllib.parse
 from functools import wraps
+from contextlib import contextmanager
 from decimal import Decimal
 from datetime import datetime
-from django_redis import get_redis_connection
+from django.db import connection, OperationalError
 from django.core.serializers.json import DjangoJSONEncoder
 
-from common import exceptions
+from common import exceptions, redis_client
 
+logger = logging.getLogger(__name__)
 
 d0 = Decimal("0")
 
+# deadlock_detected, serialization_failure
+DB_RETRY_PGCODES = ("40P01", "40001")
+DB_RETRY_MAX = 3
+DB_RETRY_BACKOFF = 0.05
+DB_RETRY_STATS_KEY = "stats:db_retry"
+
 
 def json_dumps(d):
     return json.dumps(d, cls=DjangoJSONEncoder)
@@ -74,6 +84,57 @@ def timeit(method):
     return timed
 
 
+def retry_on_db_conflict(func):
+    """
+    Replay func on Postgres deadlock or serialization failure with jittered
+    exponential backoff, counting the retries per function and pgcode in
+    the DB_RETRY_STATS_KEY redis hash. Decorate outside @transaction.atomic,
+    within an outer transaction it is called once since the whole
+    transaction has to be rolled back.
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kw):
+        if connection.in_atomic_block:
+            return func(*args, **kw)
+
+        for attempt in range(DB_RETRY_MAX + 1):
+            try:
+                return func(*args, **kw)
+            except OperationalError as e:
+                pgcode = getattr(e.__cause__, "pgcode", None)
+                if pgcode not in DB_RETRY_PGCODES:
+                    raise
+
+                exhausted = attempt == DB_RETRY_MAX
+                field = f"{func.__name__}:{'exhausted' if exhausted else pgcode}"
+                try:
+                    redis_client.defer("stats", "hincrby", DB_RETRY_STATS_KEY, field, 1)
+                except Exception:
+                    logger.warning("db retry stats lost", exc_info=True)
+                if exhausted:
+                    logger.error("%s %s, give up after %s retries", field, e, attempt)
+                    raise
+
+                logger.warning("%s %s, retry %s", field, e, attempt + 1)
+                time.sleep(DB_RETRY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    return wrapper
+
+
+def is_db_conflict(e) -> bool:
+    """ A deadlock or serialization failure, which may succeed if replayed """
+    return (
+        isinstance(e, OperationalError)
+        and getattr(e.__cause__, "pgcode", None) in DB_RETRY_PGCODES
+    )
+
+
+def get_db_retry_stats():
+    stats = redis_client.get_redis("stats").hgetall(DB_RETRY_STATS_KEY)
+    return {k.decode(): int(v) for k, v in stats.items()}
+
+
 def deepupdate(target, src):
     for k, v in src.items():
         if isinstance(v, list):
@@ -115,7 +176,6 @@ class AvoidResubmit:
     def __init__(self, name, timeout=300):
         self.name = name
         self.prefix = "ar"
-        self.con = get_redis_connection()
         self.timeout = timeout
 
     def gen_key(self, request_id, uid):
@@ -123,7 +183,54 @@ class AvoidResubmit:
 
     def __call__(self, request_id, uid=""):
         key = self.gen_key(request_id, uid)
-        if self.con.get(key):
+        if not redis_client.call(
+            "idempotency", "set", key, 1, nx=True, ex=self.timeout
+        ):
             raise self.ResubmittedError
 
-        self.con.setex(key, 1, self.timeout)
+
+class IdempotentResult(AvoidResubmit):
+    """
+    AvoidResubmit which replays the result of the request to its retries.
+    The request is claimed with one SET NX EX and its result stored when it
+    succeeds, the retries of a request running are resubmitted and a failed
+    request releases its claim for them.
+    """
+
+    PENDING = b"-"
+
+    def __init__(self, name, timeout=300):
+        super().__init__(name, timeout=timeout)
+        self.prefix = "idem"
+
+    def __call__(self, request_id, uid=""):
+        """ Return None if claimed, else the result stored """
+        key = self.gen_key(request_id, uid)
+        claimed, value = redis_client.execute(
+            "idempotency",
+            ("set", (key, self.PENDING), {"nx": True, "ex": self.timeout}),
+            ("get", (key,), {}),
+        )
+        if claimed:
+            return None
+        if not value or value == self.PENDING:
+            raise self.ResubmittedError
+        return json.loads(value)
+
+    @contextmanager
+    def release_on_error(self, request_id, uid=""):
+        """ Release the claim if the request fails, so that it can be retried """
+        try:
+            yield
+        except Exception:
+            key = self.gen_key(request_id, uid)
+            redis_client.defer("idempotency", "delete", key)
+            raise
+
+    def done(self, request_id, uid, result: dict):
+        """ Store the result with the other writes at the end of the request """
+        key = self.gen_key(request_id, uid)
+        redis_client.defer(
+            "idempotency", "set", key, json_dumps(result), xx=True, ex=self.timeout
+        )
+        return result
@@ -1,6 +1,8 @@
 import os
+import time
 import logging
 import importlib
+import threading
 from decimal import Decimal
 from os.path import dirname
 
@@ -69,3 +71,31 @@ def get_provider_cls(by_name=None):
         return cls
 
     return _ProviderClsMap.values()
+
+
+# rebuilt after PROVIDER_TTL, bounds the staleness in the other processes
+PROVIDER_TTL = 300
+
+# name: (provider, created_at)
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def get_provider(by_name):
+    """
+    The instance of the provider shared by the process, its configuration
+    is loaded on first use. The changes are reloaded with reload_providers().
+    """
+    entry = _providers.get(by_name)
+    if entry is None or time.monotonic() - entry[1] >= PROVIDER_TTL:
+        with _providers_lock:
+            entry = _providers.get(by_name)
+            if entry is None or time.monotonic() - entry[1] >= PROVIDER_TTL:
+                provider = get_provider_cls(by_name)()
+                entry = _providers[by_name] = (provider, time.monotonic())
+    return entry[0]
+
+
+def reload_providers():
+    with _providers_lock:
+        _providers.clear()
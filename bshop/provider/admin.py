@@ -0,0 +1,26 @@
+from django.contrib import admin
+from django.utils.translation import gettext_lazy as _
+
+from provider.models import PaymentNotify
+
+
+@admin.register(PaymentNotify)
+class PaymentNotifyAdmin(admin.ModelAdmin):
+    list_display = (
+        "order",
+        "provider",
+        "status",
+        "attempts",
+        "error",
+        "created_at",
+        "settled_at",
+        "retry_at",
+    )
+    list_filter = ("status", "provider")
+    raw_id_fields = ("order",)
+    actions = ["retry"]
+
+    def retry(self, request, queryset):
+        queryset.filter(status="FAILED").update(status="PENDING")
+
+    retry.short_description = _("Settle the selected failed notifies again")
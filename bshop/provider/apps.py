@@ -7,4 +7,4 @@ class ProviderConfig(AppConfig):
     verbose_name = _("Pay Provider")
 
     def ready(self):
-        from .wechat import order_updated  # noqa
+        from .wechat import order_updated, wechat_config_changed  # noqa
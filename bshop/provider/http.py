@@ -0,0 +1,181 @@
+"""
+Shared HTTP session of the provider clients.
+
+wechatpy gives every client its own requests.Session without timeout.
+use_session() swaps it for this process' session: pooled keep-alive
+connections, a timeout per endpoint, and a circuit breaker per host, so
+that a WeChat brownout fails the calls fast instead of holding the workers.
+The calls, errors and latency are counted per endpoint in the stats redis.
+"""
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common import redis_client
+from common.exceptions import ProviderUnavailable
+
+logger = logging.getLogger(__name__)
+
+HTTP_STATS_KEY = "stats:provider_http"
+
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+
+# (connect, read) seconds
+DEFAULT_TIMEOUT = (3, 5)
+ENDPOINT_TIMEOUTS = {
+    "pay/orderquery": (2, 3),
+    "pay/unifiedorder": (3, 5),
+    "mmpaymkttransfers/promotion/transfers": (3, 10),
+}
+
+BREAKER_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30
+
+
+def endpoint_of(url: str) -> str:
+    path = urlsplit(url).path.strip("/")
+    if path.startswith("sandboxnew/"):
+        path = path[len("sandboxnew/") :]
+    return path
+
+
+class CircuitBreaker:
+    """
+    Open after BREAKER_THRESHOLD consecutive failures, calls are refused
+    for BREAKER_RESET_TIMEOUT seconds, then a single trial call closes it
+    or opens it again. The state is per process.
+    """
+
+    def __init__(self, name, threshold=BREAKER_THRESHOLD, reset=BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.threshold = threshold
+        self.reset = reset
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial or time.monotonic() - self.opened_at < self.reset:
+                return False
+            self.trial = True
+            return True
+
+    def success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info("circuit %s closed", self.name)
+            self.failures, self.opened_at, self.trial = 0, None, False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+            if self.opened_at is None and self.failures < self.threshold:
+                return
+            if self.opened_at is None:
+                logger.warning(
+                    "circuit %s opened after %s failures", self.name, self.failures
+                )
+            self.opened_at = time.monotonic()
+
+
+class ProviderSession(requests.Session):
+    def __init__(self):
+        super().__init__()
+        adapter = HTTPAdapter(
+            pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE
+        )
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def breaker(self, host) -> CircuitBreaker:
+        with self.lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker(host)
+            return self.breakers[host]
+
+    def request(self, method, url, **kwargs):
+        endpoint = endpoint_of(url)
+        breaker = self.breaker(urlsplit(url).netloc)
+        if not breaker.allow():
+            record(endpoint, rejected=True)
+            raise ProviderUnavailable(f"circuit {breaker.name} is open")
+
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT)
+
+        start = time.monotonic()
+        try:
+            res = super().request(method, url, **kwargs)
+        except Exception as e:
+            # any error, so that a failed trial call does not leave it open
+            breaker.failure()
+            record(endpoint, time.monotonic() - start, error=True)
+            logger.warning("%s %s failed: %r", method, endpoint, e)
+            raise
+
+        # only the unavailability of the provider counts, not its answers
+        if res.status_code >= 500:
+            breaker.failure()
+        else:
+            breaker.success()
+        record(endpoint, time.monotonic() - start, error=res.status_code >= 500)
+        return res
+
+
+def record(endpoint, elapsed=0, error=False, rejected=False):
+    counters = {"rejected": 1} if rejected else {"calls": 1, "ms": int(elapsed * 1000)}
+    if error:
+        counters["errors"] = 1
+    try:
+        for name, value in counters.items():
+            redis_client.defer(
+                "stats", "hincrby", HTTP_STATS_KEY, f"{endpoint}:{name}", value
+            )
+    except Exception:
+        logger.debug("provider http stats lost", exc_info=True)
+
+
+def get_http_stats():
+    """ {endpoint: {"calls", "errors", "ms", "rejected"}} """
+    stats = {}
+    for k, v in redis_client.get_redis("stats").hgetall(HTTP_STATS_KEY).items():
+        endpoint, name = k.decode().rsplit(":", 1)
+        stats.setdefault(endpoint, {})[name] = int(v)
+    return stats
+
+
+session = ProviderSession()
+
+
+def use_session(client):
+    """ Send the requests of a wechatpy client through the shared session """
+    client._http = session
+    return client
+
+
+def use_wechat_session(app):
+    """ The api, oauth and pay clients of a WeChatApp """
+    if app.abilities.api:
+        # the wxa api of a mini program wraps the client
+        use_session(getattr(app.client, "_client", app.client))
+    if app.abilities.oauth:
+        use_session(app.oauth)
+    if app.pay:
+        use_session(app.pay.client)
+    return app
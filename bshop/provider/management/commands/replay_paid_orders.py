@@ -0,0 +1,80 @@
+import time
+
+from django.core.management.base import BaseCommand
+from wechat_django.pay.models import UnifiedOrder
+from wechat_django.pay.models.orderresult import UnifiedOrderResult
+
+from provider.settlement import replay_orders
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay paid UnifiedOrders whose notify was missed, orders already "
+        "in the wallet or being settled are skipped"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--file", help="File of UnifiedOrder ids, one per line")
+        parser.add_argument("--from-id", type=int, help="First UnifiedOrder id")
+        parser.add_argument("--to-id", type=int, help="Last UnifiedOrder id")
+        parser.add_argument("--chunk-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        qs = UnifiedOrder.objects.filter(
+            result__trade_state=UnifiedOrderResult.State.SUCCESS
+        )
+        if options["from_id"] is not None:
+            qs = qs.filter(id__gte=options["from_id"])
+        if options["to_id"] is not None:
+            qs = qs.filter(id__lte=options["to_id"])
+
+        ids = None
+        if options["file"]:
+            with open(options["file"]) as f:
+                ids = sorted({int(line) for line in f if line.strip()})
+
+        start = time.monotonic()
+        total = {"applied": 0, "skipped": 0, "failed": 0, "retried": 0}
+
+        for n, orders in enumerate(self.iter_chunks(qs, ids, options["chunk_size"])):
+            res = self.replay(orders)
+            for k, v in res.items():
+                total[k] += v
+
+            elapsed = time.monotonic() - start
+            self.stdout.write(
+                f"chunk {n}: applied={res['applied']} skipped={res['skipped']} "
+                f"failed={res['failed']} retried={res['retried']} "
+                f"{sum(total.values()) / elapsed:.0f} orders/s"
+            )
+
+        elapsed = time.monotonic() - start
+        self.stdout.write(
+            f"Replayed {sum(total.values())} orders in {elapsed:.1f}s: "
+            f"applied={total['applied']} skipped={total['skipped']} "
+            f"failed={total['failed']} retried={total['retried']}"
+        )
+
+    def iter_chunks(self, qs, ids, chunk_size):
+        if ids is not None:
+            for i in range(0, len(ids), chunk_size):
+                yield list(qs.filter(id__in=ids[i : i + chunk_size]).order_by("id"))
+            return
+
+        last_id = 0
+        while True:
+            orders = list(qs.filter(id__gt=last_id).order_by("id")[:chunk_size])
+            if not orders:
+                return
+            yield orders
+            last_id = orders[-1].id
+
+    def replay(self, orders):
+        results = replay_orders(orders)
+
+        total = {"applied": 0, "skipped": 0, "failed": 0, "retried": 0}
+        for order_id, (status, error) in results.items():
+            total[status] += 1
+            if error:
+                self.stderr.write(f"order {order_id}: {error}")
+        return total
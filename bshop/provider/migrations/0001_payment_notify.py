@@ -0,0 +1,70 @@
+# Generated by Django 3.0.5 on 2026-10-18 16:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ("wechat_django_pay", "0001_pay"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PaymentNotify",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("uuid", models.UUIDField(default=uuid.uuid4, unique=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True, db_index=True)),
+                ("updated_at", models.DateTimeField(auto_now=True, db_index=True)),
+                ("provider", models.CharField(max_length=16)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("PENDING", "PENDING"),
+                            ("SETTLED", "SETTLED"),
+                            ("FAILED", "FAILED"),
+                        ],
+                        default="PENDING",
+                        max_length=16,
+                    ),
+                ),
+                ("attempts", models.IntegerField(default=0)),
+                ("error", models.TextField(blank=True, null=True)),
+                ("settled_at", models.DateTimeField(blank=True, null=True)),
+                (
+                    "order",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="payment_notify",
+                        to="wechat_django_pay.UnifiedOrder",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Payment notify",
+                "verbose_name_plural": "Payment notifies",
+            },
+        ),
+        migrations.AddIndex(
+            model_name="paymentnotify",
+            index=models.Index(
+                condition=models.Q(status="PENDING"),
+                fields=["id"],
+                name="provider_notify_pending_idx",
+            ),
+        ),
+    ]
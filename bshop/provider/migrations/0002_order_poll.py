@@ -0,0 +1,37 @@
+# Generated by Django 3.0.5 on 2026-10-18 16:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("wechat_django_pay", "0001_pay"),
+        ("provider", "0001_payment_notify"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OrderPoll",
+            fields=[
+                (
+                    "order",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="poll",
+                        serialize=False,
+                        to="wechat_django_pay.UnifiedOrder",
+                    ),
+                ),
+                ("attempts", models.IntegerField(default=0)),
+                ("polled_at", models.DateTimeField(null=True)),
+                ("next_poll_at", models.DateTimeField(db_index=True)),
+            ],
+            options={
+                "verbose_name": "Order poll",
+                "verbose_name_plural": "Order polls",
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.5 on 2026-10-18 17:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("provider", "0002_order_poll"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="paymentnotify",
+            name="retry_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
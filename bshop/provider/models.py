@@ -0,0 +1,79 @@
+from django.db import models
+from django.db.models import Q
+from django.utils.translation import gettext_lazy as _
+from wechat_django.pay.models import UnifiedOrder
+
+from common.base_models import BaseModel
+from common.utils import utc_now
+
+
+class PaymentNotifyManager(models.Manager):
+    def record(self, order, provider="WECHAT") -> bool:
+        """ Persist the paid notify of the order, False if already recorded """
+        __, created = self.get_or_create(order=order, defaults={"provider": provider})
+        return created
+
+    def pending(self):
+        return self.filter(status="PENDING")
+
+    def due(self, now):
+        """ The pending notifies not backing off after a conflict """
+        return self.pending().filter(Q(retry_at__isnull=True) | Q(retry_at__lte=now))
+
+    def lag(self):
+        """ Seconds since the oldest notify waiting for settlement """
+        oldest = (
+            self.pending().order_by("id").values_list("created_at", flat=True).first()
+        )
+        return (utc_now() - oldest).total_seconds() if oldest else 0
+
+
+class PaymentNotify(BaseModel):
+    """
+    A paid notify of the provider, acknowledged once recorded and settled
+    into the wallet in batches by provider.tasks.settle_payments.
+    """
+
+    STATUS_CHOICES = [(x, x) for x in ["PENDING", "SETTLED", "FAILED"]]
+
+    order = models.OneToOneField(
+        UnifiedOrder, models.CASCADE, related_name="payment_notify"
+    )
+    provider = models.CharField(max_length=16)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default="PENDING")
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(null=True, blank=True)
+    settled_at = models.DateTimeField(null=True, blank=True)
+    # settled again from then on after a deadlock or serialization failure
+    retry_at = models.DateTimeField(null=True, blank=True)
+
+    objects = PaymentNotifyManager()
+
+    class Meta:
+        verbose_name = _("Payment notify")
+        verbose_name_plural = _("Payment notifies")
+        indexes = [
+            models.Index(
+                fields=["id"],
+                name="provider_notify_pending_idx",
+                condition=Q(status="PENDING"),
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.provider} {self.order_id} {self.status}"
+
+
+class OrderPoll(models.Model):
+    """ Backoff of the polling of an order waiting for payment """
+
+    order = models.OneToOneField(
+        UnifiedOrder, models.CASCADE, primary_key=True, related_name="poll"
+    )
+    attempts = models.IntegerField(default=0)
+    polled_at = models.DateTimeField(null=True)
+    next_poll_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        verbose_name = _("Order poll")
+        verbose_name_plural = _("Order polls")
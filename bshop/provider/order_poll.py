@@ -0,0 +1,103 @@
+"""
+Polling of the WeChat orders waiting for payment.
+
+Instead of a celery task per orderInfo query, provider.tasks.poll_wechat_orders
+runs every ORDER_POLL_INTERVAL seconds and queries WeChat for the orders
+neither final nor expired which are due, ORDER_POLL_CONCURRENCY at a time.
+Each order backs off exponentially, see OrderPoll. The paid orders go
+through the order_updated signal as for the notify.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.db.models import Q
+from wechat_django.pay.models import UnifiedOrder, UnifiedOrderResult
+
+from common.utils import utc_now
+from provider.http import use_session
+from provider.models import OrderPoll
+
+logger = logging.getLogger(__name__)
+
+ORDER_POLL_INTERVAL = 5
+ORDER_POLL_BATCH_SIZE = 200
+ORDER_POLL_CONCURRENCY = 8
+ORDER_POLL_BASE_DELAY = 5
+ORDER_POLL_MAX_DELAY = 600
+
+WAITING_STATES = [
+    UnifiedOrderResult.State.NOTPAY,
+    UnifiedOrderResult.State.USERPAYING,
+]
+
+
+def due_orders(now, limit=ORDER_POLL_BATCH_SIZE):
+    return list(
+        UnifiedOrder.objects.filter(time_expire__gt=now)
+        .filter(
+            Q(result__isnull=True)
+            | Q(result__trade_state__isnull=True)
+            | Q(result__trade_state__in=WAITING_STATES)
+        )
+        .filter(Q(poll__isnull=True) | Q(poll__next_poll_at__lte=now))
+        .select_related("pay__app", "poll")
+        .order_by("id")[:limit]
+    )
+
+
+def query_order(order):
+    """ Run in the pool, the result is applied by the caller """
+    try:
+        return order.pay.client.order.query(out_trade_no=order.out_trade_no)
+    except Exception as e:
+        logger.warning("poll order %s failed: %r", order.id, e)
+        return None
+
+
+def backoff(attempts: int) -> timedelta:
+    return timedelta(
+        seconds=min(ORDER_POLL_BASE_DELAY * 2 ** (attempts - 1), ORDER_POLL_MAX_DELAY)
+    )
+
+
+def poll_orders(now=None):
+    now = now or utc_now()
+    orders = due_orders(now)
+    if not orders:
+        return {"polled": 0, "failed": 0}
+
+    # one pay and client per merchant, built before the threads
+    pays = {}
+    for order in orders:
+        order.pay = pays.setdefault(order.pay_id, order.pay)
+        use_session(order.pay.client)
+
+    with ThreadPoolExecutor(max_workers=ORDER_POLL_CONCURRENCY) as pool:
+        results = list(pool.map(query_order, orders))
+
+    failed = 0
+    created, updated = [], []
+    for order, result in zip(orders, results):
+        if result is None:
+            failed += 1
+        else:
+            try:
+                order.update(result)
+            except Exception:
+                logger.exception("poll order %s: update failed", order.id)
+                failed += 1
+
+        try:
+            poll = order.poll
+            updated.append(poll)
+        except OrderPoll.DoesNotExist:
+            poll = OrderPoll(order=order)
+            created.append(poll)
+        poll.attempts += 1
+        poll.polled_at = now
+        poll.next_poll_at = now + backoff(poll.attempts)
+
+    OrderPoll.objects.bulk_create(created)
+    OrderPoll.objects.bulk_update(updated, ["attempts", "polled_at", "next_poll_at"])
+    return {"polled": len(orders), "failed": failed}
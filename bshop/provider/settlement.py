@@ -0,0 +1,221 @@
+"""
+Settlement of the paid orders into the wallet.
+
+The notify of the provider only records a PaymentNotify, the pending ones
+are settled in batches by provider.tasks.settle_payments on the
+"settlement" queue. The orders of a batch are deposited with one
+do_bulk_deposit, the pay through orders one by one. The batch runs in the
+transaction claiming it, so the orders failing on a deadlock or a
+serialization failure are left pending and settled again after a backoff.
+"""
+import logging
+from datetime import timedelta
+
+from django.db import transaction
+
+from common.utils import is_db_conflict, retry_on_db_conflict, to_decimal, utc_now
+from provider.models import PaymentNotify
+from user_center.models import ShopUser
+from wallet.action import do_bulk_deposit, do_cash_back, do_deposit, do_transfer
+from wallet.models import Fund, FundTransfer
+
+logger = logging.getLogger(__name__)
+
+SETTLE_BATCH_SIZE = 200
+# batches settled by one task run, the next run picks up the rest
+SETTLE_MAX_BATCHES = 10
+SETTLE_LAG_WARNING = 60
+SETTLE_RETRY_BASE_DELAY = 5
+SETTLE_RETRY_MAX_DELAY = 600
+
+
+def paid_order_note(order, user):
+    if order.ext_info and order.ext_info.get("to_user_id"):
+        return "deposit&buy"
+    return f"user:{user.id} deposit"
+
+
+@retry_on_db_conflict
+def deposit_paid_order(order, user: ShopUser = None):
+    """ Apply a paid order to the wallet, the caller checks it is not applied """
+    if user is None:
+        provider = order.ext_info["provider"]
+        user = ShopUser.objects.get_user_by_openid(provider, order.openid)
+
+    amount = to_decimal(order.total_fee / 100)
+    note = paid_order_note(order, user)
+    to_user = None
+    if order.ext_info and order.ext_info.get("to_user_id"):
+        to_user = ShopUser.objects.get(id=order.ext_info["to_user_id"])
+
+    with transaction.atomic():
+        # the deposit, transfer and cash back locks, in the wallet lock order
+        Fund.objects.lock_wallets(
+            debited=[user.get_user_fund()],
+            credited=[to_user.get_user_fund()] if to_user else [],
+        )
+        do_deposit(user, amount, order_id=order.id, note=note)
+
+        if to_user:
+            do_transfer(user, to_user, amount, order_id=order.id, note=note)
+
+        do_cash_back(user, amount, order_id=order.id, note=note)
+
+
+def settle_orders(orders):
+    """
+    Apply the paid orders not in the wallet yet, in the transaction of the
+    caller. Return {order.id: (status, error)}, status is one of "applied",
+    "skipped" and "failed", "retried" is added by _settle_batch.
+    """
+    # order_id of FundTransfer is the UnifiedOrder id
+    applied = set(
+        FundTransfer.objects.filter(
+            order_id__in=[str(o.id) for o in orders]
+        ).values_list("order_id", flat=True)
+    )
+    results = {o.id: ("skipped", None) for o in orders if str(o.id) in applied}
+    todo = [o for o in orders if str(o.id) not in applied]
+
+    users = {}
+    for provider in {o.ext_info["provider"] for o in todo}:
+        openids = [o.openid for o in todo if o.ext_info["provider"] == provider]
+        found = ShopUser.objects.get_users_by_openids(provider, openids)
+        users.update(((provider, k), v) for k, v in found.items())
+
+    applied, pay_through, deposits = [], [], []
+    for order in todo:
+        user = users.get((order.ext_info["provider"], order.openid))
+        if user is None:
+            results[order.id] = ("failed", f"no user of {order.openid}")
+            continue
+
+        results[order.id] = ("applied", None)
+        applied.append(user)
+        if order.ext_info.get("to_user_id"):
+            pay_through.append((order, user))
+        else:
+            amount = to_decimal(order.total_fee / 100)
+            deposits.append((user, amount, order.id, paid_order_note(order, user)))
+    if not applied:
+        return results
+
+    # the locks of the whole batch up front, in the wallet lock order: the
+    # holds and funds of the payers, then the shards of the vendors
+    to_users = ShopUser.objects.in_bulk(
+        [o.ext_info["to_user_id"] for o, __ in pay_through]
+    ).values()
+    funds = Fund.objects.get_user_funds([*applied, *to_users])
+    Fund.objects.lock_wallets(
+        debited=[funds[u.id] for u in applied],
+        credited=[funds[u.id] for u in to_users],
+    )
+
+    for order, user in pay_through:
+        # pay through orders go through the same path as the notify
+        deposit_paid_order(order, user=user)
+    if deposits:
+        do_bulk_deposit(deposits)
+    return results
+
+
+def _settle_batch(notifies):
+    orders = [n.order for n in notifies]
+    try:
+        with transaction.atomic():
+            return settle_orders(orders)
+    except Exception:
+        logger.exception("settle batch of %s orders failed, one by one", len(orders))
+
+    results = {}
+    for order in orders:
+        try:
+            with transaction.atomic():
+                results.update(settle_orders([order]))
+        except Exception as e:
+            if is_db_conflict(e):
+                logger.warning("settle order %s conflict, retry later: %s", order.id, e)
+                results[order.id] = ("retried", repr(e))
+                continue
+            logger.exception("settle order %s failed", order.id)
+            results[order.id] = ("failed", repr(e))
+    return results
+
+
+def retry_delay(attempts: int) -> timedelta:
+    return timedelta(
+        seconds=min(
+            SETTLE_RETRY_BASE_DELAY * 2 ** (attempts - 1), SETTLE_RETRY_MAX_DELAY
+        )
+    )
+
+
+def _settle_claimed(notifies):
+    """ Settle the claimed notifies and record the outcome on them """
+    results = _settle_batch(notifies)
+    now = utc_now()
+    for notify in notifies:
+        status, error = results[notify.order_id]
+        notify.attempts += 1
+        notify.error = error
+        notify.updated_at = now
+        if status == "retried":
+            notify.retry_at = now + retry_delay(notify.attempts)
+            continue
+        notify.status = "FAILED" if status == "failed" else "SETTLED"
+        notify.settled_at = None if status == "failed" else now
+    PaymentNotify.objects.bulk_update(
+        notifies,
+        ["attempts", "error", "status", "settled_at", "retry_at", "updated_at"],
+    )
+    return results
+
+
+def settle_pending(batch_size=SETTLE_BATCH_SIZE, max_batches=SETTLE_MAX_BATCHES):
+    """
+    Settle the due PaymentNotify, the batches are claimed with
+    SKIP LOCKED so that the workers of the queue settle in parallel.
+    """
+    total = {"applied": 0, "skipped": 0, "failed": 0, "retried": 0}
+    for __ in range(max_batches):
+        with transaction.atomic():
+            notifies = list(
+                PaymentNotify.objects.due(utc_now())
+                .select_for_update(skip_locked=True, of=("self",))
+                .select_related("order")
+                .order_by("id")[:batch_size]
+            )
+            if not notifies:
+                break
+
+            for status, __ in _settle_claimed(notifies).values():
+                total[status] += 1
+
+    lag = PaymentNotify.objects.lag()
+    if lag > SETTLE_LAG_WARNING:
+        logger.warning("payment settlement lag %.0fs", lag)
+    return dict(total, lag=lag)
+
+
+def replay_orders(orders):
+    """
+    Settle paid orders whose notify was missed. They are recorded as
+    PaymentNotify and claimed as by settle_pending, so that a worker does
+    not settle them too, the orders settled or claimed elsewhere are
+    "skipped". Return {order.id: (status, error)} like settle_orders.
+    """
+    for order in orders:
+        PaymentNotify.objects.record(order, order.ext_info["provider"])
+
+    results = {o.id: ("skipped", None) for o in orders}
+    with transaction.atomic():
+        notifies = list(
+            PaymentNotify.objects.pending()
+            .filter(order__in=orders)
+            .select_for_update(skip_locked=True, of=("self",))
+            .select_related("order")
+            .order_by("id")
+        )
+        if notifies:
+            results.update(_settle_claimed(notifies))
+    return results
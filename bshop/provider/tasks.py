@@ -0,0 +1,42 @@
+import logging
+from bshop.celery import app
+
+from common import redis_client
+from provider.order_poll import ORDER_POLL_INTERVAL, poll_orders
+from provider.settlement import settle_pending
+from provider.withdrawal import send_pending
+
+logger = logging.getLogger(__name__)
+
+
+# routed to the "settlement" queue, see bshop.celery
+@app.task
+def settle_payments():
+    res = settle_pending()
+    logger.info(f"settle payments: {res}")
+    return res
+
+
+# routed to the "withdraw" queue, its workers bound the concurrency
+@app.task
+def send_withdrawals():
+    res = send_pending()
+    logger.info(f"send withdrawals: {res}")
+    return res
+
+
+@app.task
+def poll_wechat_orders():
+    # one poller at a time, a run may outlast the interval
+    lock = redis_client.get_redis("lock").lock(
+        "poll_wechat_orders", timeout=ORDER_POLL_INTERVAL * 12
+    )
+    if not lock.acquire(blocking=False):
+        return None
+    try:
+        res = poll_orders()
+    finally:
+        lock.release()
+    if res["polled"]:
+        logger.info(f"poll wechat orders: {res}")
+    return res
@@ -1,12 +1,25 @@
-import json
+from io import StringIO
+from datetime import timedelta
+from unittest.mock import patch
 from uuid import uuid4
 from django_fakeredis import FakeRedis
+from requests import ConnectionError, Response
+from requests.adapters import BaseAdapter
 
+from django.db import OperationalError, connection
 from django.test import TestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.core.management import call_command
+from wechatpy.exceptions import WeChatPayException
 from wechat_django.models import WeChatApp
 from wechat_django.pay.models import WeChatPay, UnifiedOrder
 
-from common.utils import to_decimal, json_dumps
+from common.exceptions import ProviderUnavailable, WithdrawError
+from common.utils import to_decimal, utc_now
+from provider import get_provider, http
+from provider.models import OrderPoll, PaymentNotify
+from provider.order_poll import poll_orders
+from provider.tasks import settle_payments
 from wallet.utils import CashBackSettings
 from wallet.factory import FundFactory
 from wallet.models import Fund, HoldFund, FundAction, FundTransfer
@@ -14,6 +27,70 @@ from user_center.models import ShopUser
 from user_center.factory import ShopUserFactory
 
 
+class DeadlockDetected(Exception):
+    pgcode = "40P01"
+
+
+class FakeAdapter(BaseAdapter):
+    def __init__(self, status=200):
+        super().__init__()
+        self.status = status
+        self.timeouts = []
+
+    def send(self, request, timeout=None, **kwargs):
+        self.timeouts.append(timeout)
+        if self.status is None:
+            raise ConnectionError("brownout")
+        res = Response()
+        res.status_code, res.request, res.url = self.status, request, request.url
+        return res
+
+    def close(self):
+        pass
+
+
+class ProviderHttpTest(TestCase):
+    @FakeRedis("common.redis_client.get_redis_connection")
+    def test_circuit_breaker(self):
+        session = http.ProviderSession()
+        adapter = FakeAdapter()
+        session.mount("https://", adapter)
+        url = "https://api.mch.weixin.qq.com/pay/orderquery"
+
+        session.post(url)
+        self.assertEqual(adapter.timeouts, [http.ENDPOINT_TIMEOUTS["pay/orderquery"]])
+
+        adapter.status = None
+        for _ in range(http.BREAKER_THRESHOLD):
+            with self.assertRaises(ConnectionError):
+                session.post(url)
+        # fails fast, nothing is sent
+        with self.assertRaises(ProviderUnavailable):
+            session.post(url, timeout=1)
+        self.assertEqual(len(adapter.timeouts), 1 + http.BREAKER_THRESHOLD)
+
+        stats = http.get_http_stats()["pay/orderquery"]
+        self.assertEqual(stats["calls"], 1 + http.BREAKER_THRESHOLD)
+        self.assertEqual(stats["errors"], http.BREAKER_THRESHOLD)
+        self.assertEqual(stats["rejected"], 1)
+
+        # a trial call failing on any error opens it again until the next trial
+        breaker = session.breaker("api.mch.weixin.qq.com")
+        breaker.opened_at -= http.BREAKER_RESET_TIMEOUT
+        with patch.object(adapter, "send", side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                session.post(url)
+        self.assertFalse(breaker.trial)
+        with self.assertRaises(ProviderUnavailable):
+            session.post(url)
+
+        # a trial call after the reset timeout closes it
+        breaker.opened_at -= http.BREAKER_RESET_TIMEOUT
+        adapter.status = 200
+        session.post(url)
+        self.assertFalse(breaker.is_open)
+
+
 class ProviderTest(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -48,8 +125,9 @@ class ProviderTest(TestCase):
         FundTransfer.objects.all().delete()
         UnifiedOrder.objects.all().delete()
         HoldFund.objects.all().delete()
+        PaymentNotify.objects.all().delete()
 
-    @FakeRedis("provider.wechat.get_redis_connection")
+    @FakeRedis("common.redis_client.get_redis_connection")
     def test_order_update_transfer(self):
         # test deposit & transfer
         minimal = self.minimal_example
@@ -57,6 +135,7 @@ class ProviderTest(TestCase):
         order = self.app.pay.create_order(self.wechat_user, self.request, **minimal)
         result = self.success(self.app.pay, order)
         order.update(result)
+        settle_payments()
 
         new_fund = Fund.objects.get(id=self.fund.id)
         new_fund2 = Fund.objects.get(id=self.fund2.id)
@@ -76,7 +155,7 @@ class ProviderTest(TestCase):
         self.assertEqual(transfer.note, f"deposit&buy")
         self.assertEqual(transfer.amount, to_decimal("1.01"))
 
-    @FakeRedis("provider.wechat.get_redis_connection")
+    @FakeRedis("common.redis_client.get_redis_connection")
     def test_order_update_deposit(self):
         csettings = CashBackSettings()
         csettings.threshold = "1"
@@ -89,6 +168,23 @@ class ProviderTest(TestCase):
         old_hold = self.fund.hold
 
         order.update(result)
+        # the notify is only recorded
+        notify = PaymentNotify.objects.get(order=order)
+        self.assertEqual(notify.status, "PENDING")
+        self.assertEqual(Fund.objects.get(id=self.fund.id).cash, self.fund.cash)
+        self.assertGreaterEqual(PaymentNotify.objects.lag(), 0)
+
+        # a repeated notify is recorded once
+        order.update(result)
+        self.assertEqual(PaymentNotify.objects.filter(order=order).count(), 1)
+
+        res = settle_payments()
+        self.assertDictEqual(
+            res, {"applied": 1, "skipped": 0, "failed": 0, "retried": 0, "lag": 0}
+        )
+        notify.refresh_from_db()
+        self.assertEqual((notify.status, notify.attempts), ("SETTLED", 1))
+        self.assertIsNotNone(notify.settled_at)
 
         # test deposit
         new_fund = Fund.objects.get(id=self.fund.id)
@@ -107,9 +203,189 @@ class ProviderTest(TestCase):
         self.assertEqual(cashback_transfer.amount, to_decimal("1.01"))
 
         fund_action = FundAction.objects.get(fund=self.fund, transfer=cashback_transfer)
-        self.assertDictEqual(
-            fund_action.balance, json.loads(json_dumps(new_fund.amount_d))
+        self.assertEqual(fund_action.amount, to_decimal("1.01"))
+        self.assertDictEqual(fund_action.amount_d, new_fund.amount_d)
+
+    @FakeRedis("common.redis_client.get_redis_connection")
+    def test_settle_locks_up_front(self):
+        CashBackSettings().threshold = "1"
+        Fund.objects.set_shard_count(self.fund2, 2)
+        fund3 = FundFactory(shop_user=ShopUserFactory(wechat_id="openid3"))
+        payers = [self.app.users.create(openid="openid3"), self.wechat_user]
+        for payer, to_user in zip(payers, (None, self.shop_user2)):
+            minimal = dict(self.minimal_example, openid=payer.openid)
+            if to_user:
+                minimal["ext_info"]["to_user_id"] = to_user.id
+            order = self.app.pay.create_order(payer, self.request, **minimal)
+            order.update(self.success(self.app.pay, order))
+
+        with CaptureQueriesContext(connection) as ctx:
+            res = settle_payments()
+        self.assertEqual(res["applied"], 2)
+
+        # every lock of the batch is taken before its first write
+        sqls = [q["sql"] for q in ctx.captured_queries]
+        locks = [i for i, sql in enumerate(sqls) if "FOR UPDATE" in sql]
+        writes = [
+            i
+            for i, sql in enumerate(sqls)
+            if sql.startswith(("UPDATE", "INSERT", "WITH")) and "wallet_" in sql
+        ]
+        tables = [sqls[i].split('FROM "')[1].split('"')[0] for i in locks[1:4]]
+        self.assertEqual(tables, ["wallet_holdfund", "wallet_fund", "wallet_fundshard"])
+        self.assertLess(locks[3], writes[0])
+        # the funds of both payers in the first lock
+        for fund in (fund3, self.fund):
+            self.assertIn(str(fund.id), sqls[locks[2]])
+
+    @FakeRedis("common.redis_client.get_redis_connection")
+    def test_settle_conflict(self):
+        order = self.app.pay.create_order(
+            self.wechat_user, self.request, **self.minimal_example
         )
+        order.update(self.success(self.app.pay, order))
+
+        # a deadlock leaves the notify pending, backing off
+        deadlock = OperationalError("deadlock detected")
+        deadlock.__cause__ = DeadlockDetected()
+        with patch("provider.settlement.do_bulk_deposit", side_effect=deadlock):
+            self.assertEqual(settle_payments()["retried"], 1)
+        notify = PaymentNotify.objects.get(order=order)
+        self.assertEqual((notify.status, notify.attempts), ("PENDING", 1))
+        self.assertGreater(notify.retry_at, utc_now())
+
+        self.assertEqual(settle_payments()["applied"], 0)
+        with patch("provider.settlement.utc_now", return_value=notify.retry_at):
+            self.assertEqual(settle_payments()["applied"], 1)
+        notify.refresh_from_db()
+        self.assertEqual((notify.status, notify.attempts), ("SETTLED", 2))
+
+        # the other errors are not retried
+        order = self.app.pay.create_order(
+            self.wechat_user, self.request, **self.minimal_example
+        )
+        order.update(self.success(self.app.pay, order))
+        with patch("provider.settlement.do_bulk_deposit", side_effect=ValueError):
+            self.assertEqual(settle_payments()["failed"], 1)
+        self.assertEqual(PaymentNotify.objects.get(order=order).status, "FAILED")
+
+    @FakeRedis("common.redis_client.get_redis_connection")
+    def test_replay_paid_orders(self):
+        csettings = CashBackSettings()
+        csettings.threshold = "1"
+
+        orders = []
+        for i in range(3):
+            minimal = self.minimal_example
+            if i == 2:
+                minimal["ext_info"]["to_user_id"] = self.shop_user2.id
+            order = self.app.pay.create_order(self.wechat_user, self.request, **minimal)
+            # the notify was missed
+            order.update(self.success(self.app.pay, order), signal=False)
+            orders.append(order)
+        # already applied by the notify
+        orders[0].update(self.success(self.app.pay, orders[0]))
+        settle_payments()
+        # not paid
+        self.app.pay.create_order(
+            self.wechat_user, self.request, **self.minimal_example
+        )
+
+        out = StringIO()
+        call_command("replay_paid_orders", chunk_size=2, stdout=out)
+        self.assertIn("applied=2 skipped=1 failed=0", out.getvalue())
+        # recorded and claimed as the notifies, not settled again by the task
+        self.assertEqual(
+            PaymentNotify.objects.filter(order__in=orders, status="SETTLED").count(), 3,
+        )
+
+        new_fund = Fund.objects.get(id=self.fund.id)
+        new_fund2 = Fund.objects.get(id=self.fund2.id)
+        # three deposits and cash backs, one paid through to fund2
+        self.assertEqual(self.fund.total + to_decimal("5.05"), new_fund.total)
+        self.assertEqual(self.fund2.cash + to_decimal("1.01"), new_fund2.cash)
+
+        for order in orders:
+            types = FundTransfer.objects.filter(order_id=order.id).values_list(
+                "type", flat=True
+            )
+            self.assertIn("DEPOSIT", types)
+            self.assertIn("CASHBACK", types)
+
+        # replay again is a no-op
+        out = StringIO()
+        call_command("replay_paid_orders", stdout=out)
+        self.assertIn("applied=0 skipped=3 failed=0", out.getvalue())
+        self.assertEqual(Fund.objects.get(id=self.fund.id).amount_d, new_fund.amount_d)
+
+    @FakeRedis("common.redis_client.get_redis_connection")
+    def test_poll_orders(self):
+        paid = self.app.pay.create_order(
+            self.wechat_user, self.request, **self.minimal_example
+        )
+        waiting = self.app.pay.create_order(
+            self.wechat_user, self.request, **self.minimal_example
+        )
+        results = {
+            paid.id: self.success(self.app.pay, paid),
+            waiting.id: dict(self.success(self.app.pay, waiting), trade_state="NOTPAY"),
+        }
+
+        now = utc_now()
+        with patch("provider.order_poll.query_order", lambda order: results[order.id]):
+            self.assertDictEqual(poll_orders(now), {"polled": 2, "failed": 0})
+            # not due yet
+            self.assertDictEqual(poll_orders(now), {"polled": 0, "failed": 0})
+            # the paid order is not polled anymore
+            later = now + timedelta(seconds=5)
+            self.assertDictEqual(poll_orders(later), {"polled": 1, "failed": 0})
+
+        self.assertEqual(PaymentNotify.objects.get(order=paid).status, "PENDING")
+        self.assertFalse(PaymentNotify.objects.filter(order=waiting).exists())
+        poll = OrderPoll.objects.get(order=waiting)
+        self.assertEqual(poll.attempts, 2)
+        self.assertEqual(poll.next_poll_at, later + timedelta(seconds=10))
+
+    def test_provider_cache(self):
+        app = WeChatApp.objects.create(
+            title="liuxiaoge", name="liuxiaoge", appid="appid2", appsecret="secret"
+        )
+        WeChatPay.objects.create(app=app, mch_id="mch_id2", api_key="api_key")
+
+        provider = get_provider("WECHAT")
+        app = provider.app
+        self.assertEqual(app.pay.mch_id, "mch_id2")
+
+        # shared, no query once loaded
+        with self.assertNumQueries(0):
+            self.assertIs(get_provider("WECHAT").app.pay.client, app.pay.client)
+
+        # reloaded when the configuration is changed
+        app.pay.save()
+        self.assertIsNot(get_provider("WECHAT"), provider)
+
+    def test_withdraw_errors(self):
+        app = WeChatApp.objects.create(
+            title="liuxiaoge", name="liuxiaoge", appid="appid2", appsecret="secret"
+        )
+        WeChatPay.objects.create(app=app, mch_id="mch_id2", api_key="api_key")
+        provider = get_provider("WECHAT")
+
+        def fail(errcode):
+            return WeChatPayException("SUCCESS", "FAIL", errcode=errcode)
+
+        transfer = "wechatpy.pay.api.WeChatTransfer.transfer"
+        # refused, the withdrawal is reversed
+        with patch(transfer, side_effect=fail("NOTENOUGH")):
+            with self.assertRaises(WithdrawError):
+                provider.withdraw("openid", to_decimal("1"), "desc", out_trade_no="w1")
+        # maybe paid, sent again with the same out_trade_no
+        for error in (fail("SYSTEMERROR"), WeChatPayException(None)):
+            with patch(transfer, side_effect=error):
+                with self.assertRaises(WeChatPayException):
+                    provider.withdraw(
+                        "openid", to_decimal("1"), "desc", out_trade_no="w1"
+                    )
 
     def rf(self, **defaults):
         return RequestFactory(**defaults)
@@ -4,26 +4,49 @@ from decimal import Decimal
 
 from django.conf import settings
 from django.db import transaction
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from django_redis import get_redis_connection
 
 import wechatpy
 from wechat_django.pay import signals
 from wechat_django.models import WeChatApp, WeChatUser
+from wechat_django.pay.models import WeChatPay
 from wechat_django.pay.models.orderresult import UnifiedOrderResult, UnifiedOrder
 
 from common import exceptions
-from common.utils import yuan2fen, to_decimal, fen2yuan, AvoidResubmit
+from common.utils import yuan2fen, fen2yuan
 from common.schema import LoginProvider
-from provider import BaseProvider
+from provider import BaseProvider, reload_providers
+from provider.http import use_wechat_session
 from user_center.models import ShopUser
-from wallet.tasks import sync_wechat_order
-from wallet.models import FundTransfer
-from wallet.action import do_deposit, do_transfer, do_cash_back
+from provider.models import PaymentNotify
+from provider.tasks import settle_payments
 
 
 logger = logging.getLogger(__name__)
 
+# err_code of the transfers refused for good, the others (SYSTEMERROR,
+# SEND_FAILED, FREQ_LIMIT, timeouts...) may have been paid and are sent
+# again with the same partner_trade_no
+# https://pay.weixin.qq.com/wiki/doc/api/tools/mch_pay.php?chapter=14_2
+WITHDRAW_REJECTED = {
+    "NO_AUTH",
+    "AMOUNT_LIMIT",
+    "PARAM_ERROR",
+    "OPENID_ERROR",
+    "NOTENOUGH",
+    "NAME_MISMATCH",
+    "SIGN_ERROR",
+    "XML_ERROR",
+    "MONEY_LIMIT",
+    "CA_ERROR",
+    "V2_ACCOUNT_SIMPLE_BAN",
+    "PARAM_IS_NOT_UTF8",
+    "SENDNUM_LIMIT",
+    "RECV_ACCOUNT_NOT_ALLOWED",
+    "PAY_CHANNEL_NOT_ALLOWED",
+}
+
 
 class WeChatProvider(BaseProvider):
     field = "wechat_id"
@@ -36,7 +59,8 @@ class WeChatProvider(BaseProvider):
         if self._app:
             return self._app
 
-        self._app = WeChatApp.objects.get_by_name("liuxiaoge")
+        # shared by the requests, the app caches its pay and clients
+        self._app = use_wechat_session(WeChatApp.objects.get_by_name("liuxiaoge"))
         return self._app
 
     @property
@@ -129,16 +153,7 @@ class WeChatProvider(BaseProvider):
         except UnifiedOrder.DoesNotExist:
             return None
 
-        # just add one task in 10s
-        expire = 10
-        avoid_resubmit = AvoidResubmit("async_wechat_order", timeout=expire)
-        try:
-            avoid_resubmit(order.id)
-            sync_wechat_order.apply_async(args=[order.id], expires=expire)
-        except avoid_resubmit.ResubmittedError:
-            print("Avoid async wechat_order*********")
-            pass
-
+        # synced by provider.tasks.poll_wechat_orders
         return {
             "id": order_id,
             "state": order.trade_state(),
@@ -170,8 +185,11 @@ class WeChatProvider(BaseProvider):
                 device_info=device_info,
             )
         except wechatpy.exceptions.WeChatPayException as e:
-            logger.exception(str(e))
-            raise exceptions.WithdrawError(str(e))
+            if e.errcode in WITHDRAW_REJECTED:
+                logger.warning("withdraw %s rejected: %s", out_trade_no, e)
+                raise exceptions.WithdrawError(str(e))
+            # outcome unknown, retried by provider.withdrawal
+            raise
 
         # OrderedDict([('return_code', 'SUCCESS'), ('return_msg', None), ('mch_appid', 'wx478898d89cf437dc'), ('mchid', '1231736602'), ('nonce_str', 'pslL019BgHIzSDqfv8F Uy6EC32OtZauK'), ('result_code', 'SUCCESS'), ('partner_trade_no', '1231736602201910260304298054'), ('payment_no', '10100101184011910260023619583860'), ('paymen t_time', '2019-10-26 11:04:32')])
         return res
@@ -184,35 +202,18 @@ def order_updated(result, order, state, attach, **kwargs):
         logger.info(f"{order} deposit signal, skip for no-success state")
         return
 
-    if FundTransfer.objects.filter(order_id=order.id).exists():
+    # acknowledged once recorded, settle_payments applies it to the wallet
+    if not PaymentNotify.objects.record(order):
         logger.info(f"{order} deposit signal, skip for duplicate trigger")
         return
 
-    con = get_redis_connection()
-    lock_name = f"order:{order.id}_update_signal"
-
-    provider = order.ext_info["provider"]
-    user = ShopUser.objects.get_user_by_openid(provider, order.openid)
-
-    amount = to_decimal(order.total_fee / 100)
-    is_transfer = bool(order.ext_info and order.ext_info.get("to_user_id"))
-
-    if is_transfer:
-        to_user_id = order.ext_info["to_user_id"]
-        to_user = ShopUser.objects.get(id=to_user_id)
-        note = "deposit&buy"
-    else:
-        note = f"user:{user.id} deposit"
-
-    # Ensure cocurrent callback in 10 seconds
-    with con.lock(lock_name, timeout=10):
-        with transaction.atomic():
-            if is_transfer:
-                do_deposit(user, amount, order_id=order.id, note=note)
-                do_transfer(user, to_user, amount, order_id=order.id, note=note)
-            else:
-                do_deposit(user, amount, order_id=order.id, note=note)
+    transaction.on_commit(lambda: settle_payments.delay())
+    logger.info(f"{order} deposit signal, queued for settlement")
 
-            do_cash_back(user, amount, order_id=order.id, note=note)
 
-    logger.info(f"{order} deposit success: {note}")
+@receiver([post_save, post_delete], sender=WeChatApp)
+@receiver([post_save, post_delete], sender=WeChatPay)
+def wechat_config_changed(**kwargs):
+    # again on commit, a request may have reloaded the old configuration
+    reload_providers()
+    transaction.on_commit(reload_providers)
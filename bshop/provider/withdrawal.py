@@ -0,0 +1,151 @@
+"""
+Withdrawals sent to the provider out of the request.
+
+The Withdraw mutation debits the fund with a PENDING FundTransfer and a
+WithdrawOutbox row in one transaction. The workers of the "withdraw" queue
+lease the outbox rows, call the provider without holding any lock, then
+settle the transfer or reverse it if the provider refused it. The
+concurrency towards the provider is bounded by the workers of the queue.
+"""
+import logging
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F
+
+from common import exceptions
+from common.utils import retry_on_db_conflict, utc_now
+from provider import get_provider
+from provider.http import BREAKER_RESET_TIMEOUT
+from wallet.action import do_reverse_withdraw, do_withdraw
+from wallet.models import FundTransfer, WithdrawOutbox
+
+logger = logging.getLogger(__name__)
+
+WITHDRAW_BATCH_SIZE = 10
+# longer than the timeout of the provider
+WITHDRAW_LEASE = 120
+WITHDRAW_MAX_ATTEMPTS = 5
+WITHDRAW_RETRY_DELAY = 30
+
+
+def _enqueue():
+    # provider.tasks imports this module
+    from provider.tasks import send_withdrawals
+
+    send_withdrawals.delay()
+
+
+@retry_on_db_conflict
+def request_withdraw(user, amount, provider: str, openid: str, desc: str, note=None):
+    """ Debit the fund and queue the withdrawal, return its FundTransfer """
+    with transaction.atomic():
+        transfer = do_withdraw(user, amount, note=note, status="PENDING")
+        WithdrawOutbox.objects.create(
+            transfer=transfer, provider=provider, openid=openid, desc=desc
+        )
+        transaction.on_commit(_enqueue)
+    return transfer
+
+
+def _lock_unsettled(outbox):
+    """ The outbox row locked, None if settled by another worker meanwhile """
+    return (
+        WithdrawOutbox.objects.select_for_update()
+        .filter(id=outbox.id)
+        .exclude(status__in=["DONE", "FAILED"])
+        .first()
+    )
+
+
+@transaction.atomic
+def settle(outbox, res):
+    outbox = _lock_unsettled(outbox)
+    if outbox is None:
+        return
+    FundTransfer.objects.filter(id=outbox.transfer_id).update(
+        status="SUCCESS",
+        order_id=res["payment_no"],
+        extra_info=dict(res),
+        updated_at=utc_now(),
+    )
+    outbox.status, outbox.result, outbox.error = "DONE", dict(res), None
+    outbox.save()
+
+
+@transaction.atomic
+def reverse(outbox, error: str):
+    locked = _lock_unsettled(outbox)
+    if locked is None:
+        return
+    do_reverse_withdraw(outbox.transfer, note=f"refund: {error}"[:128])
+    locked.status, locked.error = "FAILED", error
+    locked.save()
+
+
+@transaction.atomic
+def give_up(outbox, error: str):
+    """ The outcome is still unknown, left to the admin """
+    locked = _lock_unsettled(outbox)
+    if locked is None:
+        return
+    FundTransfer.objects.filter(id=outbox.transfer_id).update(
+        status="ADMIN_REQUIRED", updated_at=utc_now()
+    )
+    locked.status, locked.error = "FAILED", error
+    locked.save()
+
+
+def send(outbox) -> str:
+    """ Send a leased withdrawal, return what became of it """
+    transfer = outbox.transfer
+    try:
+        # the same out_trade_no for every attempt, paid once by the provider
+        res = get_provider(outbox.provider).withdraw(
+            outbox.openid, transfer.amount, outbox.desc, out_trade_no=transfer.uuid.hex
+        )
+    except exceptions.WithdrawError as e:
+        reverse(outbox, e.message)
+        return "reversed"
+    except exceptions.ProviderUnavailable as e:
+        # not sent, tried again once the breaker lets calls through
+        logger.warning("withdraw %s: %s", transfer.id, e)
+        WithdrawOutbox.objects.filter(id=outbox.id, status="SENDING").update(
+            status="PENDING",
+            attempts=F("attempts") - 1,
+            error=repr(e),
+            next_attempt_at=utc_now() + timedelta(seconds=BREAKER_RESET_TIMEOUT),
+        )
+        return "deferred"
+    except Exception as e:
+        logger.exception("withdraw %s: outcome unknown", transfer.id)
+        if outbox.attempts >= WITHDRAW_MAX_ATTEMPTS:
+            give_up(outbox, repr(e))
+            return "admin_required"
+
+        delay = WITHDRAW_RETRY_DELAY * 2 ** (outbox.attempts - 1)
+        WithdrawOutbox.objects.filter(id=outbox.id, status="SENDING").update(
+            status="PENDING",
+            error=repr(e),
+            next_attempt_at=utc_now() + timedelta(seconds=delay),
+        )
+        return "retry"
+
+    settle(outbox, res)
+    return "success"
+
+
+def send_pending(batch_size=WITHDRAW_BATCH_SIZE):
+    total = {
+        "success": 0,
+        "reversed": 0,
+        "retry": 0,
+        "deferred": 0,
+        "admin_required": 0,
+    }
+    while True:
+        outboxes = WithdrawOutbox.objects.claim(batch_size, WITHDRAW_LEASE)
+        if not outboxes:
+            return total
+        for outbox in outboxes:
+            total[send(outbox)] += 1
@@ -3,7 +3,7 @@ from django.contrib.auth.models import User
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth.hashers import make_password, check_password
 
-from provider import get_provider_cls
+from provider import get_provider, get_provider_cls
 from common.base_models import BaseModel, ModelWithExtraInfo
 from common import exceptions
 
@@ -16,20 +16,24 @@ class ShopUserManager(models.Manager):
         return shop_user
 
     def get_user_by_auth_code(self, provider, auth_code):
-        cls = get_provider_cls(provider)
-        obj = cls()
+        obj = get_provider(provider)
         openid = obj.get_openid(auth_code)
         kw = {obj.field: openid}
         shop_user = self.get(**kw)
         return shop_user
 
     def get_user_by_openid(self, provider, openid):
-        cls = get_provider_cls(provider)
-        obj = cls()
+        obj = get_provider(provider)
         kw = {obj.field: openid}
         shop_user = self.get(**kw)
         return shop_user
 
+    def get_users_by_openids(self, provider, openids):
+        """ Return {openid: shop_user} of the openids found """
+        field = get_provider_cls(provider).field
+        kw = {f"{field}__in": openids}
+        return {getattr(u, field): u for u in self.filter(**kw)}
+
 
 class ShopUser(BaseModel, ModelWithExtraInfo):
 
@@ -124,8 +128,7 @@ class ShopUser(BaseModel, ModelWithExtraInfo):
 
     def bind_third_account(self, provider, auth_code):
 
-        cls = get_provider_cls(provider)
-        obj = cls()
+        obj = get_provider(provider)
         openid = obj.get_openid(auth_code)
 
         val = getattr(self, obj.field)
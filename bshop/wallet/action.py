@@ -4,15 +4,22 @@ from datetime import timedelta
 from django.db import transaction
 
 from common import exceptions
-from common.utils import d0, utc_now
+from common.utils import d0, utc_now, retry_on_db_conflict
 from user_center.models import ShopUser
 
 from wallet.utils import CashBackSettings
-from wallet.models import Fund, FundAction, FundTransfer, HoldFund
+from wallet.models import Fund, FundTransfer, HoldFund
 
 logger = logging.getLogger(__name__)
 
+# Lock order of all the wallet writers, to avoid deadlocks:
+# HoldFund rows of the debited fund or the credited buckets, Fund rows by id,
+# then FundShard rows by (fund, shard). The actions locking more than one
+# row take them up front with FundManager.lock_wallets, the callers of
+# several actions in one transaction lock the union first.
 
+
+@retry_on_db_conflict
 @transaction.atomic
 def do_transfer(
     from_user: ShopUser,
@@ -28,17 +35,6 @@ def do_transfer(
     if from_fund.total < amount:
         raise exceptions.NotEnoughBalance
 
-    # First, we try to deduct from the HoldFund, if fail then deduct from Fund
-    remain_amount = HoldFund.objects.decr_hold(from_fund, amount)
-
-    if remain_amount < d0:
-        raise AssertionError("Should not happen here")
-    elif remain_amount > d0:
-        Fund.objects.decr_cash(from_fund.id, remain_amount)
-
-    new_from_fund = Fund.objects.get(id=from_fund.id)
-    new_to_fund = Fund.objects.incr_cash(to_fund.id, amount)
-
     transfer = FundTransfer.objects.create(
         from_fund=from_fund,
         to_fund=to_fund,
@@ -49,18 +45,93 @@ def do_transfer(
         extra_info=kw,
     )
 
-    FundAction.objects.add_action(from_fund, transfer, new_from_fund.amount_d)
-    FundAction.objects.add_action(to_fund, transfer, balance=new_to_fund.amount_d)
+    # First, we try to deduct from the HoldFund, if fail then deduct from Fund
+    remain_amount = HoldFund.objects.deduct(from_fund, amount)
+
+    if remain_amount < d0:
+        raise AssertionError("Should not happen here")
+
+    # the holds are locked by deduct, credits to a sharded fund do not touch
+    # its Fund row
+    shards = Fund.objects.lock_wallets(
+        debited=[from_fund], credited=[to_fund], holds=False
+    )
+    Fund.objects.fold_shards(from_fund)
+
+    Fund.objects.update_balance(
+        from_fund.id,
+        cash=-remain_amount,
+        hold=remain_amount - amount,
+        transfer=transfer,
+    )
+    Fund.objects.credit(
+        to_fund, amount, transfer=transfer, shard=shards.get(to_fund.id)
+    )
 
     return transfer
 
 
+@retry_on_db_conflict
+@transaction.atomic
+def do_batch_transfer(
+    from_user: ShopUser, items: list, note: str = None, **kw,
+):
+    """
+    Transfer to many users at once, `items` is a list of (to_user, amount).
+    The sender is debited once, recipients are credited with one UPDATE.
+    """
+    if not items or any(amount <= d0 for _, amount in items):
+        raise ValueError("Invalid minus amount")
+
+    from_fund = from_user.get_user_fund()
+    total = sum(amount for _, amount in items)
+
+    if from_fund.total < total:
+        raise exceptions.NotEnoughBalance
+
+    to_funds = Fund.objects.get_user_funds([to_user for to_user, _ in items])
+
+    transfers = FundTransfer.objects.bulk_create(
+        [
+            FundTransfer(
+                from_fund=from_fund,
+                to_fund=to_funds[to_user.id],
+                amount=amount,
+                note=note,
+                type="TRANSFER",
+                extra_info=kw,
+            )
+            for to_user, amount in items
+        ]
+    )
+
+    # Same as do_transfer, deduct from the HoldFund first, leg by leg
+    remain_amount = HoldFund.objects.deduct(from_fund, total)
+    hold_amount = total - remain_amount
+
+    # the recipients are credited on their Fund row, sharded or not
+    Fund.objects.lock_wallets(
+        debited=[from_fund], credited=to_funds.values(), holds=False, to_shards=False
+    )
+    Fund.objects.fold_shards(from_fund)
+
+    legs = []
+    for transfer in transfers:
+        hold = min(hold_amount, transfer.amount)
+        hold_amount -= hold
+        legs.append((from_fund.id, hold - transfer.amount, -hold, transfer))
+
+    legs.extend((t.to_fund_id, t.amount, d0, t) for t in transfers)
+    Fund.objects.update_balances(legs)
+
+    return transfers
+
+
+@retry_on_db_conflict
 @transaction.atomic
 def do_deposit(user: ShopUser, amount: Decimal, order_id: str, note: str = None, **kw):
     fund = user.get_user_fund()
 
-    new_fund = Fund.objects.incr_cash(fund.id, amount)
-
     transfer = FundTransfer.objects.create(
         to_fund=fund,
         amount=amount,
@@ -70,36 +141,118 @@ def do_deposit(user: ShopUser, amount: Decimal, order_id: str, note: str = None,
         extra_info=kw,
     )
 
-    FundAction.objects.add_action(fund, transfer, balance=new_fund.amount_d)
+    Fund.objects.credit(fund, amount, transfer=transfer)
 
     return transfer
 
 
+@retry_on_db_conflict
+@transaction.atomic
+def do_bulk_deposit(items: list, **kw):
+    """
+    Same as do_deposit then do_cash_back for each of the `items`, a list
+    of (user, amount, order_id, note), with bulk inserts and one balance
+    UPDATE for all of them.
+    """
+    csetting = CashBackSettings()
+    threshold = csetting.threshold
+    expired_at = utc_now() + timedelta(days=csetting.expired_days)
+
+    funds = Fund.objects.get_user_funds([user for user, *_ in items])
+
+    transfers = []
+    for user, amount, order_id, note in items:
+        fund = funds[user.id]
+        transfers.append(
+            FundTransfer(
+                to_fund=fund,
+                amount=amount,
+                order_id=order_id,
+                note=note,
+                type="DEPOSIT",
+                extra_info=kw,
+            )
+        )
+        if amount >= threshold:
+            transfers.append(
+                FundTransfer(
+                    to_fund=fund,
+                    amount=amount,
+                    order_id=order_id,
+                    note=f"cash_back: {amount}",
+                    type="CASHBACK",
+                    extra_info=kw,
+                )
+            )
+    transfers = FundTransfer.objects.bulk_create(transfers)
+
+    cash_backs = [t for t in transfers if t.type == "CASHBACK"]
+    if cash_backs:
+        HoldFund.objects.add_holds(
+            [(t.to_fund_id, t.amount, expired_at, t) for t in cash_backs]
+        )
+    Fund.objects.update_balances(
+        [
+            (t.to_fund_id, d0, t.amount, t)
+            if t.type == "CASHBACK"
+            else (t.to_fund_id, t.amount, d0, t)
+            for t in transfers
+        ]
+    )
+
+    return transfers
+
+
+@retry_on_db_conflict
 @transaction.atomic
 def do_withdraw(
-    user: ShopUser, amount: Decimal, order_id: str = None, note: str = None, **kw
+    user: ShopUser,
+    amount: Decimal,
+    order_id: str = None,
+    note: str = None,
+    status: str = "SUCCESS",
+    **kw,
 ):
     fund = user.get_user_fund()
 
     if amount <= d0:
         raise ValueError("Invalid minus amount")
 
-    new_fund = Fund.objects.decr_cash(fund.id, amount)
-
     transfer = FundTransfer.objects.create(
         from_fund=fund,
         amount=amount,
         order_id=order_id,
         note=note,
+        status=status,
         type="WITHDRAW",
         extra_info=kw,
     )
 
-    FundAction.objects.add_action(fund, transfer, balance=new_fund.amount_d)
+    Fund.objects.fold_shards(fund)
+    Fund.objects.decr_cash(fund.id, amount, transfer=transfer)
 
     return transfer
 
 
+@retry_on_db_conflict
+@transaction.atomic
+def do_reverse_withdraw(transfer: FundTransfer, note: str = None):
+    """ Credit a withdrawal refused by the provider back to its fund """
+    FundTransfer.objects.filter(id=transfer.id).update(
+        status="REVERSED", updated_at=utc_now()
+    )
+    refund = FundTransfer.objects.create(
+        to_fund_id=transfer.from_fund_id,
+        amount=transfer.amount,
+        order_id=str(transfer.uuid),
+        note=note,
+        type="REFUND",
+    )
+    Fund.objects.credit(transfer.from_fund, transfer.amount, transfer=refund)
+    return refund
+
+
+@retry_on_db_conflict
 @transaction.atomic
 def do_cash_back(
     user: ShopUser, amount: Decimal, order_id: str = None, note: str = None, **kw
@@ -123,9 +276,9 @@ def do_cash_back(
     )
 
     HoldFund.objects.incr_hold(
-        fund, amount, expired_at=utc_now() + timedelta(days=csetting.expired_days)
+        fund,
+        amount,
+        expired_at=utc_now() + timedelta(days=csetting.expired_days),
+        transfer=transfer,
     )
-
-    new_fund = Fund.objects.get(id=fund.id)
-    FundAction.objects.add_action(fund, transfer, balance=new_fund.amount_d)
     return transfer
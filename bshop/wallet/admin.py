@@ -1,10 +1,23 @@
 from django.contrib import admin
-from wallet.models import Fund, HoldFund, FundTransfer, FundAction
+from django.utils.translation import gettext_lazy as _
+
+from wallet.export import CHUNK_SIZE, streaming_export
+from wallet.models import (
+    ArchiveManifest,
+    Fund,
+    HoldFund,
+    HoldFundEntry,
+    FundTransfer,
+    FundAction,
+    FundCheckpoint,
+    WithdrawOutbox,
+)
 
 
 @admin.register(Fund)
 class FundAdmin(admin.ModelAdmin):
-    list_display = ("id", "shop_user", "currency", "cash")
+    list_display = ("id", "shop_user", "currency", "cash", "hold", "shard_count")
+    readonly_fields = ("shard_count",)
     search_fields = ["shop_user__phone", "shop_user__user__username"]
 
 
@@ -14,22 +27,75 @@ class HoldFundAdmin(admin.ModelAdmin):
         "id",
         "fund",
         "amount",
+        "expiry_day",
         "expired_at",
-        "order_id",
         "created_at",
         "updated_at",
     )
     search_fields = ["fund__shop_user__phone", "fund__shop_user__user__username"]
 
 
+@admin.register(HoldFundEntry)
+class HoldFundEntryAdmin(admin.ModelAdmin):
+    list_display = ("fund", "expiry_day", "amount", "order_id", "created_at")
+    search_fields = ["order_id", "fund__shop_user__phone"]
+    raw_id_fields = ("fund", "transfer")
+
+
 @admin.register(FundAction)
 class FundActionAdmin(admin.ModelAdmin):
-    list_display = ("fund", "transfer", "balance", "created_at", "updated_at")
+    list_display = ("fund", "seq", "transfer", "amount", "cash", "hold", "created_at")
     search_fields = ["fund__shop_user__phone", "fund__shop_user__user__username"]
 
+    # the journal is append-only, written by FundManager.update_balance
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+TRANSFER_EXPORT_FIELDS = [
+    "id",
+    "uuid",
+    "created_at",
+    "type",
+    "status",
+    "from_fund_id",
+    "to_fund_id",
+    "amount",
+    "order_id",
+    "note",
+]
+
+
+def export_transfers(queryset, fmt):
+    rows = (
+        queryset.order_by("id")
+        .values(*TRANSFER_EXPORT_FIELDS)
+        .iterator(chunk_size=CHUNK_SIZE)
+    )
+    return streaming_export(rows, TRANSFER_EXPORT_FIELDS, fmt, "transfers")
+
 
 @admin.register(FundTransfer)
 class FundTransferAdmin(admin.ModelAdmin):
+    list_filter = ("type", "status", "created_at")
+    actions = ["export_csv", "export_ndjson"]
+
+    def export_csv(self, request, queryset):
+        return export_transfers(queryset, "csv")
+
+    export_csv.short_description = _("Export selected transfers as CSV")
+
+    def export_ndjson(self, request, queryset):
+        return export_transfers(queryset, "ndjson")
+
+    export_ndjson.short_description = _("Export selected transfers as NDJSON")
+
     list_display = (
         "from_fund",
         "to_fund",
@@ -47,3 +113,32 @@ class FundTransferAdmin(admin.ModelAdmin):
         "to_fund__shop_user__phone",
         "to_fund__shop_user__user__username",
     ]
+
+
+@admin.register(WithdrawOutbox)
+class WithdrawOutboxAdmin(admin.ModelAdmin):
+    list_display = (
+        "transfer",
+        "provider",
+        "status",
+        "attempts",
+        "next_attempt_at",
+        "error",
+        "created_at",
+    )
+    list_filter = ("status", "provider")
+    raw_id_fields = ("transfer",)
+
+
+@admin.register(FundCheckpoint)
+class FundCheckpointAdmin(admin.ModelAdmin):
+    list_display = ("fund", "date", "seq", "cash", "hold")
+    list_filter = ("date",)
+    search_fields = ["fund__shop_user__phone", "fund__shop_user__user__username"]
+
+
+@admin.register(ArchiveManifest)
+class ArchiveManifestAdmin(admin.ModelAdmin):
+    list_display = ("table", "month", "rows", "fund_min", "fund_max", "key")
+    list_filter = ("table",)
+    readonly_fields = [f.name for f in ArchiveManifest._meta.fields]
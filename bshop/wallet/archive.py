@@ -0,0 +1,439 @@
+"""
+Archival of the old wallet journal to the cold storage.
+
+The rows of a month are written to gzipped column-oriented JSON files
+through common.upload.Uploader, one ArchiveManifest per file, and removed
+from the database, dropping the month's partitions. FundAction are archived
+with the ledger fields of their FundTransfer, so that the ledger of a fund
+reads on into the archive when a client pages past the database.
+"""
+import gzip
+import json
+import uuid
+import bisect
+import hashlib
+import logging
+from datetime import date, datetime
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, models, transaction
+from django.utils import timezone
+
+from common.upload import Uploader
+from common.utils import utc_now
+from wallet.models import (
+    ArchiveManifest,
+    FundAction,
+    FundArchive,
+    FundTransfer,
+    day_start,
+)
+from wallet.partitions import add_months, list_partitions, month_start, partition_name
+
+logger = logging.getLogger(__name__)
+
+CHUNK_ROWS = 50000
+# uncompressed size of the archived files kept by a process
+LOAD_CACHE_BYTES = 64 * 1024 * 1024
+# columns of the FundTransfer archived with each FundAction for the ledger
+LEDGER_TRANSFER_FIELDS = ["uuid", "type", "order_id", "note", "status", "created_at"]
+
+# rows of the month and net of each fund, read in one snapshot
+MONTH_TOTALS_SQL = """
+    WITH month AS (
+        SELECT from_fund_id, to_fund_id, amount FROM {transfer}
+        WHERE created_at >= %(start)s AND created_at < %(end)s
+    ), funds AS (
+        SELECT fund_id, SUM(credit) AS credit, SUM(debit) AS debit
+        FROM (
+            SELECT to_fund_id AS fund_id, amount AS credit, 0 AS debit FROM month
+            UNION ALL
+            SELECT from_fund_id, 0, amount FROM month
+        ) t
+        WHERE fund_id IS NOT NULL
+        GROUP BY fund_id
+    )
+    SELECT (SELECT COUNT(*) FROM month), fund_id, credit, debit
+    FROM (SELECT 1) one LEFT JOIN funds ON true
+"""
+
+FUND_ARCHIVE_SQL = """
+    INSERT INTO {fund_archive}
+    (uuid, created_at, updated_at, fund_id, credit, debit)
+    VALUES {values}
+    ON CONFLICT (fund_id) DO UPDATE SET
+    credit = {fund_archive}.credit + EXCLUDED.credit,
+    debit = {fund_archive}.debit + EXCLUDED.debit,
+    updated_at = EXCLUDED.updated_at
+"""
+FUND_ARCHIVE_BATCH = 1000
+
+
+class ArchiveEncoder(DjangoJSONEncoder):
+    def default(self, o):
+        # keep the microseconds
+        if isinstance(o, datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+def is_configured() -> bool:
+    """ Archived only to a storage set explicitly, never to a default disk """
+    options = settings.WALLET_ARCHIVE
+    return bool(options.get("ENDPOINT") or options.get("ROOT"))
+
+
+def get_uploader():
+    return Uploader(**settings.WALLET_ARCHIVE)
+
+
+def _select(model):
+    """ SQL and columns of the rows of a month of `model` to archive """
+    table = model._meta.db_table
+    columns = [f.column for f in model._meta.concrete_fields]
+    select = [f"a.{c}" for c in columns]
+    if model is not FundAction:
+        sql = (
+            f"SELECT {', '.join(select)} FROM {table} a "
+            f"WHERE a.created_at >= %s AND a.created_at < %s ORDER BY a.id"
+        )
+        return sql, columns
+
+    transfer = FundTransfer._meta
+    select += [f"t.{transfer.get_field(f).column}" for f in LEDGER_TRANSFER_FIELDS]
+    columns += [f"transfer.{f}" for f in LEDGER_TRANSFER_FIELDS]
+    sql = (
+        f"SELECT {', '.join(select)} FROM {table} a "
+        f"LEFT JOIN {transfer.db_table} t ON t.id = a.transfer_id "
+        f"WHERE a.created_at >= %s AND a.created_at < %s "
+        f"ORDER BY a.fund_id, a.seq"
+    )
+    return sql, columns
+
+
+def _dump(columns, rows) -> bytes:
+    data = {"columns": columns, "data": [list(values) for values in zip(*rows)]}
+    return gzip.compress(json.dumps(data, cls=ArchiveEncoder).encode())
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def _upload_month(model, month: date, uploader):
+    """
+    Write the rows of `month` to the cold storage, out of any transaction,
+    return the unsaved ArchiveManifest of the files.
+    """
+    table = model._meta.db_table
+    start, end = day_start(month), day_start(add_months(month, 1))
+    sql, columns = _select(model)
+    fund_id = columns.index("fund_id") if model is FundAction else None
+    manifests = []
+
+    # held in autocommit, the rows are read without keeping a snapshot
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(sql, [start, end])
+        while True:
+            rows = cursor.fetchmany(CHUNK_ROWS)
+            if not rows:
+                break
+
+            manifest = ArchiveManifest(table=table, month=month, rows=len(rows))
+            manifest.key = f"{table}/{month:%Y-%m}/{manifest.uuid}.json.gz"
+            if fund_id is not None:
+                manifest.fund_min = rows[0][fund_id]
+                manifest.fund_max = rows[-1][fund_id]
+            buf = _dump(columns, rows)
+            manifest.md5 = hashlib.md5(buf).hexdigest()
+            uploader.upload_bytes(buf, key=manifest.key)
+            manifests.append(manifest)
+    return manifests
+
+
+def _verify(manifests, uploader):
+    for manifest in manifests:
+        buf = uploader.download_bytes(manifest.key)
+        if hashlib.md5(buf).hexdigest() != manifest.md5:
+            raise ArchiveError(f"{manifest.key}: md5 mismatch")
+
+
+def _month_totals(model, month: date):
+    """
+    The number of rows of `month` and, for the transfers, the
+    [(fund_id, credit, debit)] of the month, read in one statement.
+    """
+    table = model._meta.db_table
+    start, end = day_start(month), day_start(add_months(month, 1))
+    with connection.cursor() as cursor:
+        if model is not FundTransfer:
+            cursor.execute(
+                f"SELECT COUNT(*) FROM {table} "
+                f"WHERE created_at >= %s AND created_at < %s",
+                [start, end],
+            )
+            return cursor.fetchone()[0], []
+
+        cursor.execute(
+            MONTH_TOTALS_SQL.format(transfer=table), {"start": start, "end": end}
+        )
+        rows = cursor.fetchall()
+    return rows[0][0], [row[1:] for row in rows if row[1] is not None]
+
+
+def _save_fund_archive(funds, cursor):
+    now = utc_now()
+    for i in range(0, len(funds), FUND_ARCHIVE_BATCH):
+        batch = funds[i : i + FUND_ARCHIVE_BATCH]
+        sql = FUND_ARCHIVE_SQL.format(
+            fund_archive=FundArchive._meta.db_table,
+            values=", ".join(["(%s, %s, %s, %s, %s, %s)"] * len(batch)),
+        )
+        params = [
+            x
+            for fund_id, credit, debit in batch
+            for x in (uuid.uuid4(), now, now, fund_id, credit, debit)
+        ]
+        cursor.execute(sql, params)
+
+
+def _detach(table, name, month: date, rows: int):
+    """
+    Detach the partition in a transaction of its own, the only one locking
+    the table, and attach it back if its rows are not the `rows` archived.
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+
+    # out of the table, counted without blocking its writers
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT COUNT(*) FROM {name}")
+        (count,) = cursor.fetchone()
+    if count == rows:
+        return
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            f"ALTER TABLE {table} ATTACH PARTITION {name} "
+            f"FOR VALUES FROM (%s) TO (%s)",
+            [day_start(month), day_start(add_months(month, 1))],
+        )
+    raise ArchiveError(f"{table} {month:%Y-%m}: rows changed, retry")
+
+
+def archive_month(model, month: date, uploader=None):
+    """
+    Move the rows of `month` of the model to the cold storage, return the
+    ArchiveManifest of the files written. The files are uploaded and
+    verified, then the rows are counted and the FundArchive computed before
+    the partition is detached on its own, and dropped once detached. It
+    fails if rows of the month changed meanwhile.
+    """
+    uploader = uploader or get_uploader()
+    table = model._meta.db_table
+    start, end = day_start(month), day_start(add_months(month, 1))
+
+    manifests = _upload_month(model, month, uploader)
+    _verify(manifests, uploader)
+    rows = sum(m.rows for m in manifests)
+
+    count, funds = _month_totals(model, month)
+    if count != rows:
+        raise ArchiveError(f"{table} {month:%Y-%m}: rows changed, retry")
+
+    name = partition_name(table, month)
+    partitioned = name in list_partitions(table)
+    if partitioned:
+        _detach(table, name, month, rows)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        if partitioned:
+            cursor.execute(f"DROP TABLE {name}")
+        else:
+            cursor.execute(
+                f"DELETE FROM {table} WHERE created_at >= %s AND created_at < %s",
+                [start, end],
+            )
+            if cursor.rowcount != rows:
+                raise ArchiveError(f"{table} {month:%Y-%m}: rows changed, retry")
+        ArchiveManifest.objects.bulk_create(manifests)
+        _save_fund_archive(funds, cursor)
+
+    logger.info(
+        "archive %s %s: %s rows, %s files",
+        table,
+        f"{month:%Y-%m}",
+        rows,
+        len(manifests),
+    )
+    return manifests
+
+
+def archive_until(cutoff: date, uploader=None):
+    """
+    Archive the FundAction older than the month of `cutoff` and the
+    FundTransfer older than the month before, as the actions of a month
+    may be of the transfers of the previous one. Return the manifests.
+    """
+    if uploader is None and not is_configured():
+        raise ArchiveError("No archive storage, set WALLET_ARCHIVE_ENDPOINT or ROOT")
+    uploader = uploader or get_uploader()
+    cutoff = month_start(cutoff)
+    manifests = []
+    for model, until in [
+        (FundAction, cutoff),
+        (FundTransfer, add_months(cutoff, -1)),
+    ]:
+        while True:
+            first = model.objects.aggregate(first=models.Min("created_at"))["first"]
+            if first is None or first >= day_start(until):
+                break
+            month = month_start(timezone.localdate(first))
+            manifests += archive_month(model, month, uploader)
+    return manifests
+
+
+class FileCache:
+    """
+    The archived files decoded, least recently used first out, bounded by
+    their uncompressed size. The files are immutable.
+    """
+
+    def __init__(self, max_bytes=LOAD_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # key: (columns, size)
+        self.files = OrderedDict()
+        self.size = 0
+
+    def get(self, key, download):
+        with self.lock:
+            if key in self.files:
+                self.files.move_to_end(key)
+                return self.files[key][0]
+
+        raw = gzip.decompress(download(key))
+        data = json.loads(raw)
+        columns = dict(zip(data["columns"], data["data"]))
+        with self.lock:
+            if key not in self.files and len(raw) <= self.max_bytes:
+                self.files[key] = (columns, len(raw))
+                self.size += len(raw)
+            while self.size > self.max_bytes:
+                __, (__, size) = self.files.popitem(last=False)
+                self.size -= size
+        return columns
+
+    def clear(self):
+        with self.lock:
+            self.files.clear()
+            self.size = 0
+
+
+file_cache = FileCache()
+
+
+def load(key: str):
+    """ {column: values} of an archived file """
+    return file_cache.get(key, lambda key: get_uploader().download_bytes(key))
+
+
+def _to_python(model, name, value):
+    return model._meta.get_field(name).to_python(value)
+
+
+def _archived_actions(manifest, fund_id):
+    """ Unsaved FundAction of the fund with their `transfer`, in seq order """
+    columns = load(manifest.key)
+    fund_ids = columns["fund_id"]
+    lo = bisect.bisect_left(fund_ids, fund_id)
+    hi = bisect.bisect_right(fund_ids, fund_id)
+
+    for i in range(lo, hi):
+        values = {name: column[i] for name, column in columns.items()}
+        action = FundAction(
+            **{
+                name: _to_python(FundAction, name, value)
+                for name, value in values.items()
+                if not name.startswith("transfer.")
+            }
+        )
+        # the transfer is missing if it was deleted before the archival
+        if action.transfer_id is not None and values["transfer.uuid"] is not None:
+            action.transfer = FundTransfer(
+                id=action.transfer_id,
+                **{
+                    name: _to_python(FundTransfer, name, values[f"transfer.{name}"])
+                    for name in LEDGER_TRANSFER_FIELDS
+                },
+            )
+        yield action
+
+
+def archived_ledger(fund, limit: int, cursor: int = None, older=True):
+    """ Same as FundActionManager.ledger over the archived FundAction """
+    manifests = ArchiveManifest.objects.filter(
+        table=FundAction._meta.db_table, fund_min__lte=fund.id, fund_max__gte=fund.id
+    ).order_by("-month" if older else "month")
+
+    actions, month = [], None
+    for manifest in manifests:
+        if manifest.month != month and len(actions) >= limit:
+            break
+        month = manifest.month
+        actions.extend(
+            action
+            for action in _archived_actions(manifest, fund.id)
+            if action.transfer_id is not None
+            and action.seq is not None
+            and (
+                cursor is None
+                or (action.seq < cursor if older else action.seq > cursor)
+            )
+        )
+
+    actions.sort(key=lambda action: action.seq, reverse=older)
+    actions = actions[:limit]
+    return actions if older else actions[::-1]
+
+
+def ledger(fund, limit: int, cursor: int = None, older=True, cursor_at=None):
+    """
+    FundActionManager.ledger continued into the archive, which holds the
+    oldest seq of the fund.
+    """
+    archived_until = ArchiveManifest.objects.filter(
+        table=FundAction._meta.db_table
+    ).aggregate(month=models.Max("month"))["month"]
+    in_archive = (
+        archived_until is not None
+        and cursor_at is not None
+        and cursor_at < day_start(add_months(archived_until, 1))
+    )
+
+    if older:
+        actions = FundAction.objects.ledger(
+            fund, limit, cursor=cursor, older=True, cursor_at=cursor_at
+        )
+        if len(actions) < limit and archived_until is not None:
+            last = actions[-1].seq if actions else cursor
+            actions += archived_ledger(fund, limit - len(actions), last, older=True)
+        return actions
+
+    actions = archived_ledger(fund, limit, cursor, older=False) if in_archive else []
+    if len(actions) < limit:
+        last = actions[0].seq if actions else cursor
+        actions = (
+            FundAction.objects.ledger(
+                fund,
+                limit - len(actions),
+                cursor=last,
+                older=False,
+                cursor_at=None if actions else cursor_at,
+            )
+            + actions
+        )
+    return actions
@@ -0,0 +1,85 @@
+"""
+Streaming CSV/NDJSON export of transfers, rows are read through a
+server-side cursor and written one by one to a StreamingHttpResponse.
+"""
+import csv
+import datetime
+
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from common.utils import json_dumps, utc_now
+
+CHUNK_SIZE = 2000
+
+CONTENT_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+class InvalidExportParams(ValueError):
+    pass
+
+
+class Echo:
+    """ File-like object returning what is written, for csv.writer """
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows, fields):
+    writer = csv.writer(Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([row[f] for f in fields])
+
+
+def ndjson_lines(rows, fields):
+    for row in rows:
+        yield json_dumps({f: row[f] for f in fields}) + "\n"
+
+
+def streaming_export(rows, fields, fmt, name):
+    if fmt not in CONTENT_TYPES:
+        raise InvalidExportParams(f"invalid format {fmt}")
+
+    lines = csv_lines(rows, fields) if fmt == "csv" else ndjson_lines(rows, fields)
+    response = StreamingHttpResponse(lines, content_type=CONTENT_TYPES[fmt])
+    filename = f"{name}-{utc_now():%Y%m%d%H%M%S}.{fmt}"
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+
+def parse_time(value, end=False):
+    """ Parse a datetime or a date, a date `end` is the start of the next day """
+    try:
+        # well formed but out of range values raise ValueError
+        dt = parse_datetime(value)
+        day = None if dt else parse_date(value)
+    except ValueError:
+        raise InvalidExportParams(f"invalid date {value}")
+    if dt is None:
+        if day is None:
+            raise InvalidExportParams(f"invalid date {value}")
+        if end:
+            day += datetime.timedelta(days=1)
+        dt = datetime.datetime.combine(day, datetime.time.min)
+    if timezone.is_naive(dt):
+        dt = timezone.make_aware(dt)
+    return dt
+
+
+def filter_transfers(queryset, params, prefix=""):
+    """
+    Filter by the `type`, `status`, `since` and `until` params, `prefix`
+    is the lookup path to FundTransfer.
+    """
+    lookups = {}
+    for name in ["type", "status"]:
+        if params.get(name):
+            lookups[f"{prefix}{name}"] = params[name]
+    if params.get("since"):
+        lookups[f"{prefix}created_at__gte"] = parse_time(params["since"])
+    if params.get("until"):
+        lookups[f"{prefix}created_at__lt"] = parse_time(params["until"], end=True)
+    return queryset.filter(**lookups)
@@ -0,0 +1,38 @@
+from datetime import datetime
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from wallet.archive import archive_until, is_configured
+from wallet.partitions import add_months, month_start
+
+
+class Command(BaseCommand):
+    help = "Move the FundAction and FundTransfer past the retention to the archive"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--before",
+            metavar="YYYY-MM",
+            help="Archive the months before, default to the retention setting",
+        )
+
+    def handle(self, *args, **options):
+        if not is_configured():
+            raise CommandError(
+                "No archive storage, set WALLET_ARCHIVE_ENDPOINT or WALLET_ARCHIVE_ROOT"
+            )
+        if options["before"]:
+            try:
+                cutoff = datetime.strptime(options["before"], "%Y-%m").date()
+            except ValueError as e:
+                raise CommandError(e)
+        else:
+            cutoff = add_months(
+                month_start(timezone.localdate()), -settings.WALLET_ARCHIVE_MONTHS
+            )
+
+        manifests = archive_until(cutoff)
+        for manifest in manifests:
+            self.stdout.write(f"Archived {manifest.rows} rows to {manifest.key}")
+        self.stdout.write(f"Archived {len(manifests)} files before {cutoff:%Y-%m}")
@@ -0,0 +1,32 @@
+import csv
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from wallet.models import FundCheckpoint
+
+
+class Command(BaseCommand):
+    help = "Write the balance of every fund at the end of a day as CSV"
+
+    def add_arguments(self, parser):
+        parser.add_argument("date", type=date.fromisoformat)
+        parser.add_argument(
+            "--build", action="store_true", help="Build the missing checkpoints"
+        )
+
+    def handle(self, *args, **options):
+        day = options["date"]
+        if options["build"]:
+            FundCheckpoint.objects.build_until(day)
+
+        writer = csv.writer(self.stdout)
+        writer.writerow(["fund_id", "date", "cash", "hold", "total"])
+
+        checkpoints = (
+            FundCheckpoint.objects.filter(date=day)
+            .order_by("fund_id")
+            .values_list("fund_id", "cash", "hold")
+        )
+        for fund_id, cash, hold in checkpoints.iterator(chunk_size=10000):
+            writer.writerow([fund_id, day, cash, hold, cash + hold])
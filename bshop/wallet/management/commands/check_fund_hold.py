@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from wallet.models import Fund
+
+
+class Command(BaseCommand):
+    help = "Check Fund.hold against the sum of HoldFund rows"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--fix", action="store_true", help="Recompute the mismatched Fund.hold"
+        )
+
+    def handle(self, *args, **options):
+        mismatched = Fund.objects.check_hold(fix=options["fix"])
+
+        for fund in mismatched:
+            self.stdout.write(
+                f"fund:{fund.id} hold={fund.hold} expected={fund.expected_hold}"
+            )
+
+        if options["fix"]:
+            self.stdout.write(f"Fixed {len(mismatched)} funds")
+        else:
+            self.stdout.write(f"Found {len(mismatched)} mismatched funds")
@@ -0,0 +1,29 @@
+from datetime import datetime
+from django.core.management.base import BaseCommand, CommandError
+
+from wallet.partitions import PARTITIONED_TABLES, detach_partition, ensure_partitions
+
+
+class Command(BaseCommand):
+    help = "Pre-create the monthly partitions of the wallet journal tables"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--months", type=int, default=3, help="Months ahead")
+        parser.add_argument(
+            "--detach", metavar="YYYY-MM", help="Detach the partitions of a month"
+        )
+
+    def handle(self, *args, **options):
+        if options["detach"]:
+            try:
+                month = datetime.strptime(options["detach"], "%Y-%m").date()
+                for table in PARTITIONED_TABLES:
+                    self.stdout.write(f"Detached {detach_partition(table, month)}")
+            except ValueError as e:
+                raise CommandError(e)
+            return
+
+        created = ensure_partitions(options["months"])
+        for name in created:
+            self.stdout.write(f"Created {name}")
+        self.stdout.write(f"Created {len(created)} partitions")
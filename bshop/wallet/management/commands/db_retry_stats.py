@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from common.utils import get_db_retry_stats
+
+
+class Command(BaseCommand):
+    help = "Show the deadlock/serialization retries of the wallet actions"
+
+    def handle(self, *args, **options):
+        stats = get_db_retry_stats()
+        for field, cnt in sorted(stats.items()):
+            self.stdout.write(f"{field} {cnt}")
+
+        if not stats:
+            self.stdout.write("No retries")
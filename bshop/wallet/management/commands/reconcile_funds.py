@@ -0,0 +1,41 @@
+import time
+
+from django.db.models import Max, Min
+from django.core.management.base import BaseCommand
+
+from wallet.models import Fund
+from wallet.reconcile import reconcile_parallel
+
+
+class Command(BaseCommand):
+    help = "Check every Fund against the net of its FundTransfer and HoldFund"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--from-id", type=int, help="First fund id")
+        parser.add_argument("--to-id", type=int, help="Last fund id")
+        parser.add_argument("--workers", type=int, default=1)
+
+    def handle(self, *args, **options):
+        ids = Fund.objects.aggregate(lo=Min("id"), hi=Max("id"))
+        if ids["lo"] is None:
+            self.stdout.write("No funds")
+            return
+
+        lo = options["from_id"] or ids["lo"]
+        hi = (options["to_id"] or ids["hi"]) + 1
+
+        start = time.monotonic()
+        checked = found = 0
+        for mismatches, cnt in reconcile_parallel(lo, hi, options["workers"]):
+            checked += cnt
+            found += len(mismatches)
+            for m in mismatches:
+                self.stdout.write(
+                    f"fund:{m.fund_id} total={m.total} expected={m.expected_total} "
+                    f"hold={m.hold} expected_hold={m.expected_hold}"
+                )
+
+        self.stdout.write(
+            f"Checked {checked} funds in {time.monotonic() - start:.1f}s, "
+            f"found {found} mismatched funds"
+        )
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from wallet.models import Fund
+
+
+class Command(BaseCommand):
+    help = "Spread the credits of a hot fund over shards, 0 to disable"
+
+    def add_arguments(self, parser):
+        parser.add_argument("fund_id", type=int)
+        parser.add_argument("count", type=int)
+
+    def handle(self, *args, **options):
+        fund = Fund.objects.get(id=options["fund_id"])
+        fund = Fund.objects.set_shard_count(fund, options["count"])
+        self.stdout.write(f"fund:{fund.id} shard_count={fund.shard_count}")
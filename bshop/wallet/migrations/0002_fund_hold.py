@@ -0,0 +1,33 @@
+# Generated by Django 3.0.5 on 2026-10-18 16:03
+
+import common.base_models
+from decimal import Decimal
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("wallet", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="fund",
+            name="hold",
+            field=common.base_models.DecimalField(
+                decimal_places=4, default=Decimal("0"), help_text="冻结余额", max_digits=65
+            ),
+        ),
+        migrations.RunSQL(
+            """
+            UPDATE wallet_fund SET hold = h.total
+            FROM (
+                SELECT fund_id, SUM(amount) AS total
+                FROM wallet_holdfund GROUP BY fund_id
+            ) AS h
+            WHERE wallet_fund.id = h.fund_id
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
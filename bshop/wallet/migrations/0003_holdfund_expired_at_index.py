@@ -0,0 +1,18 @@
+# Generated by Django 3.0.5 on 2026-10-18 16:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("wallet", "0002_fund_hold"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="holdfund",
+            name="expired_at",
+            field=models.DateTimeField(db_index=True, verbose_name="Expired At"),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 3.0.5 on 2026-10-18 16:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("wallet", "0003_holdfund_expired_at_index"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="fundtransfer",
+            index=models.Index(
+                fields=["from_fund", "created_at", "id"],
+                name="wallet_fund_from_fu_71b72c_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="fundtransfer",
+            index=models.Index(
+                fields=["to_fund", "created_at", "id"],
+                name="wallet_fund_to_fund_43d730_idx",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="fundtransfer",
+            name="from_fund",
+            field=models.ForeignKey(
+                db_index=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="transfer_as_from",
+                to="wallet.Fund",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="fundtransfer",
+            name="to_fund",
+            field=models.ForeignKey(
+                db_index=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="transfer_as_to",
+                to="wallet.Fund",
+            ),
+        ),
+    ]
@@ -0,0 +1,90 @@
+# Generated by Django 3.0.5 on 2026-10-18 16:13
+
+import common.base_models
+from decimal import Decimal
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("wallet", "0004_fundtransfer_ledger_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="fund", name="seq", field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="fundaction",
+            name="amount",
+            field=common.base_models.DecimalField(
+                decimal_places=4, default=Decimal("0"), max_digits=65
+            ),
+        ),
+        migrations.AddField(
+            model_name="fundaction",
+            name="cash",
+            field=common.base_models.DecimalField(
+                decimal_places=4, default=Decimal("0"), max_digits=65
+            ),
+        ),
+        migrations.AddField(
+            model_name="fundaction",
+            name="hold",
+            field=common.base_models.DecimalField(
+                decimal_places=4, default=Decimal("0"), max_digits=65
+            ),
+        ),
+        migrations.AddField(
+            model_name="fundaction",
+            name="seq",
+            field=models.BigIntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name="fundaction",
+            name="fund",
+            field=models.ForeignKey(
+                db_index=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="fund_actions",
+                to="wallet.Fund",
+            ),
+        ),
+        migrations.RunSQL(
+            """
+            UPDATE wallet_fundaction SET
+                seq = n.seq,
+                cash = COALESCE((wallet_fundaction.balance->>'cash')::numeric, 0),
+                hold = COALESCE((wallet_fundaction.balance->>'hold')::numeric, 0)
+            FROM (
+                SELECT id, row_number() OVER (
+                    PARTITION BY fund_id ORDER BY created_at, id
+                ) AS seq
+                FROM wallet_fundaction
+            ) AS n
+            WHERE wallet_fundaction.id = n.id;
+
+            UPDATE wallet_fundaction SET amount = CASE
+                WHEN t.from_fund_id = wallet_fundaction.fund_id THEN -t.amount
+                ELSE t.amount END
+            FROM wallet_fundtransfer t
+            WHERE wallet_fundaction.transfer_id = t.id;
+
+            UPDATE wallet_fund SET seq = a.seq
+            FROM (
+                SELECT fund_id, MAX(seq) AS seq
+                FROM wallet_fundaction GROUP BY fund_id
+            ) AS a
+            WHERE wallet_fund.id = a.fund_id;
+            """,
+            migrations.RunSQL.noop,
+        ),
+        migrations.AlterUniqueTogether(
+            name="fundaction", unique_together={("fund", "seq")},
+        ),
+        migrations.RemoveField(model_name="fundaction", name="balance",),
+    ]
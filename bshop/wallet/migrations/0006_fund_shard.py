@@ -0,0 +1,65 @@
+# Generated by Django 3.0.5 on 2026-10-18 16:19
+
+import common.base_models
+from decimal import Decimal
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("wallet", "0005_fundaction_journal"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="fund",
+            name="shard_count",
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name="fundaction",
+            name="seq",
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.CreateModel(
+            name="FundShard",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("uuid", models.UUIDField(default=uuid.uuid4, unique=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True, db_index=True)),
+                ("updated_at", models.DateTimeField(auto_now=True, db_index=True)),
+                ("shard", models.PositiveSmallIntegerField()),
+                (
+                    "cash",
+                    common.base_models.DecimalField(
+                        decimal_places=4, default=Decimal("0"), max_digits=65
+                    ),
+                ),
+                (
+                    "fund",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="shards",
+                        to="wallet.Fund",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Fund shard",
+                "verbose_name_plural": "Fund shards",
+                "unique_together": {("fund", "shard")},
+            },
+        ),
+    ]
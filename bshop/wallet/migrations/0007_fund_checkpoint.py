@@ -0,0 +1,71 @@
+# Generated by Django 3.0.5 on 2026-10-18 16:23
+
+import common.base_models
+from decimal import Decimal
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("wallet", "0006_fund_shard"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FundCheckpoint",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("uuid", models.UUIDField(default=uuid.uuid4, unique=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True, db_index=True)),
+                ("updated_at", models.DateTimeField(auto_now=True, db_index=True)),
+                ("date", models.DateField(db_index=True)),
+                ("seq", models.BigIntegerField(null=True)),
+                (
+                    "cash",
+                    common.base_models.DecimalField(
+                        decimal_places=4, default=Decimal("0"), max_digits=65
+                    ),
+                ),
+                (
+                    "hold",
+                    common.base_models.DecimalField(
+                        decimal_places=4, default=Decimal("0"), max_digits=65
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Fund checkpoint",
+                "verbose_name_plural": "Fund checkpoints",
+            },
+        ),
+        migrations.AddIndex(
+            model_name="fundaction",
+            index=models.Index(
+                fields=["fund", "created_at"], name="wallet_fund_fund_id_04492e_idx"
+            ),
+        ),
+        migrations.AddField(
+            model_name="fundcheckpoint",
+            name="fund",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="checkpoints",
+                to="wallet.Fund",
+            ),
+        ),
+        migrations.AlterUniqueTogether(
+            name="fundcheckpoint", unique_together={("fund", "date")},
+        ),
+    ]
@@ -0,0 +1,45 @@
+from django.db import migrations, models
+from django.db.migrations.exceptions import IrreversibleError
+import django.db.models.deletion
+
+from wallet.partitions import PARTITIONED_TABLES, partition_table
+
+
+def partition_tables(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        # wallet_fundtransfer first, it drops the foreign key of the actions
+        for table in PARTITIONED_TABLES:
+            partition_table(cursor, table)
+
+
+def unpartition_tables(apps, schema_editor):
+    # the rows may be spread over detached and archived partitions by now,
+    # and the foreign keys to the tables are gone
+    raise IrreversibleError("The wallet journal tables cannot be unpartitioned")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("wallet", "0007_fund_checkpoint"),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name="fundaction",
+                    name="transfer",
+                    field=models.ForeignKey(
+                        db_constraint=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="wallet.FundTransfer",
+                    ),
+                ),
+            ],
+        ),
+        # the copy runs under the lock of the renamed tables until the
+        # migration commits, plan a maintenance window for large journals
+        migrations.RunPython(partition_tables, unpartition_tables),
+    ]
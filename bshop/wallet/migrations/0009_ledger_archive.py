@@ -0,0 +1,93 @@
+# Generated by Django 3.0.5 on 2026-10-18 16:34
+
+import common.base_models
+from decimal import Decimal
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("wallet", "0008_partition_journal"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ArchiveManifest",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("uuid", models.UUIDField(default=uuid.uuid4, unique=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True, db_index=True)),
+                ("updated_at", models.DateTimeField(auto_now=True, db_index=True)),
+                ("table", models.CharField(max_length=64)),
+                ("month", models.DateField()),
+                ("fund_min", models.IntegerField(null=True)),
+                ("fund_max", models.IntegerField(null=True)),
+                ("rows", models.PositiveIntegerField()),
+                ("key", models.CharField(max_length=255)),
+                ("md5", models.CharField(max_length=32)),
+            ],
+            options={
+                "verbose_name": "Archive manifest",
+                "verbose_name_plural": "Archive manifests",
+            },
+        ),
+        migrations.CreateModel(
+            name="FundArchive",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("uuid", models.UUIDField(default=uuid.uuid4, unique=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True, db_index=True)),
+                ("updated_at", models.DateTimeField(auto_now=True, db_index=True)),
+                (
+                    "credit",
+                    common.base_models.DecimalField(
+                        decimal_places=4, default=Decimal("0"), max_digits=65
+                    ),
+                ),
+                (
+                    "debit",
+                    common.base_models.DecimalField(
+                        decimal_places=4, default=Decimal("0"), max_digits=65
+                    ),
+                ),
+                (
+                    "fund",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="archive",
+                        to="wallet.Fund",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Fund archive",
+                "verbose_name_plural": "Fund archives",
+            },
+        ),
+        migrations.AddIndex(
+            model_name="archivemanifest",
+            index=models.Index(
+                fields=["table", "fund_min", "fund_max"],
+                name="wallet_arch_table_3336ec_idx",
+            ),
+        ),
+    ]
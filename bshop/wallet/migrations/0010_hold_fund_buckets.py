@@ -0,0 +1,141 @@
+# Generated by Django 3.0.5 on 2026-10-18 16:42
+
+import common.base_models
+from decimal import Decimal
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def merge_holds(apps, schema_editor):
+    """
+    Record the holds as HoldFundEntry and merge them into the bucket of
+    their fund and expiry day, which expires with the latest of its holds.
+    """
+    params = {"tz": settings.TIME_ZONE}
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            """
+            UPDATE wallet_holdfund
+            SET expiry_day = (expired_at AT TIME ZONE %(tz)s)::date
+            """,
+            params,
+        )
+        cursor.execute(
+            """
+            INSERT INTO wallet_holdfundentry
+            (created_at, fund_id, expiry_day, amount, transfer_id, order_id)
+            SELECT h.created_at, h.fund_id, h.expiry_day, h.amount, t.id, h.order_id
+            FROM wallet_holdfund h
+            LEFT JOIN wallet_fundtransfer t
+            ON t.type = 'CASHBACK' AND t.order_id = h.order_id
+            ORDER BY h.id
+            """
+        )
+        cursor.execute(
+            """
+            WITH merged AS (
+                DELETE FROM wallet_holdfund h
+                USING (
+                    SELECT fund_id, expiry_day, MIN(id) AS keep
+                    FROM wallet_holdfund GROUP BY fund_id, expiry_day
+                    HAVING COUNT(*) > 1
+                ) g
+                WHERE h.fund_id = g.fund_id AND h.expiry_day = g.expiry_day
+                AND h.id <> g.keep
+                RETURNING g.keep, h.amount, h.expired_at
+            )
+            UPDATE wallet_holdfund
+            SET amount = wallet_holdfund.amount + m.amount,
+                expired_at = GREATEST(wallet_holdfund.expired_at, m.expired_at)
+            FROM (
+                SELECT keep, SUM(amount) AS amount, MAX(expired_at) AS expired_at
+                FROM merged GROUP BY keep
+            ) m
+            WHERE id = m.keep
+            """
+        )
+        # check the foreign keys now, the table is altered next
+        cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("wallet", "0009_ledger_archive"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="holdfund", name="expiry_day", field=models.DateField(null=True),
+        ),
+        migrations.CreateModel(
+            name="HoldFundEntry",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("expiry_day", models.DateField()),
+                (
+                    "amount",
+                    common.base_models.DecimalField(
+                        decimal_places=4, default=Decimal("0"), max_digits=65
+                    ),
+                ),
+                ("order_id", models.CharField(blank=True, max_length=64, null=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "fund",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="hold_entries",
+                        to="wallet.Fund",
+                    ),
+                ),
+                (
+                    "transfer",
+                    models.ForeignKey(
+                        db_constraint=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        to="wallet.FundTransfer",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Hold fund entry",
+                "verbose_name_plural": "Hold fund entries",
+            },
+        ),
+        migrations.AddIndex(
+            model_name="holdfundentry",
+            index=models.Index(
+                fields=["fund", "expiry_day"], name="wallet_hold_fund_id_c2ca79_idx"
+            ),
+        ),
+        migrations.RunPython(merge_holds, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="holdfund", name="expiry_day", field=models.DateField(),
+        ),
+        migrations.AlterField(
+            model_name="holdfund",
+            name="fund",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="hold_funds",
+                to="wallet.Fund",
+            ),
+        ),
+        migrations.AlterUniqueTogether(
+            name="holdfund", unique_together={("fund", "expiry_day")},
+        ),
+        migrations.RemoveField(model_name="holdfund", name="order_id",),
+    ]
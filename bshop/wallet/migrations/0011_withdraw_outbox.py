@@ -0,0 +1,117 @@
+# Generated by Django 3.0.5 on 2026-10-18 16:51
+
+import common.base_models
+import common.utils
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("wallet", "0010_hold_fund_buckets"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="fundtransfer",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("ADMIN_REQUIRED", "ADMIN_REQUIRED"),
+                    ("ADMIN_DENIED", "ADMIN_DENIED"),
+                    ("SUCCESS", "SUCCESS"),
+                    ("PENDING", "PENDING"),
+                    ("REVERSED", "REVERSED"),
+                ],
+                db_index=True,
+                default="SUCCESS",
+                max_length=16,
+                verbose_name="Transfer status",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="fundtransfer",
+            name="type",
+            field=models.CharField(
+                blank=True,
+                choices=[
+                    ("WITHDRAW", "WITHDRAW"),
+                    ("DEPOSIT", "DEPOSIT"),
+                    ("CASHBACK", "CASHBACK"),
+                    ("TRANSFER", "TRANSFER"),
+                    ("REFUND", "REFUND"),
+                ],
+                max_length=16,
+                null=True,
+                verbose_name="Transfer Type",
+            ),
+        ),
+        migrations.CreateModel(
+            name="WithdrawOutbox",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("uuid", models.UUIDField(default=uuid.uuid4, unique=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True, db_index=True)),
+                ("updated_at", models.DateTimeField(auto_now=True, db_index=True)),
+                ("provider", models.CharField(max_length=16)),
+                ("openid", models.CharField(max_length=128)),
+                ("desc", models.CharField(max_length=128)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("PENDING", "PENDING"),
+                            ("SENDING", "SENDING"),
+                            ("DONE", "DONE"),
+                            ("FAILED", "FAILED"),
+                        ],
+                        default="PENDING",
+                        max_length=16,
+                    ),
+                ),
+                ("attempts", models.IntegerField(default=0)),
+                ("next_attempt_at", models.DateTimeField(default=common.utils.utc_now)),
+                ("error", models.TextField(blank=True, null=True)),
+                (
+                    "result",
+                    common.base_models.MYJSONField(
+                        blank=True,
+                        encoder=django.core.serializers.json.DjangoJSONEncoder,
+                        null=True,
+                    ),
+                ),
+                (
+                    "transfer",
+                    models.OneToOneField(
+                        db_constraint=False,
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        related_name="withdraw_outbox",
+                        to="wallet.FundTransfer",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Withdraw outbox",
+                "verbose_name_plural": "Withdraw outbox",
+            },
+        ),
+        migrations.AddIndex(
+            model_name="withdrawoutbox",
+            index=models.Index(
+                condition=models.Q(status__in=["PENDING", "SENDING"]),
+                fields=["next_attempt_at"],
+                name="wallet_withdraw_due_idx",
+            ),
+        ),
+    ]
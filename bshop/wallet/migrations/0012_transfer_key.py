@@ -0,0 +1,86 @@
+# Generated by Django 3.0.5 on 2026-10-18 17:12
+
+from django.db import migrations, models
+
+# the keys are kept on delete, like the keys of the archived months, and
+# when wallet.partitions.create_partition moves rows out of the default
+# partition
+TRANSFER_KEY_SQL = """
+    INSERT INTO wallet_fundtransferkey (type, order_id, transfer_id, created_at)
+    SELECT DISTINCT ON (type, order_id) type, order_id, id, created_at
+    FROM wallet_fundtransfer
+    WHERE type IS NOT NULL AND order_id IS NOT NULL
+    ORDER BY type, order_id, id;
+
+    CREATE FUNCTION wallet_fundtransfer_key() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'UPDATE' THEN
+            IF NEW.type IS NOT DISTINCT FROM OLD.type
+                AND NEW.order_id IS NOT DISTINCT FROM OLD.order_id THEN
+                RETURN NULL;
+            END IF;
+            DELETE FROM wallet_fundtransferkey
+            WHERE type = OLD.type AND order_id = OLD.order_id
+            AND transfer_id = OLD.id;
+        END IF;
+        IF NEW.type IS NULL OR NEW.order_id IS NULL THEN
+            RETURN NULL;
+        END IF;
+        -- an UPDATE moving the row to another partition fires an INSERT
+        INSERT INTO wallet_fundtransferkey
+        (type, order_id, transfer_id, created_at)
+        VALUES (NEW.type, NEW.order_id, NEW.id, NEW.created_at)
+        ON CONFLICT (type, order_id) DO UPDATE SET created_at = EXCLUDED.created_at
+        WHERE wallet_fundtransferkey.transfer_id = EXCLUDED.transfer_id;
+        IF NOT FOUND THEN
+            RAISE unique_violation USING MESSAGE = format(
+                'duplicate fund transfer (%s, %s)', NEW.type, NEW.order_id
+            );
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER wallet_fundtransfer_key
+    AFTER INSERT OR UPDATE OF type, order_id ON wallet_fundtransfer
+    FOR EACH ROW EXECUTE PROCEDURE wallet_fundtransfer_key();
+"""
+
+DROP_TRANSFER_KEY_SQL = """
+    DROP TRIGGER wallet_fundtransfer_key ON wallet_fundtransfer;
+    DROP FUNCTION wallet_fundtransfer_key();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("wallet", "0011_withdraw_outbox"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FundTransferKey",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("type", models.CharField(max_length=16)),
+                ("order_id", models.CharField(max_length=64)),
+                ("transfer_id", models.BigIntegerField()),
+                ("created_at", models.DateTimeField()),
+            ],
+            options={
+                "verbose_name": "Fund transfer key",
+                "verbose_name_plural": "Fund transfer keys",
+                "unique_together": {("type", "order_id")},
+            },
+        ),
+        migrations.RunSQL(TRANSFER_KEY_SQL, DROP_TRANSFER_KEY_SQL),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations
+
+from wallet.partitions import PARTITIONED_TABLES, create_unique_indexes
+
+
+def default_partition_indexes(apps, schema_editor):
+    # the default partitions were created without the unique indexes
+    with schema_editor.connection.cursor() as cursor:
+        for table in PARTITIONED_TABLES:
+            create_unique_indexes(cursor, table, f"{table}_default")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("wallet", "0012_transfer_key"),
+    ]
+
+    operations = [
+        migrations.RunPython(default_partition_indexes, migrations.RunPython.noop),
+    ]
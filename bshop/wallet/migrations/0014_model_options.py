@@ -0,0 +1,66 @@
+# Generated by Django 3.0.5 on 2026-10-18 17:45
+
+import common.base_models
+from decimal import Decimal
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("wallet", "0013_default_partition_indexes"),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name="fund",
+            options={"verbose_name": "Fund", "verbose_name_plural": "Funds"},
+        ),
+        migrations.AlterModelOptions(
+            name="fundaction",
+            options={
+                "verbose_name": "Fund action",
+                "verbose_name_plural": "Fund actions",
+            },
+        ),
+        migrations.AlterModelOptions(
+            name="fundtransfer",
+            options={
+                "verbose_name": "Fund transfer",
+                "verbose_name_plural": "Fund transfers",
+            },
+        ),
+        migrations.AlterModelOptions(
+            name="holdfund",
+            options={"verbose_name": "Hold fund", "verbose_name_plural": "Hold funds"},
+        ),
+        migrations.AlterField(
+            model_name="fund",
+            name="cash",
+            field=common.base_models.DecimalField(
+                decimal_places=4, default=Decimal("0"), help_text="可提现余额", max_digits=65
+            ),
+        ),
+        migrations.AlterField(
+            model_name="fund",
+            name="currency",
+            field=models.CharField(default="CNY", help_text="币种", max_length=8),
+        ),
+        migrations.AlterField(
+            model_name="fundtransfer",
+            name="note",
+            field=models.CharField(
+                blank=True, max_length=128, null=True, verbose_name="Transfer Note"
+            ),
+        ),
+        migrations.AlterField(
+            model_name="holdfund",
+            name="amount",
+            field=common.base_models.DecimalField(
+                decimal_places=4,
+                default=Decimal("0"),
+                max_digits=65,
+                verbose_name="Amount",
+            ),
+        ),
+    ]
@@ -1,17 +1,23 @@
+import uuid
+import random
 import logging
 from decimal import Decimal
-from datetime import datetime
-from django.db import models, transaction
+from datetime import date, datetime, time, timedelta
+from django.db import models, transaction, connection
+from django.db.models import Q
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 
 from user_center.models import ShopUser
-from common.utils import d0, utc_now
+from common.utils import d0, utc_now, retry_on_db_conflict
+from wallet.partitions import month_start
 from common import exceptions
 from common.base_models import (
     BaseModel,
-    MYJSONField,
     DecimalField,
+    MYJSONField,
     ModelWithExtraInfo,
     RefreshFromDbInvalidatesCachedPropertiesMixin,
 )
@@ -20,30 +26,350 @@ logger = logging.getLogger(__name__)
 
 
 class FundManager(models.Manager):
-    def incr_cash(self, fund_id, amount: Decimal):
+    UPDATE_BALANCE_SQL = """
+        WITH updated AS (
+            UPDATE {fund}
+            SET cash = cash + %(cash)s, hold = hold + %(hold)s, seq = seq + 1
+            WHERE id = %(id)s AND cash + %(cash)s >= 0 AND hold + %(hold)s >= 0
+            RETURNING {columns}
+        ), journal AS (
+            INSERT INTO {fund_action}
+            (uuid, created_at, updated_at, fund_id, transfer_id, seq, amount, cash, hold)
+            SELECT %(uuid)s, %(now)s, %(now)s, id, %(transfer)s, seq,
+                %(cash)s + %(hold)s, cash, hold
+            FROM updated
+        )
+        SELECT {columns} FROM updated
+    """
+
+    def update_balance(
+        self, fund_id, cash: Decimal = d0, hold: Decimal = d0, transfer=None
+    ):
+        """
+        Add `cash` and `hold` (may be negative) to the fund, append the
+        change to its FundAction journal and return the updated fund, all
+        in the same statement.
+        """
+        fields = self.model._meta.concrete_fields
+        sql = self.UPDATE_BALANCE_SQL.format(
+            fund=self.model._meta.db_table,
+            fund_action=FundAction._meta.db_table,
+            columns=", ".join(f.column for f in fields),
+        )
+        params = {
+            "id": fund_id,
+            "cash": cash,
+            "hold": hold,
+            "transfer": transfer.id if transfer else None,
+            "uuid": uuid.uuid4(),
+            "now": utc_now(),
+        }
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+
+        if row is None:
+            logger.error(
+                "fund %s update cash %s hold %s, InsufficientCash", fund_id, cash, hold
+            )
+            raise exceptions.NotEnoughBalance
+
+        logger.info("fund %s update cash %s hold %s", fund_id, cash, hold)
+        return self.model.from_db(self.db, [f.attname for f in fields], row)
+
+    def lock_funds(self, fund_ids):
+        """ Lock the Fund rows in id order, see the lock order in wallet.action """
+        return list(
+            self.select_for_update()
+            .filter(id__in=fund_ids)
+            .order_by("id")
+            .values_list("id", flat=True)
+        )
+
+    def lock_wallets(self, debited=(), credited=(), holds=True, to_shards=True):
+        """
+        Take the locks of a wallet transaction up front, in the lock order
+        of wallet.action: the HoldFund rows of the debited funds unless the
+        caller holds them, the Fund rows by id, then the FundShard rows by
+        (fund, shard). All the shards of a debited fund are locked to fold
+        them, a sharded credited fund only has a shard locked by
+        lock_credit_shard and not its Fund row, unless not `to_shards`.
+        Return {fund_id: shard} of the credited sharded funds, for credit.
+        """
+        debited = {f.id: f for f in debited}
+        credited = {f.id: f for f in credited if f.id not in debited}
+        to_shard = sorted(
+            fund_id
+            for fund_id, fund in credited.items()
+            if fund.shard_count and to_shards
+        )
+
+        if debited and holds:
+            list(
+                HoldFund.objects.select_for_update()
+                .filter(fund_id__in=debited)
+                .order_by("fund_id", "id")
+                .values_list("id", flat=True)
+            )
+        self.lock_funds([*debited, *(i for i in credited if i not in to_shard)])
+
+        sharded = [i for i, f in debited.items() if f.shard_count]
+        if sharded:
+            list(
+                FundShard.objects.select_for_update()
+                .filter(fund_id__in=sharded)
+                .order_by("fund_id", "shard")
+                .values_list("id", flat=True)
+            )
+        return {i: self.lock_credit_shard(credited[i]) for i in to_shard}
+
+    def update_balances(self, legs):
+        """
+        Apply many `(fund_id, cash, hold, transfer)` legs with one UPDATE for
+        all the funds and one bulk INSERT of their FundAction rows, in the
+        legs' order. Return {fund_id: updated fund}.
+        """
+        deltas = {}
+        for fund_id, cash, hold, transfer in legs:
+            old = deltas.get(fund_id, (d0, d0, 0))
+            deltas[fund_id] = (old[0] + cash, old[1] + hold, old[2] + 1)
+
+        fields = self.model._meta.concrete_fields
+        table = self.model._meta.db_table
+        sql = """
+            UPDATE {table} f
+            SET cash = f.cash + v.cash, hold = f.hold + v.hold, seq = f.seq + v.cnt
+            FROM (VALUES {values}) AS v (id, cash, hold, cnt)
+            WHERE f.id = v.id AND f.cash + v.cash >= 0 AND f.hold + v.hold >= 0
+            RETURNING {columns}
+        """.format(
+            table=table,
+            values=", ".join(["(%s, %s::numeric, %s::numeric, %s)"] * len(deltas)),
+            columns=", ".join(f"f.{f.column}" for f in fields),
+        )
+        params = [x for k in sorted(deltas) for x in (k, *deltas[k])]
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            # one UPDATE of many rows locks them in no particular order
+            self.lock_funds(deltas)
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+
+            if len(rows) != len(deltas):
+                logger.error("funds %s update balances, InsufficientCash", deltas)
+                raise exceptions.NotEnoughBalance
+
+            funds = {
+                fund.id: fund
+                for fund in (
+                    self.model.from_db(self.db, [f.attname for f in fields], row)
+                    for row in rows
+                )
+            }
+
+            # replay the legs from the balances before the UPDATE
+            state = {
+                fund_id: (
+                    fund.cash - deltas[fund_id][0],
+                    fund.hold - deltas[fund_id][1],
+                    fund.seq - deltas[fund_id][2],
+                )
+                for fund_id, fund in funds.items()
+            }
+            actions = []
+            for fund_id, cash, hold, transfer in legs:
+                old_cash, old_hold, seq = state[fund_id]
+                state[fund_id] = (old_cash + cash, old_hold + hold, seq + 1)
+                actions.append(
+                    FundAction(
+                        fund_id=fund_id,
+                        transfer=transfer,
+                        seq=seq + 1,
+                        amount=cash + hold,
+                        cash=old_cash + cash,
+                        hold=old_hold + hold,
+                    )
+                )
+            FundAction.objects.bulk_create(actions)
+
+        logger.info("funds %s update balances", deltas)
+        return funds
+
+    def get_user_funds(self, shop_users):
+        """ Like ShopUser.get_user_fund for many users, return {shop_user_id: fund} """
+        funds = {f.shop_user_id: f for f in self.filter(shop_user__in=shop_users)}
+        missing = {u.id: u for u in shop_users if u.id not in funds}
+        if missing:
+            created = self.bulk_create(
+                [self.model(shop_user=u) for u in missing.values()]
+            )
+            funds.update((f.shop_user_id, f) for f in created)
+        return funds
+
+    CREDIT_SHARD_SQL = """
+        WITH shard AS (
+            UPDATE {fund_shard} SET cash = cash + %(amount)s
+            WHERE fund_id = %(id)s AND shard = %(shard)s
+            RETURNING fund_id
+        )
+        INSERT INTO {fund_action}
+        (uuid, created_at, updated_at, fund_id, transfer_id, amount, cash, hold)
+        SELECT %(uuid)s, %(now)s, %(now)s, fund_id, %(transfer)s, %(amount)s, 0, 0
+        FROM shard
+        RETURNING id
+    """
+
+    def lock_credit_shard(self, fund: "Fund") -> int:
+        """
+        Lock a FundShard of the fund for the credits of this transaction,
+        the first one not locked by the others, so that concurrent credits
+        take as many shards as they need. The shard already locked by the
+        transaction is not skipped, it only waits if all are busy.
+        """
+        shards = FundShard.objects.filter(fund=fund, shard__lt=fund.shard_count)
+        shard = (
+            shards.select_for_update(skip_locked=True)
+            .order_by("shard")
+            .values_list("shard", flat=True)
+            .first()
+        )
+        if shard is None:
+            shard = random.randrange(fund.shard_count)
+            list(shards.select_for_update().filter(shard=shard).values_list("id"))
+        return shard
+
+    def credit(self, fund: "Fund", amount: Decimal, transfer=None, shard=None):
+        """
+        Add cash to the fund, to a FundShard if the fund is sharded so that
+        concurrent credits do not queue on the Fund row: the `shard` locked
+        by lock_wallets, else a random one. The FundAction of a shard credit
+        is pending (no seq) until fold_shards.
+        """
+        if not fund.shard_count:
+            self.incr_cash(fund.id, amount, transfer=transfer)
+            return
+
+        if amount <= d0:
+            raise ValueError("Invalid minus amount")
+
+        sql = self.CREDIT_SHARD_SQL.format(
+            fund_shard=FundShard._meta.db_table, fund_action=FundAction._meta.db_table,
+        )
+        params = {
+            "id": fund.id,
+            "shard": random.randrange(fund.shard_count) if shard is None else shard,
+            "amount": amount,
+            "transfer": transfer.id if transfer else None,
+            "uuid": uuid.uuid4(),
+            "now": utc_now(),
+        }
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+
+        if row is None:
+            # shards changed since the fund was read
+            self.incr_cash(fund.id, amount, transfer=transfer)
+            return
+
+        logger.info("fund %s shard %s incr cash %s", fund.id, params["shard"], amount)
+
+    def fold_shards(self, fund: "Fund"):
+        """
+        Move the cash of the fund's shards back to the Fund row and number
+        their pending FundAction, return the locked and updated fund. Called
+        before debits and by the fold_fund_shards task.
+        """
+        if not fund.shard_count:
+            return fund
+
+        with transaction.atomic():
+            fund = self.select_for_update().get(id=fund.id)
+            # locking every shard waits for the credits in flight
+            shards = list(FundShard.objects.select_for_update().filter(fund=fund))
+            amount = sum(shard.cash for shard in shards)
+            pending = list(
+                FundAction.objects.filter(fund=fund, seq__isnull=True).order_by("id")
+            )
+            if not pending:
+                return fund
+
+            # dated when folded, so created_at follows seq within the fund
+            now = utc_now()
+            for action in pending:
+                fund.seq += 1
+                fund.cash += action.amount
+                action.seq, action.cash, action.hold = fund.seq, fund.cash, fund.hold
+                action.created_at = now
+            FundAction.objects.bulk_update(
+                pending, ["seq", "cash", "hold", "created_at"]
+            )
 
+            if sum(a.amount for a in pending) != amount:
+                logger.error(
+                    "fund %s shards %s mismatch pending actions", fund.id, amount
+                )
+                raise AssertionError("Should not happen here")
+
+            FundShard.objects.filter(fund=fund).update(cash=d0)
+            self.filter(id=fund.id).update(cash=fund.cash, seq=fund.seq)
+            fund.invalidate_cached_properties()
+
+        logger.info("fund %s fold shards %s, actions %s", fund.id, amount, len(pending))
+        return fund
+
+    @transaction.atomic
+    def set_shard_count(self, fund: "Fund", count: int):
+        """ Spread the credits of fund to `count` shards, 0 to disable """
+        fund = self.fold_shards(self.select_for_update().get(id=fund.id))
+        FundShard.objects.filter(fund=fund, shard__gte=count).delete()
+        FundShard.objects.bulk_create(
+            [FundShard(fund=fund, shard=i) for i in range(count)],
+            ignore_conflicts=True,
+        )
+        self.filter(id=fund.id).update(shard_count=count)
+        fund.shard_count = count
+        return fund
+
+    def incr_cash(self, fund_id, amount: Decimal, transfer=None):
         if amount <= d0:
             raise ValueError("Invalid minus amount")
 
-        cnt = self.filter(id=fund_id).update(cash=models.F("cash") + amount)
-        logger.info("fund %s incr cash %s, cnt=%s", fund_id, amount, cnt)
-        return self.get(id=fund_id)
+        return self.update_balance(fund_id, cash=amount, transfer=transfer)
 
-    def decr_cash(self, fund_id, amount: Decimal):
+    def decr_cash(self, fund_id, amount: Decimal, transfer=None):
         if amount <= d0:
             raise ValueError("Invalid minus amount")
 
-        cnt = self.filter(id=fund_id, cash__gte=amount).update(
-            cash=models.F("cash") - amount
+        return self.update_balance(fund_id, cash=-amount, transfer=transfer)
+
+    def check_hold(self, fix=False):
+        """
+        Compare `Fund.hold` with the sum of its HoldFund rows, return the
+        mismatched funds annotated with `expected_hold`.
+        """
+        mismatched = list(
+            self.annotate(expected_hold=Coalesce(models.Sum("hold_funds__amount"), d0))
+            .exclude(hold=models.F("expected_hold"))
+            .order_by("id")
         )
-        if cnt == 0:
-            logger.error(
-                "fund %s decr cash %s, cnt=%s, InsufficientCash", fund_id, amount, cnt
-            )
-            raise exceptions.NotEnoughBalance
 
-        logger.info("fund %s decr cash %s, cnt=%s", fund_id, amount, cnt)
-        return self.get(id=fund_id)
+        if fix:
+            for fund in mismatched:
+                logger.warning(
+                    "fund %s hold %s mismatch, fix to %s",
+                    fund.id,
+                    fund.hold,
+                    fund.expected_hold,
+                )
+                with transaction.atomic():
+                    locked = self.select_for_update().get(id=fund.id)
+                    expected_hold = HoldFund.objects.total_amount(locked)
+                    if expected_hold != locked.hold:
+                        self.update_balance(fund.id, hold=expected_hold - locked.hold)
+
+        return mismatched
 
 
 class Fund(
@@ -55,6 +381,12 @@ class Fund(
     # CNY
     currency = models.CharField(max_length=8, default="CNY", help_text="币种")
     cash = DecimalField(help_text="可提现余额")
+    # Sum of HoldFund.amount, maintained by HoldFundManager
+    hold = DecimalField(help_text="冻结余额")
+    # seq of the latest FundAction of this fund
+    seq = models.BigIntegerField(default=0)
+    # number of FundShard taking the credits, 0 for not sharded
+    shard_count = models.PositiveSmallIntegerField(default=0)
 
     objects = FundManager()
 
@@ -66,98 +398,310 @@ class Fund(
         return f"fund:{self.id} {self.shop_user.phone}"
 
     @cached_property
-    def total(self):
-        return self.cash + self.hold
+    def shard_cash(self):
+        """ Cash credited to the shards and not folded yet """
+        if not self.shard_count:
+            return d0
+        return self.shards.aggregate(cash=models.Sum("cash"))["cash"] or d0
 
-    @cached_property
-    def hold(self):
-        return HoldFund.objects.total_amount(self)
+    @property
+    def total(self):
+        return self.cash + self.shard_cash + self.hold
 
     @property
     def amount_d(self):
-        return {"total": self.total, "hold": self.hold, "cash": self.cash}
+        return {
+            "total": self.total,
+            "hold": self.hold,
+            "cash": self.cash + self.shard_cash,
+        }
+
+
+class FundShard(BaseModel):
+    """ Sub account taking the credits of a hot fund, see FundManager.credit """
+
+    fund = models.ForeignKey(
+        Fund, models.CASCADE, related_name="shards", db_index=False
+    )
+    shard = models.PositiveSmallIntegerField()
+    cash = DecimalField()
+
+    class Meta:
+        verbose_name = _("Fund shard")
+        verbose_name_plural = _("Fund shards")
+        unique_together = (("fund", "shard"),)
 
 
 class HoldFundManager(models.Manager):
-    def incr_hold(self, fund: Fund, amount: Decimal, expired_at: datetime):
-        if amount <= d0:
-            raise ValueError("Invalid minus amount")
-        return self.create(fund=fund, amount=amount, expired_at=expired_at)
+    EXPIRED_UNHOLD_SQL = """
+        WITH expired AS (
+            SELECT id FROM {hold_fund}
+            WHERE expired_at <= %(now)s
+            ORDER BY id
+            LIMIT %(limit)s
+            FOR UPDATE SKIP LOCKED
+        ), deleted AS (
+            DELETE FROM {hold_fund} h USING expired
+            WHERE h.id = expired.id
+            RETURNING h.fund_id, h.amount
+        ), agg AS (
+            SELECT fund_id, SUM(amount) AS amount, COUNT(*) AS cnt
+            FROM deleted GROUP BY fund_id
+        ), locked AS (
+            SELECT f.id FROM {fund} f JOIN agg ON f.id = agg.fund_id
+            ORDER BY f.id
+            FOR UPDATE OF f
+        ), updated AS (
+            UPDATE {fund} f
+            SET cash = f.cash + agg.amount, hold = f.hold - agg.amount, seq = f.seq + 1
+            FROM agg JOIN locked ON locked.id = agg.fund_id
+            WHERE f.id = agg.fund_id
+            RETURNING f.id, f.seq, f.cash, f.hold, agg.cnt
+        ), journal AS (
+            INSERT INTO {fund_action}
+            (uuid, created_at, updated_at, fund_id, seq, amount, cash, hold)
+            SELECT md5(random()::text || id::text)::uuid, %(now)s, %(now)s,
+                id, seq, 0, cash, hold
+            FROM updated
+        )
+        SELECT id, cnt FROM updated
+    """
+
+    ADD_HOLDS_SQL = """
+        WITH bucket AS (
+            INSERT INTO {hold_fund}
+            (uuid, created_at, updated_at, fund_id, amount, expiry_day, expired_at)
+            VALUES {buckets}
+            ON CONFLICT (fund_id, expiry_day) DO UPDATE
+            SET amount = {hold_fund}.amount + EXCLUDED.amount,
+                expired_at = GREATEST({hold_fund}.expired_at, EXCLUDED.expired_at),
+                updated_at = EXCLUDED.updated_at
+            RETURNING {columns}
+        ), entry AS (
+            INSERT INTO {entry}
+            (created_at, fund_id, expiry_day, amount, transfer_id, order_id)
+            VALUES {entries}
+        )
+        SELECT {columns} FROM bucket
+    """
+
+    def add_holds(self, holds):
+        """
+        Add the `(fund_id, amount, expired_at, transfer)` holds to the bucket
+        of their fund and expiry day, which expires with the latest of its
+        holds, and record each of them as a HoldFundEntry, in one statement.
+        Return {(fund_id, expiry_day): bucket}.
+        NOTE: Fund.hold is left to the caller.
+        """
+        now = utc_now()
+        buckets, entries = {}, []
+        for fund_id, amount, expired_at, transfer in holds:
+            day = timezone.localdate(expired_at)
+            total, latest = buckets.get((fund_id, day), (d0, expired_at))
+            buckets[fund_id, day] = (total + amount, max(latest, expired_at))
+            entries.extend(
+                [
+                    now,
+                    fund_id,
+                    day,
+                    amount,
+                    transfer.id if transfer else None,
+                    transfer.order_id if transfer else None,
+                ]
+            )
 
-    def decr_hold(self, fund: Fund, amount: Decimal):
+        fields = self.model._meta.concrete_fields
+        columns = ", ".join(f.column for f in fields)
+        sql = self.ADD_HOLDS_SQL.format(
+            hold_fund=self.model._meta.db_table,
+            entry=HoldFundEntry._meta.db_table,
+            buckets=", ".join(["(%s, %s, %s, %s, %s, %s, %s)"] * len(buckets)),
+            entries=", ".join(["(%s, %s, %s, %s, %s, %s)"] * len(holds)),
+            columns=columns,
+        )
+        # upserted in key order, so that concurrent callers lock them in order
+        params = [
+            x
+            for (fund_id, day), (amount, expired_at) in sorted(buckets.items())
+            for x in (uuid.uuid4(), now, now, fund_id, amount, day, expired_at)
+        ] + entries
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+
+        result = {}
+        for row in rows:
+            bucket = self.model.from_db(self.db, [f.attname for f in fields], row)
+            result[bucket.fund_id, bucket.expiry_day] = bucket
+        return result
+
+    def incr_hold(
+        self, fund: Fund, amount: Decimal, expired_at: datetime, transfer=None
+    ):
         if amount <= d0:
             raise ValueError("Invalid minus amount")
 
         with transaction.atomic():
-            hold_funds = (
-                self.select_for_update().filter(fund=fund).order_by("-expired_at")
+            (hold_fund,) = self.add_holds(
+                [(fund.id, amount, expired_at, transfer)]
+            ).values()
+            hold_fund.fund = Fund.objects.update_balance(
+                fund.id, hold=amount, transfer=transfer
             )
+        return hold_fund
 
-            for cbf in hold_funds:
-                if cbf.amount >= amount:
-                    cbf.amount -= amount
-                    logger.info(f"holdfund {cbf.id} decr hold {amount}")
-                    amount = d0
-                else:
-                    # deduct the amount and try next
-                    logger.info(f"holdfund {cbf.id} decr hold {cbf.amount}")
-                    cbf.amount = d0
-                    amount -= cbf.amount
+    DEDUCT_SQL = """
+        WITH locked AS (
+            SELECT id, amount, expired_at FROM {hold_fund}
+            WHERE fund_id = %(fund)s
+            ORDER BY id
+            FOR UPDATE
+        ), holds AS (
+            SELECT id, amount, SUM(amount) OVER (ORDER BY expired_at, id) AS running
+            FROM locked
+        ), deleted AS (
+            DELETE FROM {hold_fund} h USING holds
+            WHERE h.id = holds.id AND holds.running <= %(amount)s
+            RETURNING h.amount
+        ), trimmed AS (
+            UPDATE {hold_fund} h SET amount = holds.running - %(amount)s
+            FROM holds
+            WHERE h.id = holds.id AND holds.running > %(amount)s
+            AND holds.running - holds.amount < %(amount)s
+            RETURNING holds.amount - h.amount AS amount
+        )
+        SELECT %(amount)s
+            - COALESCE((SELECT SUM(amount) FROM deleted), 0)
+            - COALESCE((SELECT SUM(amount) FROM trimmed), 0)
+    """
 
-                if cbf.amount == d0:
-                    cbf.delete()
-                else:
-                    cbf.save(update_fields=["amount"])
+    def deduct(self, fund: Fund, amount: Decimal):
+        """
+        Deduct the amount from the HoldFund rows of fund in expiry order,
+        return the remain. The used rows are deleted and the last one is
+        trimmed in one statement.
+        NOTE: Fund.hold is left to the caller.
+        """
+        if amount <= d0:
+            raise ValueError("Invalid minus amount")
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                self.DEDUCT_SQL.format(hold_fund=self.model._meta.db_table),
+                {"fund": fund.id, "amount": amount},
+            )
+            (remain,) = cursor.fetchone()
 
-                if amount == d0:
-                    return d0
+        logger.info("fund %s deduct hold %s, remain %s", fund.id, amount, remain)
+        return remain
 
-            return amount
+    def decr_hold(self, fund: Fund, amount: Decimal, transfer=None):
+        with transaction.atomic():
+            remain = self.deduct(fund, amount)
+            if remain < amount:
+                Fund.objects.update_balance(
+                    fund.id, hold=remain - amount, transfer=transfer
+                )
+            return remain
 
     def total_amount(self, fund: Fund):
         return (
             self.filter(fund=fund).aggregate(total=models.Sum("amount"))["total"] or d0
         )
 
-    def expired_unhold(self):
-        with transaction.atomic():
-            hold_funds = self.select_for_update().filter(expired_at__lte=utc_now())
-            for cbf in hold_funds:
-                cbf.unhold()
+    def expiry_buckets(self, until: datetime, bucket_seconds: int):
+        """
+        Group the HoldFund expiring before `until` by the end of their
+        `bucket_seconds` wide time bucket, return [(bucket_end, count)].
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT to_timestamp(
+                    ceil(extract(epoch FROM expired_at) / %(bucket)s) * %(bucket)s
+                ) AS bucket, COUNT(*)
+                FROM {self.model._meta.db_table}
+                WHERE expired_at < %(until)s
+                GROUP BY bucket ORDER BY bucket
+                """,
+                {"until": until, "bucket": bucket_seconds},
+            )
+            return cursor.fetchall()
+
+    @retry_on_db_conflict
+    def expire_chunk(self, now: datetime, chunk_size: int):
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                self.EXPIRED_UNHOLD_SQL.format(
+                    hold_fund=self.model._meta.db_table,
+                    fund=Fund._meta.db_table,
+                    fund_action=FundAction._meta.db_table,
+                ),
+                {"now": now, "limit": chunk_size},
+            )
+            return cursor.fetchall()
+
+    def expired_unhold(self, chunk_size=1000):
+        """
+        Release expired HoldFund to the fund's cash in chunks, each chunk is
+        one statement in its own transaction. Rows locked by running
+        transfers are skipped and will be picked up by the next run.
+        """
+        now = utc_now()
+        rows, fund_ids = 0, set()
+
+        while True:
+            result = self.expire_chunk(now, chunk_size)
+            cnt = sum(r[1] for r in result)
+            rows += cnt
+            fund_ids.update(r[0] for r in result)
+            logger.info("expired_unhold chunk: rows=%s funds=%s", cnt, len(result))
+
+            if cnt < chunk_size:
+                break
+
+        logger.info("expired_unhold: rows=%s funds=%s", rows, len(fund_ids))
+        return {"rows": rows, "funds": len(fund_ids)}
 
 
 class HoldFund(BaseModel, ModelWithExtraInfo):
-    """ Hold cash for cash back """
+    """
+    Hold cash for cash back, one bucket per fund and expiry day, see
+    HoldFundManager.add_holds. The holds added are in HoldFundEntry.
+    """
 
     fund = models.ForeignKey(
-        Fund, models.CASCADE, related_name="hold_funds", db_index=True
+        Fund, models.CASCADE, related_name="hold_funds", db_index=False
     )
 
     amount = DecimalField(verbose_name=_("Amount"))
-    expired_at = models.DateTimeField(verbose_name=_("Expired At"))
-    order_id = models.CharField(max_length=64, null=True, blank=True, unique=True)
+    expiry_day = models.DateField()
+    expired_at = models.DateTimeField(verbose_name=_("Expired At"), db_index=True)
     objects = HoldFundManager()
 
     class Meta:
         verbose_name = _("Hold fund")
         verbose_name_plural = _("Hold funds")
+        unique_together = (("fund", "expiry_day"),)
 
+    @transaction.atomic
     def unhold(self):
         self.delete()
-        Fund.objects.incr_cash(self.fund_id, self.amount)
+        self.fund = Fund.objects.update_balance(
+            self.fund_id, cash=self.amount, hold=-self.amount
+        )
         logger.info(f"Unhold for fund {self.fund_id} amount: {self.amount}")
 
 
-class FundTransferManager(models.Manager):
-    pass
-    # def create(self, *args, **kw):
-    #    all_fields = [f.name for f in self.model_meta.get_fields()]
-    #    return super().create(self, *args, **kw)
-
-
 class FundTransfer(BaseModel, ModelWithExtraInfo):
-    TYPE_CHOICES = [(x, x) for x in ["WITHDRAW", "DEPOSIT", "CASHBACK", "TRANSFER"]]
-    STATUS_CHOICES = [(x, x) for x in ["ADMIN_REQUIRED", "ADMIN_DENIED", "SUCCESS"]]
+    TYPE_CHOICES = [
+        (x, x) for x in ["WITHDRAW", "DEPOSIT", "CASHBACK", "TRANSFER", "REFUND"]
+    ]
+    STATUS_CHOICES = [
+        (x, x)
+        for x in ["ADMIN_REQUIRED", "ADMIN_DENIED", "SUCCESS", "PENDING", "REVERSED"]
+    ]
 
     status = models.CharField(
         max_length=16,
@@ -168,11 +712,12 @@ class FundTransfer(BaseModel, ModelWithExtraInfo):
     )
 
     # how to support deduct from holdfund?
+    # indexed with created_at, id for the ledger
     from_fund = models.ForeignKey(
-        Fund, models.CASCADE, related_name="transfer_as_from", db_index=True, null=True
+        Fund, models.CASCADE, related_name="transfer_as_from", db_index=False, null=True
     )
     to_fund = models.ForeignKey(
-        Fund, models.CASCADE, related_name="transfer_as_to", db_index=True, null=True
+        Fund, models.CASCADE, related_name="transfer_as_to", db_index=False, null=True
     )
     amount = DecimalField()
     type = models.CharField(
@@ -187,39 +732,400 @@ class FundTransfer(BaseModel, ModelWithExtraInfo):
     )
     order_id = models.CharField(max_length=64, null=True, blank=True)
 
-    objects = FundTransferManager()
-
     class Meta:
         verbose_name = _("Fund transfer")
         verbose_name_plural = _("Fund transfers")
+        # partitioned by month, see wallet.partitions, unique per partition
+        # and across them with FundTransferKey
         unique_together = (("type", "order_id"),)
+        indexes = [
+            models.Index(fields=["from_fund", "created_at", "id"]),
+            models.Index(fields=["to_fund", "created_at", "id"]),
+        ]
 
     def __str__(self):
         return f"{self.from_fund} {self.to_fund} {self.type} {self.amount}"
 
 
+class FundTransferKey(models.Model):
+    """
+    The (type, order_id) of every FundTransfer, unique across the monthly
+    partitions where the constraint of FundTransfer only holds per month.
+    Written by a trigger in the transaction of the transfer, see the
+    migration 0012. The keys are kept when the transfers are deleted or
+    archived, so that an order is never applied twice.
+    """
+
+    type = models.CharField(max_length=16)
+    order_id = models.CharField(max_length=64)
+    transfer_id = models.BigIntegerField()
+    created_at = models.DateTimeField()
+
+    class Meta:
+        verbose_name = _("Fund transfer key")
+        verbose_name_plural = _("Fund transfer keys")
+        unique_together = (("type", "order_id"),)
+
+
+class WithdrawOutboxManager(models.Manager):
+    def claim(self, limit: int, lease: int):
+        """
+        Lease up to `limit` withdrawals due to be sent for `lease` seconds,
+        those of a worker which died are sent again once the lease expires.
+        """
+        now = utc_now()
+        with transaction.atomic():
+            outboxes = list(
+                self.select_for_update(skip_locked=True, of=("self",))
+                .filter(status__in=["PENDING", "SENDING"], next_attempt_at__lte=now)
+                .select_related("transfer")
+                .order_by("next_attempt_at")[:limit]
+            )
+            for outbox in outboxes:
+                outbox.status = "SENDING"
+                outbox.attempts += 1
+                outbox.next_attempt_at = now + timedelta(seconds=lease)
+                outbox.updated_at = now
+            self.bulk_update(
+                outboxes, ["status", "attempts", "next_attempt_at", "updated_at"]
+            )
+        return outboxes
+
+
+class WithdrawOutbox(BaseModel):
+    """
+    A withdrawal to send to the provider, written with its PENDING
+    FundTransfer and sent by provider.withdrawal out of the request.
+    """
+
+    STATUS_CHOICES = [(x, x) for x in ["PENDING", "SENDING", "DONE", "FAILED"]]
+
+    # FundTransfer is partitioned, without foreign keys to it
+    transfer = models.OneToOneField(
+        FundTransfer,
+        models.DO_NOTHING,
+        db_constraint=False,
+        related_name="withdraw_outbox",
+    )
+    provider = models.CharField(max_length=16)
+    openid = models.CharField(max_length=128)
+    desc = models.CharField(max_length=128)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default="PENDING")
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=utc_now)
+    error = models.TextField(null=True, blank=True)
+    result = MYJSONField()
+
+    objects = WithdrawOutboxManager()
+
+    class Meta:
+        verbose_name = _("Withdraw outbox")
+        verbose_name_plural = _("Withdraw outbox")
+        indexes = [
+            models.Index(
+                fields=["next_attempt_at"],
+                name="wallet_withdraw_due_idx",
+                condition=Q(status__in=["PENDING", "SENDING"]),
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.transfer_id} {self.status}"
+
+
+class HoldFundEntry(models.Model):
+    """
+    A hold added to the HoldFund bucket of its fund and expiry day, kept
+    for the traceability of the orders. Append only and not read by the
+    wallet actions, so without the indexes of BaseModel.
+    """
+
+    fund = models.ForeignKey(
+        Fund, models.CASCADE, related_name="hold_entries", db_index=False
+    )
+    expiry_day = models.DateField()
+    amount = DecimalField()
+    transfer = models.ForeignKey(
+        FundTransfer, models.DO_NOTHING, null=True, db_constraint=False
+    )
+    order_id = models.CharField(max_length=64, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = _("Hold fund entry")
+        verbose_name_plural = _("Hold fund entries")
+        indexes = [models.Index(fields=["fund", "expiry_day"])]
+
+
 class FundActionManager(models.Manager):
-    # FIXME: how to use fund action to store the history of fund changing
-    def add_action(self, fund, transfer, balance=None, **kw):
-        action, _ = self.update_or_create(
-            fund=fund,
-            transfer=transfer,
-            defaults={"extra_info": kw if kw else None, "balance": balance},
+    # created_at follows seq within a fund up to the time the writers wait
+    # for the Fund row lock
+    CLOCK_SKEW = timedelta(minutes=5)
+
+    def ledger(
+        self,
+        fund: Fund,
+        limit: int,
+        cursor: int = None,
+        older=True,
+        cursor_at: datetime = None,
+    ):
+        """
+        Journal rows of the fund's transfers, newest first. Page from the seq
+        `cursor` towards older or newer ones, a range scan on (fund, seq).
+        The `created_at` of the cursor row bounds the monthly partitions read.
+        """
+        actions = self.filter(
+            fund=fund, transfer__isnull=False, seq__isnull=False
+        ).select_related("transfer")
+
+        # the newest end of the ledger, with the credits pending in the shards
+        pending = self.pending(fund)
+        if cursor is not None and older:
+            pending = [a for a in pending if a.seq < cursor]
+        elif cursor is not None:
+            pending = [a for a in pending if a.seq > cursor]
+        if older:
+            pending = pending[::-1][:limit]
+
+        if cursor is None and older:
+            # the first page is read from this month's partition if it is full
+            since = day_start(month_start(timezone.localdate()))
+            recent = actions.filter(created_at__gte=since).order_by("-seq")
+            recent = list(recent[:limit])
+            recent = (self.unfolded(pending, recent) + recent)[:limit]
+            if (
+                len(recent) == limit
+                and recent[-1].created_at >= since + self.CLOCK_SKEW
+            ):
+                return recent
+
+        if cursor is not None:
+            actions = actions.filter(**{"seq__lt" if older else "seq__gt": cursor})
+        if cursor_at is not None and older:
+            actions = actions.filter(created_at__lte=cursor_at + self.CLOCK_SKEW)
+        elif cursor_at is not None:
+            actions = actions.filter(created_at__gte=cursor_at - self.CLOCK_SKEW)
+
+        actions = list(actions.order_by("-seq" if older else "seq")[:limit])
+        if older:
+            return (self.unfolded(pending, actions) + actions)[:limit]
+        return (actions + self.unfolded(pending, actions))[:limit][::-1]
+
+    def pending(self, fund: Fund):
+        """
+        The credits of a sharded fund not folded yet, numbered and balanced
+        as FundManager.fold_shards will do, without locking. Oldest first.
+        """
+        if not fund.shard_count:
+            return []
+        # the fund is read in the same statement, the same snapshot
+        pending = list(
+            self.filter(fund=fund, transfer__isnull=False, seq__isnull=True)
+            .select_related("transfer", "fund")
+            .order_by("id")
+        )
+        if not pending:
+            return []
+        seq, cash, hold = (
+            pending[0].fund.seq,
+            pending[0].fund.cash,
+            pending[0].fund.hold,
         )
-        # TODO: send signal
-        return action
+        for action in pending:
+            seq, cash = seq + 1, cash + action.amount
+            action.seq, action.cash, action.hold = seq, cash, hold
+        return pending
+
+    def unfolded(self, pending, actions):
+        """ Drop the pending rows folded since, read again in `actions` """
+        ids = {a.id for a in actions}
+        return [a for a in pending if a.id not in ids]
 
 
 class FundAction(BaseModel, ModelWithExtraInfo):
+    """
+    Append-only journal of a fund, one row per balance change written by
+    FundManager.update_balance, numbered by `seq` per fund. Credits to a
+    FundShard are pending, seq and balances are set when folded.
+    """
 
     fund = models.ForeignKey(
-        Fund, models.CASCADE, related_name="fund_actions", db_index=True, null=True
+        Fund, models.CASCADE, related_name="fund_actions", db_index=False, null=True
     )
-    transfer = models.ForeignKey(FundTransfer, models.CASCADE, null=True)
-    balance = MYJSONField(verbose_name=_("Current Balance"))
+    # no foreign key constraints to a partitioned table
+    transfer = models.ForeignKey(
+        FundTransfer, models.CASCADE, null=True, db_constraint=False
+    )
+    seq = models.BigIntegerField(null=True)
+    # signed change of the total, cash and hold after it
+    amount = DecimalField()
+    cash = DecimalField()
+    hold = DecimalField()
 
     objects = FundActionManager()
 
     class Meta:
         verbose_name = _("Fund action")
         verbose_name_plural = _("Fund actions")
+        # partitioned by month, see wallet.partitions, unique per partition
+        unique_together = (("fund", "seq"),)
+        indexes = [models.Index(fields=["fund", "created_at"])]
+
+    @property
+    def total(self):
+        return self.cash + self.hold
+
+    @property
+    def amount_d(self):
+        return {"total": self.total, "hold": self.hold, "cash": self.cash}
+
+
+def day_start(day: date) -> datetime:
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+class FundCheckpointManager(models.Manager):
+    BUILD_SQL = """
+        INSERT INTO {checkpoint}
+        (uuid, created_at, updated_at, fund_id, date, seq, cash, hold)
+        SELECT md5(random()::text || COALESCE(a.fund_id, p.fund_id)::text)::uuid,
+            %(now)s, %(now)s, COALESCE(a.fund_id, p.fund_id), %(day)s,
+            COALESCE(a.seq, p.seq), COALESCE(a.cash, p.cash), COALESCE(a.hold, p.hold)
+        FROM (
+            SELECT fund_id, seq, cash, hold FROM {checkpoint} WHERE date = %(prev)s
+        ) p
+        FULL JOIN (
+            SELECT DISTINCT ON (fund_id) fund_id, seq, cash, hold
+            FROM {fund_action}
+            WHERE created_at >= %(start)s AND created_at < %(end)s
+            AND seq IS NOT NULL
+            ORDER BY fund_id, seq DESC
+        ) a ON a.fund_id = p.fund_id
+    """
+
+    def build(self, day: date):
+        """
+        Build the checkpoints at the end of `day` from the ones of the day
+        before and the last FundAction of each fund during the day.
+        """
+        with transaction.atomic(), connection.cursor() as cursor:
+            self.filter(date=day).delete()
+            cursor.execute(
+                self.BUILD_SQL.format(
+                    checkpoint=self.model._meta.db_table,
+                    fund_action=FundAction._meta.db_table,
+                ),
+                {
+                    "now": utc_now(),
+                    "day": day,
+                    "prev": day - timedelta(days=1),
+                    "start": day_start(day),
+                    "end": day_start(day + timedelta(days=1)),
+                },
+            )
+            cnt = cursor.rowcount
+
+        logger.info("fund checkpoint %s: %s funds", day, cnt)
+        return cnt
+
+    def build_until(self, until: date):
+        """ Build the missing days up to `until`, return the days built """
+        last = self.aggregate(last=models.Max("date"))["last"]
+        if last is None:
+            first = FundAction.objects.aggregate(first=models.Min("created_at"))
+            if first["first"] is None:
+                return []
+            day = timezone.localdate(first["first"])
+        else:
+            day = last + timedelta(days=1)
+
+        days = []
+        while day <= until:
+            self.build(day)
+            days.append(day)
+            day += timedelta(days=1)
+        return days
+
+    def balance_at(self, fund: Fund, at: datetime):
+        """
+        Balance (cash, hold) of the fund at `at`: the last checkpoint before
+        that day plus the FundAction since, at most one day of them once the
+        checkpoints are built.
+        """
+        checkpoint = (
+            self.filter(fund=fund, date__lt=timezone.localdate(at))
+            .order_by("-date")
+            .first()
+        )
+        actions = FundAction.objects.filter(
+            fund=fund, seq__isnull=False, created_at__lte=at
+        )
+        if checkpoint:
+            actions = actions.filter(
+                created_at__gte=day_start(checkpoint.date + timedelta(days=1))
+            )
+
+        action = actions.order_by("-created_at", "-seq").first()
+        if action:
+            return action.cash, action.hold
+        if checkpoint:
+            return checkpoint.cash, checkpoint.hold
+        return d0, d0
+
+
+class FundCheckpoint(BaseModel):
+    """ Balance of a fund at the end of `date`, built nightly """
+
+    fund = models.ForeignKey(
+        Fund, models.CASCADE, related_name="checkpoints", db_index=False
+    )
+    date = models.DateField(db_index=True)
+    # seq of the last FundAction included
+    seq = models.BigIntegerField(null=True)
+    cash = DecimalField()
+    hold = DecimalField()
+
+    objects = FundCheckpointManager()
+
+    class Meta:
+        verbose_name = _("Fund checkpoint")
+        verbose_name_plural = _("Fund checkpoints")
+        unique_together = (("fund", "date"),)
+
+    @property
+    def total(self):
+        return self.cash + self.hold
+
+
+class ArchiveManifest(BaseModel):
+    """ A file of journal rows moved to the cold storage, see wallet.archive """
+
+    table = models.CharField(max_length=64)
+    month = models.DateField()
+    # rows of FundAction are sorted by fund_id, seq in the file
+    fund_min = models.IntegerField(null=True)
+    fund_max = models.IntegerField(null=True)
+    rows = models.PositiveIntegerField()
+    key = models.CharField(max_length=255)
+    md5 = models.CharField(max_length=32)
+
+    class Meta:
+        verbose_name = _("Archive manifest")
+        verbose_name_plural = _("Archive manifests")
+        indexes = [models.Index(fields=["table", "fund_min", "fund_max"])]
+
+    def __str__(self):
+        return f"{self.table} {self.month:%Y-%m} {self.key}"
+
+
+class FundArchive(BaseModel):
+    """ Net of the archived FundTransfer of a fund, for the reconciliation """
+
+    fund = models.OneToOneField(Fund, models.CASCADE, related_name="archive")
+    credit = DecimalField()
+    debit = DecimalField()
+
+    class Meta:
+        verbose_name = _("Fund archive")
+        verbose_name_plural = _("Fund archives")
@@ -0,0 +1,210 @@
+"""
+Monthly range partitions on `created_at` of the wallet journal tables.
+
+PostgreSQL requires the partition key in the unique indexes of a
+partitioned table, so the primary keys are (id, created_at) and the other
+unique constraints are enforced within each partition only. The (type,
+order_id) of the transfers is kept unique across them by FundTransferKey,
+the uuid and (fund_id, seq) are unique by construction. Rows out of the
+created partitions go to the `<table>_default` partition.
+"""
+import re
+import logging
+from contextlib import nullcontext
+from datetime import date, datetime, time
+from django.db import connection, transaction
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# table: unique columns enforced per partition
+PARTITIONED_TABLES = {
+    "wallet_fundtransfer": [("uuid",), ("type", "order_id")],
+    "wallet_fundaction": [("uuid",), ("fund_id", "seq")],
+}
+
+# rows copied per statement by partition_table
+COPY_BATCH = 100000
+
+
+def month_start(day: date) -> date:
+    return date(day.year, day.month, 1)
+
+
+def add_months(month: date, months: int) -> date:
+    year, month0 = divmod(month.year * 12 + month.month - 1 + months, 12)
+    return date(year, month0 + 1, 1)
+
+
+def month_bounds(month: date):
+    return tuple(
+        timezone.make_aware(datetime.combine(day, time.min))
+        for day in (month, add_months(month, 1))
+    )
+
+
+def partition_name(table: str, month: date) -> str:
+    return f"{table}_y{month:%Y}m{month:%m}"
+
+
+def list_partitions(table: str, cursor=None):
+    """ Names of the attached partitions of `table`, in name order """
+    with connection.cursor() if cursor is None else nullcontext(cursor) as cursor:
+        cursor.execute(
+            """
+            SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = %s::regclass ORDER BY c.relname
+            """,
+            [table],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def create_unique_indexes(cursor, table: str, name: str):
+    """ Create the unique indexes of `table` on its partition `name` """
+    for columns in PARTITIONED_TABLES[table]:
+        cursor.execute(
+            f"CREATE UNIQUE INDEX IF NOT EXISTS {name}_{'_'.join(columns)}_uniq "
+            f"ON {name} ({', '.join(columns)})"
+        )
+
+
+def create_partition(table: str, month: date, cursor=None):
+    """
+    Create and attach the partition of `month`, moving its rows out of
+    the default partition. Return the name, None if it already exists.
+    """
+    name = partition_name(table, month)
+    start, end = month_bounds(month)
+
+    with transaction.atomic(), (
+        connection.cursor() if cursor is None else nullcontext(cursor)
+    ) as cursor:
+        if name in list_partitions(table, cursor):
+            return None
+
+        cursor.execute(
+            f"CREATE TABLE {name} "
+            f"(LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+        )
+        cursor.execute(
+            f"""
+            WITH moved AS (
+                DELETE FROM {table}_default
+                WHERE created_at >= %(start)s AND created_at < %(end)s
+                RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved
+            """,
+            {"start": start, "end": end},
+        )
+        create_unique_indexes(cursor, table, name)
+        cursor.execute(
+            f"ALTER TABLE {table} ATTACH PARTITION {name} "
+            f"FOR VALUES FROM (%s) TO (%s)",
+            [start, end],
+        )
+
+    logger.info("create partition %s [%s, %s)", name, start, end)
+    return name
+
+
+def detach_partition(table: str, month: date):
+    """
+    Detach the partition of `month`, its rows leave the table but are kept
+    in the detached one until it is archived or dropped. Its foreign keys
+    are dropped so that it does not pin the funds. Return the name.
+    """
+    name = partition_name(table, month)
+    with transaction.atomic(), connection.cursor() as cursor:
+        if name not in list_partitions(table, cursor):
+            raise ValueError(f"No partition {name}")
+        cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+        cursor.execute(
+            "SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass "
+            "AND contype = 'f'",
+            [name],
+        )
+        for (constraint,) in cursor.fetchall():
+            cursor.execute(f"ALTER TABLE {name} DROP CONSTRAINT {constraint}")
+
+    logger.info("detach partition %s", name)
+    return name
+
+
+def ensure_partitions(months: int = 3, today: date = None):
+    """ Create the partitions from this month up to `months` ahead """
+    this_month = month_start(today or timezone.localdate())
+    created = []
+    for table in PARTITIONED_TABLES:
+        for i in range(months + 1):
+            name = create_partition(table, add_months(this_month, i))
+            if name:
+                created.append(name)
+    return created
+
+
+def partition_table(cursor, table: str, months_ahead: int = 3):
+    """
+    Convert `table` to a partitioned one, used by the migration. Indexes
+    and foreign keys are recreated, but the foreign keys to the table are
+    dropped as they are not supported by partitioned tables.
+
+    The table stays locked by the rename until the migration commits, the
+    rows are copied in id ranges of COPY_BATCH so that no single statement
+    works through the whole table.
+    """
+    old = f"{table}_old"
+    cursor.execute(f"ALTER TABLE {table} RENAME TO {old}")
+    cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [old])
+    (sequence,) = cursor.fetchone()
+    cursor.execute(
+        """
+        SELECT indexdef FROM pg_indexes WHERE tablename = %s
+        AND indexdef NOT LIKE 'CREATE UNIQUE %%'
+        """,
+        [old],
+    )
+    indexes = [row[0] for row in cursor.fetchall()]
+    cursor.execute(
+        """
+        SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+        WHERE conrelid = %s::regclass AND contype = 'f'
+        """,
+        [old],
+    )
+    foreign_keys = cursor.fetchall()
+    cursor.execute(f"SELECT MIN(created_at), MIN(id), MAX(id) FROM {old}")
+    first, min_id, max_id = cursor.fetchone()
+
+    cursor.execute(
+        f"CREATE TABLE {table} "
+        f"(LIKE {old} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+        f"PARTITION BY RANGE (created_at)"
+    )
+    cursor.execute(f"ALTER SEQUENCE {sequence} OWNED BY {table}.id")
+    cursor.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+    create_unique_indexes(cursor, table, f"{table}_default")
+
+    this_month = month_start(timezone.localdate())
+    month = month_start(timezone.localdate(first)) if first else this_month
+    while month <= add_months(this_month, months_ahead):
+        create_partition(table, month, cursor)
+        month = add_months(month, 1)
+
+    if first:
+        for start in range(min_id, max_id + 1, COPY_BATCH):
+            cursor.execute(
+                f"INSERT INTO {table} SELECT * FROM {old} "
+                f"WHERE id >= %s AND id < %s",
+                [start, start + COPY_BATCH],
+            )
+    cursor.execute(f"DROP TABLE {old} CASCADE")
+
+    cursor.execute(
+        f"ALTER TABLE {table} ADD CONSTRAINT {table}_pkey PRIMARY KEY (id, created_at)"
+    )
+    for indexdef in indexes:
+        cursor.execute(re.sub(rf" ON (\w+\.)?{old} ", f" ON {table} ", indexdef))
+    for name, definition in foreign_keys:
+        cursor.execute(f"ALTER TABLE {table} ADD CONSTRAINT {name} {definition}")
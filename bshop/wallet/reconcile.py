@@ -0,0 +1,138 @@
+"""
+Streaming reconciliation of Fund balances against FundTransfer and HoldFund.
+The archived FundTransfer are counted through their FundArchive totals.
+
+Every source is read through a server-side cursor in fund id order and the
+streams are merge-joined by fund id, so memory does not grow with the
+number of transfers. Ranges of fund ids can be checked in parallel.
+"""
+import heapq
+import logging
+import itertools
+import multiprocessing
+from collections import namedtuple
+
+from django.db import connections
+from django.db.models import Sum
+
+from common.utils import d0
+from wallet.models import Fund, FundArchive, FundShard, FundTransfer, HoldFund
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 10000
+
+Mismatch = namedtuple(
+    "Mismatch", ["fund_id", "total", "expected_total", "hold", "expected_hold"]
+)
+
+
+def _stream(tag, queryset):
+    """ (fund_id, tag, value) rows of a queryset of (fund_id, value) """
+    for fund_id, value in queryset.iterator(chunk_size=CHUNK_SIZE):
+        yield fund_id, tag, value or d0
+
+
+def _fund_stream(queryset):
+    for fund_id, cash, hold in queryset.iterator(chunk_size=CHUNK_SIZE):
+        yield fund_id, "fund", cash
+        yield fund_id, "hold", hold
+
+
+def fund_streams(lo: int, hi: int):
+    def in_range(queryset, field):
+        return queryset.filter(**{f"{field}__gte": lo, f"{field}__lt": hi})
+
+    def net(queryset, field):
+        # aggregated by the database over the (fund, created_at, id) index
+        return (
+            in_range(queryset, field)
+            .values(field)
+            .annotate(amount=Sum("amount"))
+            .order_by(field)
+            .values_list(field, "amount")
+        )
+
+    return [
+        _fund_stream(
+            in_range(Fund.objects, "id")
+            .order_by("id")
+            .values_list("id", "cash", "hold")
+        ),
+        _stream(
+            "shard",
+            in_range(FundShard.objects, "fund_id")
+            .order_by("fund_id")
+            .values_list("fund_id", "cash"),
+        ),
+        _stream("credit", net(FundTransfer.objects, "to_fund_id")),
+        _stream("debit", net(FundTransfer.objects, "from_fund_id")),
+        _stream(
+            "credit",
+            in_range(FundArchive.objects, "fund_id")
+            .order_by("fund_id")
+            .values_list("fund_id", "credit"),
+        ),
+        _stream(
+            "debit",
+            in_range(FundArchive.objects, "fund_id")
+            .order_by("fund_id")
+            .values_list("fund_id", "debit"),
+        ),
+        _stream("holdfund", net(HoldFund.objects, "fund_id")),
+    ]
+
+
+def reconcile(lo: int, hi: int):
+    """
+    Yield a Mismatch for each fund with id in [lo, hi) whose cash + hold is
+    not the net of its transfers, or whose hold is not the sum of its
+    HoldFund.
+    """
+    merged = heapq.merge(*fund_streams(lo, hi), key=lambda row: row[0])
+    for fund_id, rows in itertools.groupby(merged, key=lambda row: row[0]):
+        values = dict.fromkeys(
+            ["fund", "hold", "shard", "credit", "debit", "holdfund"], d0
+        )
+        found = False
+        for _, tag, value in rows:
+            values[tag] += value
+            found = found or tag == "fund"
+
+        if not found:
+            continue
+
+        total = values["fund"] + values["shard"] + values["hold"]
+        expected_total = values["credit"] - values["debit"]
+        if total != expected_total or values["hold"] != values["holdfund"]:
+            yield Mismatch(
+                fund_id, total, expected_total, values["hold"], values["holdfund"]
+            )
+
+
+def reconcile_range(lo: int, hi: int):
+    """ Worker entry, return the mismatches and the number of funds checked """
+    mismatches = list(reconcile(lo, hi))
+    checked = Fund.objects.filter(id__gte=lo, id__lt=hi).count()
+    logger.info(
+        "reconcile [%s, %s): %s funds %s mismatches", lo, hi, checked, len(mismatches)
+    )
+    return mismatches, checked
+
+
+def split_ranges(lo: int, hi: int, parts: int):
+    step = max((hi - lo + parts - 1) // parts, 1)
+    return [(start, min(start + step, hi)) for start in range(lo, hi, step)]
+
+
+def reconcile_parallel(lo: int, hi: int, workers: int):
+    """ Check [lo, hi) over `workers` processes, yield (mismatches, checked) """
+    ranges = split_ranges(lo, hi, workers * 4)
+    if workers <= 1:
+        yield from itertools.starmap(reconcile_range, ranges)
+        return
+
+    # each process opens its own connection
+    connections.close_all()
+    with multiprocessing.get_context("fork").Pool(workers) as pool:
+        yield from pool.starmap(reconcile_range, ranges)
@@ -1,29 +1,37 @@
+import base64
 import logging
+from datetime import datetime, timezone
 
 import graphene
-from graphene_django import DjangoObjectType, DjangoConnectionField
+from graphene_django import DjangoObjectType
+from graphene_django.settings import graphene_settings
 from graphql_jwt.decorators import login_required
-from django.db.models import Q
-from django.db import transaction
 from django.conf import settings
 
 from common import exceptions
 from common.schema import LoginProvider, Result, OrderState
-from common.utils import urlencode, AvoidResubmit, d0
+from common.utils import urlencode, IdempotentResult, d0
 from gql import type as gtype
 
 from user_center.models import ShopUser
-from wallet.models import FundTransfer, Fund
-from wallet.action import do_transfer, do_withdraw
-from provider import get_provider_cls
+from wallet.models import FundTransfer, FundAction, FundCheckpoint, Fund
+from wallet import archive
+from wallet.action import do_transfer, do_batch_transfer
+from provider import get_provider
+from provider.withdrawal import request_withdraw
 
 logger = logging.getLogger(__name__)
 
+LEDGER_PAGE_SIZE = 20
+BATCH_TRANSFER_MAX_SIZE = 500
+
 
 class Ledger(DjangoObjectType):
+    """ FundTransfer with the FundAction of the fund as `action` """
+
     id = graphene.ID(required=True)
     amount = gtype.Decimal()
-    # balance = graphene.Field(Balance)
+    balance = gtype.Decimal()
 
     class Meta:
         model = FundTransfer
@@ -34,17 +42,32 @@ class Ledger(DjangoObjectType):
         return self.uuid
 
     def resolve_amount(self, info):
-        fund = info.context.fund
-        if fund == self.from_fund:
-            return self.amount * -1
+        return self.action.amount
+
+    def resolve_balance(self, info):
+        return self.action.total
+
+
+class LedgerConnection(graphene.relay.Connection):
+    class Meta:
+        node = Ledger
 
-        return self.amount
 
-        logger.exception("not in or out")
-        return True
+def ledger_cursor(action: FundAction) -> str:
+    value = f"seq|{action.seq}|{action.created_at.timestamp()}"
+    return base64.urlsafe_b64encode(value.encode()).decode()
 
-    # def resolve_balance(self, info):
-    #    return Balance(**self.balance)
+
+def parse_ledger_cursor(cursor: str):
+    """ Return (seq, created_at), created_at is None for the old cursors """
+    try:
+        prefix, seq, *at = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        if prefix != "seq" or len(at) > 1:
+            raise ValueError(cursor)
+        at = datetime.fromtimestamp(float(at[0]), timezone.utc) if at else None
+        return int(seq), at
+    except (ValueError, TypeError):
+        raise exceptions.GQLError("invalid_cursor")
 
 
 class WithdrawInput(graphene.InputObjectType):
@@ -53,52 +76,76 @@ class WithdrawInput(graphene.InputObjectType):
     provider = graphene.Field(LoginProvider, required=True)
 
 
+class Withdrawal(graphene.ObjectType):
+    id = graphene.UUID()
+    amount = gtype.Decimal()
+    # PENDING, SUCCESS, REVERSED or ADMIN_REQUIRED
+    status = graphene.String()
+
+
+class WithdrawResult(Result):
+    withdrawal = graphene.Field(Withdrawal)
+
+
+def withdraw_result(data):
+    return WithdrawResult(
+        success=data["success"], withdrawal=Withdrawal(**data["withdrawal"])
+    )
+
+
 class Withdraw(graphene.Mutation):
+    """ queue a withdrawal, poll its status with the `withdrawal` query """
+
     class Arguments:
         params = WithdrawInput(required=True, name="input")
 
-    Output = Result
+    Output = WithdrawResult
 
     @login_required
     def mutate(self, info, params):
 
         shop_user = info.context.user.shop_user
 
-        avoid_resubmit = AvoidResubmit("withdraw")
+        idempotent = IdempotentResult("withdraw")
         try:
-            avoid_resubmit(params.request_id, shop_user.id)
-        except avoid_resubmit.ResubmittedError as e:
+            replay = idempotent(params.request_id, shop_user.id)
+        except idempotent.ResubmittedError as e:
             raise exceptions.GQLError(e.message)
+        if replay is not None:
+            return withdraw_result(replay)
 
-        try:
-            cls = get_provider_cls(params.provider)
-            obj = cls()
-            openid = obj.get_openid(shop_user=shop_user)
-        except exceptions.DoNotSupportBindType:
-            raise exceptions.GQLError(f"Does not support {params.provider}")
-
-        note = settings.LOGO_NAME + "-提现"
-
-        with transaction.atomic():
+        with idempotent.release_on_error(params.request_id, shop_user.id):
             try:
-                transfer = do_withdraw(shop_user, params.amount, note="提现到零钱")
-            except exceptions.NotEnoughBalance as e:
-                raise exceptions.GQLError(e.message)
-
+                obj = get_provider(params.provider)
+                openid = obj.get_openid(shop_user=shop_user)
+            except exceptions.DoNotSupportBindType:
+                raise exceptions.GQLError(f"Does not support {params.provider}")
+            if not openid:
+                raise exceptions.GQLError(f"Does not bind {params.provider}")
+
+            # sent to the provider by provider.withdrawal out of the request
             try:
-                res = obj.withdraw(openid, params.amount, note)
-            except exceptions.WithdrawError as e:
-                # FIXME: revert do_withdraw?
-                # 提现进行中，可能会有一定延时，需要人工处理
-                # 提现排队中....
-                logger.exception(str(e))
+                transfer = request_withdraw(
+                    shop_user,
+                    params.amount,
+                    provider=params.provider,
+                    openid=openid,
+                    desc=settings.LOGO_NAME + "-提现",
+                    note="提现到零钱",
+                )
+            except exceptions.NotEnoughBalance as e:
                 raise exceptions.GQLError(e.message)
 
-            transfer.extra_info = dict(res)
-            transfer.order_id = res["payment_no"]
-            transfer.save()
-
-            return Result(success=True)
+            data = {
+                "success": True,
+                "withdrawal": {
+                    "id": str(transfer.uuid),
+                    "amount": str(transfer.amount),
+                    "status": transfer.status,
+                },
+            }
+            idempotent.done(params.request_id, shop_user.id, data)
+        return withdraw_result(data)
 
 
 class CreatePayOrderInput(graphene.InputObjectType):
@@ -124,21 +171,26 @@ class CreatePayOrder(graphene.Mutation):
 
         shop_user = info.context.user.shop_user
 
-        avoid_resubmit = AvoidResubmit("createPayOrder")
+        idempotent = IdempotentResult("createPayOrder")
         try:
-            avoid_resubmit(params.request_id, shop_user.id)
-        except avoid_resubmit.ResubmittedError as e:
+            replay = idempotent(params.request_id, shop_user.id)
+        except idempotent.ResubmittedError as e:
             raise exceptions.GQLError(e.message)
+        if replay is not None:
+            return CreatePayOrder(**replay)
 
-        to_user = None
-        if params.to:
-            to_user = ShopUser.objects.get(uuid=params.to)
-        try:
-            cls = get_provider_cls(params.provider)
-            res = cls().create_pay_order(params.code, params.amount, to_user=to_user)
-        except exceptions.DoNotSupportBindType:
-            raise exceptions.GQLError(f"Does not support {params.provider}")
+        with idempotent.release_on_error(params.request_id, shop_user.id):
+            to_user = None
+            if params.to:
+                to_user = ShopUser.objects.get(uuid=params.to)
+            try:
+                res = get_provider(params.provider).create_pay_order(
+                    params.code, params.amount, to_user=to_user
+                )
+            except exceptions.DoNotSupportBindType:
+                raise exceptions.GQLError(f"Does not support {params.provider}")
 
+            idempotent.done(params.request_id, shop_user.id, {"payment": res})
         return CreatePayOrder(payment=res)
 
 
@@ -158,48 +210,121 @@ class Transfer(graphene.Mutation):
 
     @login_required
     def mutate(self, info, params):
-        # 1. avoid resubmit
+        # 1. avoid resubmit, replay the result to the retries
         shop_user = info.context.user.shop_user
 
-        avoid_resubmit = AvoidResubmit("transferPay")
+        idempotent = IdempotentResult("transferPay")
         try:
-            avoid_resubmit(params.request_id, shop_user.id)
-        except avoid_resubmit.ResubmittedError as e:
+            replay = idempotent(params.request_id, shop_user.id)
+        except idempotent.ResubmittedError as e:
             raise exceptions.GQLError(e.message)
+        if replay is not None:
+            return Result(**replay)
 
-        # 2. check payment password
-        try:
-            if not shop_user.has_payment_password:
-                raise exceptions.NeedSetPaymentPassword
+        with idempotent.release_on_error(params.request_id, shop_user.id):
+            # 2. check payment password
+            try:
+                if not shop_user.has_payment_password:
+                    raise exceptions.NeedSetPaymentPassword
 
-            if not shop_user.check_payemnt_password(params.payment_password):
-                raise exceptions.WrongPassword
-        except exceptions.ErrorResultException as e:
-            raise exceptions.GQLError(e.message)
+                if not shop_user.check_payemnt_password(params.payment_password):
+                    raise exceptions.WrongPassword
+            except exceptions.ErrorResultException as e:
+                raise exceptions.GQLError(e.message)
+
+            # TODO:
+            # 3. do transfer
+            try:
+                to_user = ShopUser.objects.get(uuid=params.to)
+            except ShopUser.DoesNotExist:
+                raise exceptions.GQLError("no_exist_user")
+
+            try:
+                do_transfer(
+                    from_user=shop_user,
+                    to_user=to_user,
+                    amount=params.amount,
+                    note=params.note,
+                )
+            except exceptions.NotEnoughBalance as e:
+                raise exceptions.GQLError(e.message)
+
+            idempotent.done(params.request_id, shop_user.id, {"success": True})
+        return Result(success=True)
+
+
+class BatchTransferItem(graphene.InputObjectType):
+    to = graphene.UUID(required=True)
+    amount = gtype.Decimal(required=True)
 
-        # TODO:
-        # 3. do transfer
-        try:
-            to_user = ShopUser.objects.get(uuid=params.to)
-        except ShopUser.DoesNotExist:
-            raise exceptions.GQLError("no_exist_user")
 
+class BatchTransferInput(graphene.InputObjectType):
+    items = graphene.List(graphene.NonNull(BatchTransferItem), required=True)
+    note = graphene.String()
+    payment_password = graphene.String(required=True)
+    request_id = graphene.UUID(required=True)
+
+
+class BatchTransfer(graphene.Mutation):
+    """ transfer to many users with one payment password check """
+
+    class Arguments:
+        params = BatchTransferInput(required=True, name="input")
+
+    Output = Result
+
+    @login_required
+    def mutate(self, info, params):
+        shop_user = info.context.user.shop_user
+
+        if not 0 < len(params.items) <= BATCH_TRANSFER_MAX_SIZE:
+            raise exceptions.GQLError("invalid_batch_size")
+
+        if any(item.amount <= d0 for item in params.items):
+            raise exceptions.GQLError("invalid_amount")
+
+        # replay the result to the retries
+        idempotent = IdempotentResult("batchTransfer")
         try:
-            do_transfer(
-                from_user=shop_user,
-                to_user=to_user,
-                amount=params.amount,
-                note=params.note,
-            )
-        except exceptions.NotEnoughBalance as e:
+            replay = idempotent(params.request_id, shop_user.id)
+        except idempotent.ResubmittedError as e:
             raise exceptions.GQLError(e.message)
+        if replay is not None:
+            return Result(**replay)
+
+        with idempotent.release_on_error(params.request_id, shop_user.id):
+            try:
+                if not shop_user.has_payment_password:
+                    raise exceptions.NeedSetPaymentPassword
+
+                if not shop_user.check_payemnt_password(params.payment_password):
+                    raise exceptions.WrongPassword
+            except exceptions.ErrorResultException as e:
+                raise exceptions.GQLError(e.message)
+
+            to_users = ShopUser.objects.in_bulk(
+                [item.to for item in params.items], field_name="uuid"
+            )
+            if len(to_users) != len({item.to for item in params.items}):
+                raise exceptions.GQLError("no_exist_user")
+
+            try:
+                do_batch_transfer(
+                    from_user=shop_user,
+                    items=[(to_users[item.to], item.amount) for item in params.items],
+                    note=params.note,
+                )
+            except exceptions.NotEnoughBalance as e:
+                raise exceptions.GQLError(e.message)
 
+            idempotent.done(params.request_id, shop_user.id, {"success": True})
         return Result(success=True)
 
 
 class Mutation(graphene.ObjectType):
     create_pay_order = CreatePayOrder.Field()
     transfer = Transfer.Field()
+    batch_transfer = BatchTransfer.Field()
     withdraw = Withdraw.Field()
 
 
@@ -230,13 +355,24 @@ class FundQL(DjangoObjectType):
     def resolve_total(self, info):
         return self.total
 
+    def resolve_cash(self, info):
+        return self.cash + self.shard_cash
+
     def resolve_hold(self, info):
         return self.hold
 
 
+class Balance(graphene.ObjectType):
+    total = gtype.Decimal()
+    cash = gtype.Decimal()
+    hold = gtype.Decimal()
+
+
 class Query(graphene.ObjectType):
     fund = graphene.Field(FundQL)
-    ledger_list = DjangoConnectionField(Ledger)
+    balance_at = graphene.Field(Balance, at=graphene.DateTime(required=True))
+    ledger_list = graphene.relay.ConnectionField(LedgerConnection)
+    withdrawal = graphene.Field(Withdrawal, id=graphene.UUID(required=True))
     vendor_receive_pay_qr = graphene.Field(VendorInfo)
     order_info = graphene.Field(
         OrderInfo, provider=graphene.Argument(LoginProvider), order_id=graphene.String()
@@ -251,16 +387,64 @@ class Query(graphene.ObjectType):
         except Fund.DoesNotExist:
             return FundQL(currency="CNY")
 
+    @login_required
+    def resolve_balance_at(self, info, at):
+        shop_user = info.context.user.shop_user
+        fund = shop_user.get_user_fund()
+        cash, hold = FundCheckpoint.objects.balance_at(fund, at)
+        return Balance(total=cash + hold, cash=cash, hold=hold)
+
+    @login_required
+    def resolve_withdrawal(self, info, id):
+        shop_user = info.context.user.shop_user
+        row = (
+            FundTransfer.objects.filter(
+                uuid=id, type="WITHDRAW", from_fund__shop_user=shop_user
+            )
+            .values("amount", "status")
+            .first()
+        )
+        return Withdrawal(id=id, **row) if row else None
+
     @login_required
     def resolve_ledger_list(self, info, **kw):
         shop_user = info.context.user.shop_user
         fund = shop_user.get_user_fund()
-        info.context.fund = fund
-        # setattr(info, "fund", fund)
 
-        return FundTransfer.objects.filter(
-            Q(from_fund=fund) | Q(to_fund=fund)
-        ).order_by("-id")
+        first, last = kw.get("first"), kw.get("last")
+        after, before = kw.get("after"), kw.get("before")
+        older = not (last or before)
+        cursor = after if older else before
+        limit = min(
+            (first if older else last) or LEDGER_PAGE_SIZE,
+            graphene_settings.RELAY_CONNECTION_MAX_LIMIT,
+        )
+
+        seq, cursor_at = parse_ledger_cursor(cursor) if cursor else (None, None)
+        # continued into the archive past the oldest rows in the database
+        actions = archive.ledger(
+            fund, limit + 1, cursor=seq, older=older, cursor_at=cursor_at
+        )
+        has_more = len(actions) > limit
+        actions = actions[:limit] if older else actions[-limit:]
+
+        edges = []
+        for action in actions:
+            # None if the transfer is gone, the action is not listed
+            transfer = getattr(action, "transfer", None)
+            if transfer is None:
+                continue
+            transfer.action = action
+            edges.append(
+                LedgerConnection.Edge(node=transfer, cursor=ledger_cursor(action))
+            )
+        page_info = graphene.relay.PageInfo(
+            start_cursor=edges[0].cursor if edges else None,
+            end_cursor=edges[-1].cursor if edges else None,
+            has_next_page=has_more if older else bool(cursor),
+            has_previous_page=bool(cursor) if older else has_more,
+        )
+        return LedgerConnection(edges=edges, page_info=page_info)
 
     # def resolve_test_order_info(self, info, order_id, **kw):
     #    from wechat_django.pay.models import UnifiedOrder
@@ -282,8 +466,7 @@ class Query(graphene.ObjectType):
     def resolve_order_info(self, info, provider, order_id, **kw):
         shop_user = info.context.user.shop_user
 
-        cls = get_provider_cls(provider)
-        obj = cls()
+        obj = get_provider(provider)
 
         openid = obj.get_openid(shop_user=shop_user)
         res = obj.order_info(order_id, openid)
@@ -1,44 +1,98 @@
 import logging
+from datetime import timedelta
 from bshop.celery import app
-from wechat_django.pay.models import UnifiedOrder, UnifiedOrderResult
+from wechat_django.pay.models import UnifiedOrder
 
+from django.conf import settings
+from django.utils import timezone
+
+from common import redis_client
 from common.utils import utc_now
-from wallet.models import HoldFund
+from wallet.models import Fund, FundCheckpoint, HoldFund
+from wallet.archive import archive_until
+from wallet.partitions import add_months, ensure_partitions, month_start
 
 logger = logging.getLogger(__name__)
 
-
-class NoSuccess(Exception):
-    pass
+# HoldFund expiring in the same bucket are released by one task
+HOLDFUND_EXPIRY_BUCKET = 300
+# Keep it below the broker visibility timeout (1h) to avoid redelivery of ETA tasks
+HOLDFUND_EXPIRY_HORIZON = 1800
 
 
-# https://celery.readthedocs.io/en/latest/userguide/tasks.html?highlight=retry_backof#Task.retry_backoff
-@app.task(autoretry_for=(NoSuccess,), max_retries=3, default_retry_delay=1)
-def sync_wechat_order(order_id):
+@app.task
+def test_order(order_id):
     order = UnifiedOrder.objects.get(id=order_id)
+    order.result.update({"attach": "attach"}, signal=True, verify=False)
+
+
+@app.task
+def check_expired_holdfund():
+    return HoldFund.objects.expired_unhold()
 
-    if (
-        order.trade_state() == UnifiedOrderResult.State.SUCCESS
-        or order.time_expire < utc_now()
+
+@app.task
+def expire_holdfund_bucket(bucket):
+    res = HoldFund.objects.expired_unhold()
+    logger.info(f"holdfund bucket {bucket} expired: {res}")
+    return res
+
+
+@app.task
+def schedule_holdfund_expiry():
+    """
+    Seed one expire_holdfund_bucket task per bucket expiring within the
+    horizon from the HoldFund table, so it also recovers the ETA tasks lost
+    by worker restarts. Overdue buckets are merged into one immediate task.
+    """
+    now = utc_now()
+    con = redis_client.get_redis("lock")
+
+    buckets = {}
+    for bucket, cnt in HoldFund.objects.expiry_buckets(
+        now + timedelta(seconds=HOLDFUND_EXPIRY_HORIZON), HOLDFUND_EXPIRY_BUCKET
     ):
-        logger.info(f"wechat_order skip sync {order}")
-        return
+        key = "overdue" if bucket <= now else int(bucket.timestamp())
+        eta, total = buckets.get(key, (max(bucket, now), 0))
+        buckets[key] = (eta, total + cnt)
+
+    scheduled = 0
+    for key, (eta, cnt) in buckets.items():
+        ttl = int((eta - now).total_seconds()) + HOLDFUND_EXPIRY_BUCKET
+        if not con.set(f"holdfund:expiry:{key}", cnt, nx=True, ex=ttl):
+            continue
 
-    res = order.sync()
-    logger.debug(res)
-    if order.trade_state() != UnifiedOrderResult.State.SUCCESS:
-        raise NoSuccess
-    else:
-        logger.info(f"wechat_order sync {order} successfully!")
+        expire_holdfund_bucket.apply_async(args=[eta.isoformat()], eta=eta)
+        scheduled += 1
+        logger.info(f"schedule holdfund expiry bucket {eta}: {cnt}")
+
+    return scheduled
 
 
 @app.task
-def test_order(order_id):
-    order = UnifiedOrder.objects.get(id=order_id)
-    order.result.update({"attach": "attach"}, signal=True, verify=False)
+def fold_fund_shards():
+    funds = Fund.objects.filter(shard_count__gt=0)
+    for fund in funds:
+        Fund.objects.fold_shards(fund)
+    return len(funds)
 
 
 @app.task
-def check_expired_holdfund():
-    # TODO: check aciton with celery  ETA?
-    HoldFund.objects.expired_unhold()
+def build_fund_checkpoints():
+    """ Build the checkpoints up to yesterday, shards are folded first """
+    fold_fund_shards()
+    days = FundCheckpoint.objects.build_until(timezone.localdate() - timedelta(days=1))
+    return [day.isoformat() for day in days]
+
+
+@app.task
+def create_partitions():
+    return ensure_partitions()
+
+
+@app.task
+def archive_ledger():
+    cutoff = add_months(
+        month_start(timezone.localdate()), -settings.WALLET_ARCHIVE_MONTHS
+    )
+    return [manifest.key for manifest in archive_until(cutoff)]
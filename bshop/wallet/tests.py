@@ -1,10 +1,21 @@
+import os
+import gzip
 import json
 import uuid
+import tempfile
+from io import StringIO
+from datetime import timedelta
 from unittest.mock import patch
-from django.test import RequestFactory
+from django.contrib import admin
+from django.test import Client, RequestFactory
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, models, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
 # from unittest import skip
 
+from graphql_jwt.shortcuts import get_token
 from graphql_jwt.testcases import JSONWebTokenTestCase
 from django_fakeredis import FakeRedis
 
@@ -12,6 +23,7 @@ from wechat_django.pay.models import WeChatPay  # , UnifiedOrder
 from wechat_django.models import WeChatApp
 
 from common import exceptions
+from common.models import quota_cache
 from common.utils import (
     ordered_dict_2_dict,
     urlencode,
@@ -20,13 +32,51 @@ from common.utils import (
     utc_now,
     d0,
 )
+from provider.tasks import send_withdrawals
 from provider.wechat import WeChatProvider
 from user_center.models import ShopUser
 from user_center.factory import ShopUserFactory
 from wallet.factory import FundFactory, HoldFundFactory
 
-from wallet.models import Fund, HoldFund, FundAction
-from wallet.action import do_deposit, do_transfer, do_withdraw
+from wallet import archive
+from wallet.models import (
+    ArchiveManifest,
+    Fund,
+    FundShard,
+    HoldFund,
+    HoldFundEntry,
+    FundAction,
+    FundCheckpoint,
+    FundTransfer,
+    FundTransferKey,
+    WithdrawOutbox,
+    day_start,
+)
+from wallet.utils import CashBackSettings
+from wallet.action import (
+    do_deposit,
+    do_transfer,
+    do_batch_transfer,
+    do_withdraw,
+    do_cash_back,
+)
+from wallet.admin import FundTransferAdmin
+from wallet.views import LEDGER_EXPORT_FIELDS
+from wallet.partitions import (
+    add_months,
+    create_partition,
+    ensure_partitions,
+    list_partitions,
+    month_bounds,
+    month_start,
+    partition_name,
+)
+from wallet.reconcile import reconcile, split_ranges, Mismatch
+from wallet.tasks import (
+    archive_ledger,
+    schedule_holdfund_expiry,
+    expire_holdfund_bucket,
+)
 
 
 class WalletTests(JSONWebTokenTestCase):
@@ -52,11 +102,13 @@ class WalletTests(JSONWebTokenTestCase):
         self.user = self.shop_user.user
         self.fund = FundFactory(shop_user=self.shop_user)
         self.hold_fund = HoldFundFactory(fund=self.fund)
+        self.fund.refresh_from_db()
 
         self.shop_user2 = ShopUserFactory(is_vendor=True)
         self.user2 = self.shop_user2.user
         self.fund2 = FundFactory(shop_user=self.shop_user2)
         self.hold_fund2 = HoldFundFactory(fund=self.fund2)
+        self.fund2.refresh_from_db()
 
         self.miniprogram = WeChatApp.objects.get_by_name("miniprogram")
         self.request = RequestFactory()
@@ -75,6 +127,7 @@ class WalletTests(JSONWebTokenTestCase):
         HoldFund.objects.all().delete()
         FundAction.objects.all().delete()
 
+    @FakeRedis("common.redis_client.get_redis_connection")
     def test_pre_create_order(self):
         self.client.authenticate(self.user)
 
@@ -108,9 +161,14 @@ class WalletTests(JSONWebTokenTestCase):
                 mock_create_order.return_value = mocked_result
                 data = self.client.execute(gql, variables)
 
+                # the retry gets the same order back
+                replay = self.client.execute(gql, variables)
+                self.assertEqual(mock_create_order.call_count, 1)
+
         self.assertIsNone(data.errors)
         expected = json.dumps(mocked_result)
         self.assertEqual(data.data["createPayOrder"]["payment"], expected)
+        self.assertEqual(replay.data, data.data)
         # TODO: mock order
         # order = UnifiedOrder.objects.get(openid=mocked_openid)
         # self.assertEquals(order.total_fee, 1231)
@@ -203,9 +261,439 @@ class WalletTests(JSONWebTokenTestCase):
         self.assertIsNotNone(page_info["hasNextPage"])
         self.assertIsNotNone(page_info["hasPreviousPage"])
 
+    def test_ledger_pagination(self):
+        self.client.authenticate(self.user)
+        transfers = [
+            do_deposit(self.shop_user, to_decimal("1"), order_id=str(i))
+            for i in range(3)
+        ]
+        transfers.append(do_transfer(self.shop_user, self.shop_user2, to_decimal("1")))
+        transfers.append(do_transfer(self.shop_user2, self.shop_user, to_decimal("2")))
+        # not related to this user
+        do_deposit(self.shop_user2, to_decimal("1"), order_id="other")
+        expected = [str(t.uuid) for t in reversed(transfers)]
+
+        gql = """
+        query _($first: Int, $after: String, $last: Int, $before: String) {
+          ledgerList(first: $first, after: $after, last: $last, before: $before){
+            edges{ node{ id amount balance } }
+            pageInfo{ startCursor endCursor hasNextPage hasPreviousPage }
+          }
+        }"""
+
+        ids, after = [], None
+        while True:
+            data = self.client.execute(gql, {"first": 2, "after": after})
+            self.assertIsNone(data.errors)
+            ledger = data.data["ledgerList"]
+            ids.extend(e["node"]["id"] for e in ledger["edges"])
+            if not ledger["pageInfo"]["hasNextPage"]:
+                break
+            after = ledger["pageInfo"]["endCursor"]
+        self.assertEqual(ids, expected)
+
+        data = self.client.execute(gql, {"first": 5})
+        amounts = [e["node"]["amount"] for e in data.data["ledgerList"]["edges"]]
+        self.assertEqual(amounts, ["2", "-1", "1", "1", "1"])
+        self.fund.refresh_from_db()
+        balances = [e["node"]["balance"] for e in data.data["ledgerList"]["edges"]]
+        self.assertEqual(balances[0], decimal2str(self.fund.total))
+
+        # page backward from the oldest one
+        before = data.data["ledgerList"]["pageInfo"]["endCursor"]
+        data = self.client.execute(gql, {"last": 2, "before": before})
+        self.assertIsNone(data.errors)
+        ledger = data.data["ledgerList"]
+        self.assertEqual([e["node"]["id"] for e in ledger["edges"]], expected[2:4])
+        self.assertTrue(ledger["pageInfo"]["hasPreviousPage"])
+
+        data = self.client.execute(gql, {"first": 2, "after": "bad"})
+        self.assertEqual("invalid_cursor", data.errors[0].message)
+
+        # the action of a deleted transfer is left out
+        FundAction.objects.filter(transfer=transfers[0]).update(transfer_id=0)
+        data = self.client.execute(gql, {"first": 5})
+        self.assertIsNone(data.errors)
+        ids = [e["node"]["id"] for e in data.data["ledgerList"]["edges"]]
+        self.assertEqual(ids, expected[:4])
+
+    def test_fund_journal(self):
+        HoldFundFactory(fund=self.fund, expired_at=utc_now() - timedelta(days=1))
+        do_deposit(self.shop_user, to_decimal("1"), order_id="j1")
+        transfer = do_transfer(self.shop_user, self.shop_user2, to_decimal("2"))
+        HoldFund.objects.expired_unhold()
+
+        self.fund.refresh_from_db()
+        actions = list(FundAction.objects.filter(fund=self.fund).order_by("seq"))
+        self.assertEqual([a.seq for a in actions], list(range(1, self.fund.seq + 1)))
+        self.assertEqual(actions[-1].amount_d, self.fund.amount_d)
+        for prev, action in zip(actions, actions[1:]):
+            self.assertEqual(action.total, prev.total + action.amount)
+
+        # expiry moves hold to cash without changing the total
+        self.assertIsNone(actions[-1].transfer)
+        self.assertEqual(actions[-1].amount, d0)
+        self.assertEqual(actions[-2].transfer, transfer)
+        self.assertEqual(actions[-2].amount, to_decimal("-2"))
+
+        action = FundAction.objects.get(fund=self.fund2, transfer=transfer)
+        self.assertEqual(action.amount, to_decimal("2"))
+
+    def test_fund_shards(self):
+        call_command("set_fund_shards", self.fund2.id, 4, stdout=StringIO())
+        self.assertEqual(FundShard.objects.filter(fund=self.fund2).count(), 4)
+        old_amount2 = self.fund2.amount_d
+
+        for _ in range(5):
+            do_transfer(self.shop_user, self.shop_user2, to_decimal("1"))
+
+        # credits go to the shards and leave the Fund row alone
+        fund2 = Fund.objects.get(id=self.fund2.id)
+        self.assertEqual(fund2.cash, old_amount2["cash"])
+        self.assertEqual(fund2.seq, self.fund2.seq)
+        self.assertEqual(fund2.total, old_amount2["total"] + to_decimal("5"))
+        self.assertEqual(
+            FundAction.objects.filter(fund=fund2, seq__isnull=True).count(), 5
+        )
+
+        # the ledger reads them unfolded, numbered as they will be
+        with self.assertNumQueries(2):
+            ledger = FundAction.objects.ledger(fund2, 3)
+        seqs = [fund2.seq + i for i in (5, 4, 3)]
+        self.assertEqual([a.seq for a in ledger], seqs)
+        self.assertEqual(ledger[0].cash, fund2.cash + to_decimal("5"))
+        older = FundAction.objects.ledger(fund2, 3, cursor=ledger[-1].seq)
+        self.assertEqual([a.seq for a in older][:2], [fund2.seq + 2, fund2.seq + 1])
+        self.assertEqual(
+            FundAction.objects.filter(fund=fund2, seq__isnull=True).count(), 5
+        )
+
+        # debits fold the shards first
+        do_withdraw(self.shop_user2, old_amount2["cash"] + to_decimal("4"))
+        folded = FundAction.objects.ledger(fund2, 4)[1:]
+        self.assertEqual(
+            [(a.seq, a.cash) for a in folded], [(a.seq, a.cash) for a in ledger]
+        )
+        fund2.refresh_from_db()
+        self.assertEqual(fund2.cash, to_decimal("1"))
+        self.assertEqual(fund2.shard_cash, d0)
+        self.assertFalse(FundAction.objects.filter(fund=fund2, seq__isnull=True))
+
+        actions = list(FundAction.objects.filter(fund=fund2).order_by("seq"))
+        self.assertEqual([a.seq for a in actions], list(range(1, fund2.seq + 1)))
+        self.assertEqual(actions[-1].amount_d, fund2.amount_d)
+        for prev, action in zip(actions, actions[1:]):
+            self.assertEqual(action.total, prev.total + action.amount)
+
+        # holds, funds then shards, a credited sharded fund by its shard
+        fund1 = Fund.objects.get(id=self.fund.id)
+        with CaptureQueriesContext(connection) as ctx:
+            shards = Fund.objects.lock_wallets(debited=[fund1], credited=[fund2])
+        self.assertEqual(
+            [q["sql"].split('FROM "')[1].split('"')[0] for q in ctx.captured_queries],
+            ["wallet_holdfund", "wallet_fund", "wallet_fundshard"],
+        )
+        self.assertIn("SKIP LOCKED", ctx.captured_queries[-1]["sql"])
+        # the first shard free, the one of the transaction once it has one
+        self.assertEqual(shards, {fund2.id: 0})
+        self.assertEqual(Fund.objects.lock_wallets(credited=[fund2]), {fund2.id: 0})
+
+        Fund.objects.set_shard_count(fund2, 0)
+        self.assertFalse(FundShard.objects.filter(fund=fund2).exists())
+        do_transfer(self.shop_user, self.shop_user2, to_decimal("1"))
+        fund2.refresh_from_db()
+        self.assertEqual(fund2.cash, to_decimal("2"))
+
+    def test_transfer_key_across_partitions(self):
+        transfer = do_deposit(self.shop_user, to_decimal("1"), order_id="dup")
+        # moved to the previous month, another partition
+        last_month = add_months(month_start(timezone.localdate()), -1)
+        FundTransfer.objects.filter(id=transfer.id).update(
+            created_at=day_start(last_month)
+        )
+        key = FundTransferKey.objects.get(type="DEPOSIT", order_id="dup")
+        self.assertEqual(key.transfer_id, transfer.id)
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            do_deposit(self.shop_user, to_decimal("1"), order_id="dup")
+
+        # the key follows the order_id, as set by a settled withdrawal
+        FundTransfer.objects.filter(id=transfer.id).update(order_id="paid")
+        do_deposit(self.shop_user, to_decimal("1"), order_id="dup")
+        self.assertEqual(FundTransferKey.objects.filter(order_id="paid").count(), 1)
+
+    def test_fund_checkpoints(self):
+        self.client.authenticate(self.user)
+        now = utc_now()
+        days = [now - timedelta(days=i) for i in range(4)]
+
+        FundAction.objects.all().update(created_at=days[3])
+        balances = {3: self.fund.amount_d}
+        for i, amount in [(2, "1"), (1, "2"), (0, "4")]:
+            do_deposit(self.shop_user, to_decimal(amount), order_id=f"cp{i}")
+            FundAction.objects.filter(created_at__gt=days[1]).update(created_at=days[i])
+            self.fund.refresh_from_db()
+            balances[i] = self.fund.amount_d
+
+        built = FundCheckpoint.objects.build_until(days[1].date())
+        self.assertEqual(built, [d.date() for d in days[:0:-1]])
+        self.assertEqual(FundCheckpoint.objects.build_until(days[1].date()), [])
+
+        checkpoint = FundCheckpoint.objects.get(fund=self.fund, date=days[1].date())
+        self.assertEqual(checkpoint.total, balances[1]["total"])
+        # funds without movement are carried over
+        checkpoint = FundCheckpoint.objects.get(fund=self.fund2, date=days[1].date())
+        self.assertEqual(checkpoint.total, self.fund2.total)
+
+        # one checkpoint plus the day's journal
+        with self.assertNumQueries(2):
+            cash, hold = FundCheckpoint.objects.balance_at(self.fund, now)
+        self.assertEqual(cash + hold, balances[0]["total"])
+        for i in (1, 2):
+            cash, hold = FundCheckpoint.objects.balance_at(self.fund, days[i])
+            self.assertEqual(cash + hold, balances[i]["total"])
+
+        gql = """
+        query _($at: DateTime!) {
+          balanceAt(at: $at){ total cash hold }
+        }"""
+        data = self.client.execute(gql, {"at": days[2].isoformat()})
+        self.assertIsNone(data.errors)
+        self.assertEqual(
+            data.data["balanceAt"]["total"], decimal2str(balances[2]["total"])
+        )
+
+        out = StringIO()
+        call_command("balance_report", days[1].date().isoformat(), stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertIn(f"{self.fund.id},{days[1].date()},", out.getvalue())
+
+    def test_archive_file_cache(self):
+        files = {
+            key: gzip.compress(
+                json.dumps({"columns": ["id"], "data": [[key] * 10]}).encode()
+            )
+            for key in "abc"
+        }
+        downloads = []
+
+        def download(key):
+            downloads.append(key)
+            return files[key]
+
+        size = len(gzip.decompress(files["a"]))
+        cache = archive.FileCache(max_bytes=size * 2)
+        for key in "abab":
+            self.assertEqual(cache.get(key, download), {"id": [key] * 10})
+        self.assertEqual(downloads, ["a", "b"])
+
+        # the least recently used one is dropped over the bound
+        cache.get("c", download)
+        cache.get("a", download)
+        self.assertEqual(downloads, ["a", "b", "c", "a"])
+        self.assertEqual(cache.size, size * 2)
+
+    def test_journal_partitions(self):
+        this_month = month_start(timezone.localdate())
+        ahead = add_months(this_month, 5)
+        table = FundAction._meta.db_table
+
+        out = StringIO()
+        call_command("create_partitions", months=5, stdout=out)
+        self.assertIn(partition_name(table, ahead), out.getvalue())
+        self.assertEqual(ensure_partitions(5), [])
+
+        # rows of a month without partition wait in the default one
+        old = add_months(this_month, -13)
+        FundAction.objects.all().update(created_at=month_bounds(old)[0])
+        first, second = FundAction.objects.order_by("id")[:2]
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            FundAction.objects.filter(id=second.id).update(uuid=first.uuid)
+        self.assertEqual(create_partition(table, old), partition_name(table, old))
+        create_partition(FundTransfer._meta.db_table, old)
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT COUNT(*) FROM {table}_default")
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+        plan = FundAction.objects.filter(
+            fund=self.fund, created_at__gte=month_bounds(this_month)[0]
+        ).explain()
+        self.assertIn(partition_name(table, this_month), plan)
+        self.assertNotIn(partition_name(table, old), plan)
+
+        with connection.cursor() as cursor:
+            # no deferred foreign key checks pending, as in a new transaction
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+        call_command("create_partitions", detach=f"{old:%Y-%m}", stdout=StringIO())
+        self.assertFalse(FundAction.objects.exists())
+        self.assertNotIn(partition_name(table, old), list_partitions(table))
+
+    def test_archive_ledger(self):
+        self.client.authenticate(self.user)
+        old = add_months(month_start(timezone.localdate()), -30)
+        for i in range(3):
+            do_deposit(self.shop_user, to_decimal("1"), order_id=f"a{i}")
+        do_transfer(self.shop_user, self.shop_user2, to_decimal("1"))
+        for model in (FundAction, FundTransfer):
+            model.objects.update(created_at=month_bounds(old)[0])
+            create_partition(model._meta.db_table, old)
+        archived = FundAction.objects.count()
+        do_deposit(self.shop_user, to_decimal("2"), order_id="hot")
+        mismatches = list(reconcile(self.fund.id, self.fund2.id + 1))
+
+        gql = """
+        query _($first: Int, $after: String, $last: Int, $before: String) {
+          ledgerList(first: $first, after: $after, last: $last, before: $before){
+            edges{ node{ id type amount balance createdAt } cursor }
+            pageInfo{ endCursor hasNextPage }
+          }
+        }"""
+
+        def pages():
+            edges, after = [], None
+            while True:
+                data = self.client.execute(gql, {"first": 2, "after": after})
+                self.assertIsNone(data.errors)
+                edges.extend(data.data["ledgerList"]["edges"])
+                if not data.data["ledgerList"]["pageInfo"]["hasNextPage"]:
+                    return edges
+                after = data.data["ledgerList"]["pageInfo"]["endCursor"]
+
+        expected = pages()
+        self.assertEqual(len(expected), 5)
+
+        # never to a default local disk
+        with self.settings(WALLET_ARCHIVE={"BUCKET": "archive"}):
+            with self.assertRaises(CommandError):
+                call_command("archive_ledger", stdout=StringIO())
+            with self.assertRaises(archive.ArchiveError):
+                archive_ledger()
+
+        with connection.cursor() as cursor:
+            # no deferred foreign key checks pending, as in a new transaction
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+        with tempfile.TemporaryDirectory() as root, self.settings(
+            WALLET_ARCHIVE={"ROOT": root, "BUCKET": "archive"}
+        ):
+            # attached back if its rows are not the ones archived
+            table = FundAction._meta.db_table
+            with self.assertRaises(archive.ArchiveError):
+                archive._detach(table, partition_name(table, old), old, archived + 1)
+            self.assertIn(partition_name(table, old), list_partitions(table))
+
+            out = StringIO()
+            call_command("archive_ledger", stdout=out)
+            self.assertIn("Archived 2 files", out.getvalue())
+            manifest = ArchiveManifest.objects.get(table=FundAction._meta.db_table)
+            self.assertEqual((manifest.month, manifest.rows), (old, archived))
+            self.assertLessEqual(manifest.fund_min, self.fund.id)
+            self.assertTrue(os.path.exists(os.path.join(root, "archive", manifest.key)))
+
+            self.assertEqual(FundAction.objects.count(), 1)
+            self.assertEqual(FundTransfer.objects.count(), 1)
+            self.assertNotIn(
+                partition_name(FundAction._meta.db_table, old),
+                list_partitions(FundAction._meta.db_table),
+            )
+            self.assertEqual(
+                list(reconcile(self.fund.id, self.fund2.id + 1)), mismatches
+            )
+
+            # paged on from the database into the archive
+            archive.file_cache.clear()
+            self.assertEqual(pages(), expected)
+            data = self.client.execute(
+                gql, {"last": 2, "before": expected[-1]["cursor"]}
+            )
+            self.assertEqual(data.data["ledgerList"]["edges"], expected[-3:-1])
+            data = self.client.execute(
+                gql, {"last": 2, "before": expected[2]["cursor"]}
+            )
+            self.assertEqual(data.data["ledgerList"]["edges"], expected[:2])
+
+        with connection.cursor() as cursor:
+            cursor.execute("SET CONSTRAINTS ALL DEFERRED")
+
+    def test_reconcile_funds(self):
+        csettings = CashBackSettings()
+        csettings.threshold = "1"
+        user1, user2 = ShopUserFactory(), ShopUserFactory()
+        fund1, fund2 = user1.get_user_fund(), user2.get_user_fund()
+
+        do_deposit(user1, to_decimal("10"), order_id="r1")
+        do_transfer(user1, user2, to_decimal("3"))
+        do_cash_back(user2, to_decimal("5"), order_id="r2")
+        do_withdraw(user2, to_decimal("1"))
+        Fund.objects.set_shard_count(fund2, 2)
+        do_transfer(user1, user2, to_decimal("1"))
+
+        out = StringIO()
+        call_command("reconcile_funds", from_id=fund1.id, stdout=out)
+        self.assertIn("Checked 2 funds", out.getvalue())
+        self.assertIn("found 0 mismatched", out.getvalue())
+
+        Fund.objects.filter(id=fund1.id).update(cash=models.F("cash") + 1)
+        HoldFund.objects.filter(fund=fund2).update(amount=to_decimal("4"))
+        mismatches = list(reconcile(fund1.id, fund2.id + 1))
+        self.assertEqual(
+            mismatches,
+            [
+                Mismatch(fund1.id, to_decimal("7"), to_decimal("6"), d0, d0),
+                Mismatch(
+                    fund2.id,
+                    to_decimal("8"),
+                    to_decimal("8"),
+                    to_decimal("5"),
+                    to_decimal("4"),
+                ),
+            ],
+        )
+        self.assertEqual(split_ranges(1, 10, 4), [(1, 4), (4, 7), (7, 10)])
+
+    def test_ledger_export(self):
+        do_deposit(self.shop_user, to_decimal("1"), order_id="e1")
+        do_transfer(self.shop_user, self.shop_user2, to_decimal("2"), note="e2")
+        do_deposit(self.shop_user2, to_decimal("3"), order_id="e3")
+
+        client = Client(HTTP_AUTHORIZATION=f"JWT {get_token(self.user)}")
+        resp = client.get("/api/ledger/export")
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.streaming)
+        lines = b"".join(resp.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], ",".join(LEDGER_EXPORT_FIELDS))
+        self.assertEqual(len(lines), 3)
+        self.assertIn(",-2.0000,", lines[2])
+
+        resp = client.get(
+            "/api/ledger/export", {"format": "ndjson", "type": "TRANSFER"}
+        )
+        rows = [json.loads(line) for line in resp.streaming_content]
+        self.fund.refresh_from_db()
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]["note"], "e2")
+        self.assertEqual(to_decimal(rows[0]["balance"]), self.fund.total)
+
+        resp = client.get("/api/ledger/export", {"until": "2000-01-01"})
+        self.assertEqual(len(b"".join(resp.streaming_content).splitlines()), 1)
+
+        resp = client.get("/api/ledger/export", {"since": "bad"})
+        self.assertEqual(resp.status_code, 400)
+        for value in ["2020-13-45", "2020-01-01T25:00:00"]:
+            resp = client.get("/api/ledger/export", {"until": value})
+            self.assertEqual(resp.status_code, 400)
+        resp = Client().get("/api/ledger/export")
+        self.assertEqual(resp.status_code, 403)
+
+        model_admin = FundTransferAdmin(FundTransfer, admin.site)
+        resp = model_admin.export_csv(None, FundTransfer.objects.all())
+        lines = b"".join(resp.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), FundTransfer.objects.count() + 1)
+
     def test_unhold(self):
         hold_fund = HoldFundFactory(expired_at=utc_now())
         fund = hold_fund.fund
+        fund.refresh_from_db()
 
         old_amount = fund.amount_d
 
@@ -217,6 +705,157 @@ class WalletTests(JSONWebTokenTestCase):
         self.assertEquals(fund.cash, old_amount["cash"] + old_amount["hold"])
         self.assertEquals(fund.hold, d0)
 
+    def test_expired_unhold_chunks(self):
+        fund = FundFactory()
+        hold_funds = [
+            HoldFundFactory(fund=fund, expired_at=utc_now() - timedelta(days=i))
+            for i in range(1, 4)
+        ]
+        fund2 = FundFactory()
+        hold_funds.append(
+            HoldFundFactory(fund=fund2, expired_at=utc_now() - timedelta(days=1))
+        )
+        not_expired = HoldFundFactory(fund=fund2)
+
+        fund.refresh_from_db()
+        fund2.refresh_from_db()
+        old_amount = fund.amount_d
+        old_amount2 = fund2.amount_d
+
+        res = HoldFund.objects.expired_unhold(chunk_size=2)
+        self.assertDictEqual(res, {"rows": 4, "funds": 2})
+
+        fund.refresh_from_db()
+        fund2.refresh_from_db()
+        self.assertEquals(fund.hold, d0)
+        self.assertEquals(fund.total, old_amount["total"])
+        self.assertEquals(fund2.hold, not_expired.amount)
+        self.assertEquals(fund2.total, old_amount2["total"])
+        self.assertEquals(
+            fund2.cash, old_amount2["cash"] + old_amount2["hold"] - not_expired.amount
+        )
+        self.assertFalse(
+            HoldFund.objects.filter(id__in=[h.id for h in hold_funds]).exists()
+        )
+
+        self.assertDictEqual(
+            HoldFund.objects.expired_unhold(chunk_size=2), {"rows": 0, "funds": 0}
+        )
+
+    @FakeRedis("common.redis_client.get_redis_connection")
+    def test_schedule_holdfund_expiry(self):
+        overdue = HoldFundFactory(fund=self.fund, expired_at=utc_now() - timedelta(1))
+        HoldFundFactory(fund=self.fund, expired_at=utc_now() - timedelta(days=2))
+        far = HoldFundFactory(fund=self.fund, expired_at=utc_now() + timedelta(days=2))
+
+        buckets = HoldFund.objects.expiry_buckets(
+            utc_now() + timedelta(seconds=1800), 300
+        )
+        self.assertEqual(sum(cnt for _, cnt in buckets), 4)
+
+        with patch.object(expire_holdfund_bucket, "apply_async") as mock_apply:
+            now = utc_now()
+            scheduled = schedule_holdfund_expiry()
+            # the overdue buckets are merged into one
+            self.assertEqual(
+                scheduled, len({max(bucket, now) for bucket, _ in buckets})
+            )
+            self.assertEqual(mock_apply.call_count, scheduled)
+            for _, kw in mock_apply.call_args_list:
+                self.assertLessEqual(kw["eta"], far.expired_at)
+
+            # survive reseeding without duplicated tasks
+            self.assertEqual(schedule_holdfund_expiry(), 0)
+            self.assertEqual(mock_apply.call_count, scheduled)
+
+        res = expire_holdfund_bucket(utc_now().isoformat())
+        self.assertDictEqual(res, {"rows": 2, "funds": 1})
+        self.assertFalse(HoldFund.objects.filter(id=overdue.id).exists())
+        self.assertTrue(HoldFund.objects.filter(id=far.id).exists())
+
+    def test_hold_buckets(self):
+        fund = FundFactory()
+        now = utc_now()
+        first = HoldFundFactory(fund=fund, amount=to_decimal("1"), expired_at=now)
+        HoldFundFactory(
+            fund=fund,
+            amount=to_decimal("2"),
+            expired_at=day_start(timezone.localdate(now)),
+        )
+        HoldFundFactory(
+            fund=fund, amount=to_decimal("4"), expired_at=now + timedelta(1)
+        )
+
+        # one row per fund and expiry day, expiring with its latest hold
+        bucket = HoldFund.objects.get(id=first.id)
+        self.assertEqual(bucket.amount, to_decimal("3"))
+        self.assertEqual(bucket.expiry_day, timezone.localdate(now))
+        self.assertEqual(bucket.expired_at, now)
+        self.assertEqual(HoldFund.objects.filter(fund=fund).count(), 2)
+
+        # each hold is still traceable
+        entries = HoldFundEntry.objects.filter(fund=fund).order_by("id")
+        self.assertEqual(
+            [e.amount for e in entries], [to_decimal(a) for a in ("1", "2", "4")]
+        )
+        fund.refresh_from_db()
+        self.assertEqual(fund.hold, to_decimal("7"))
+
+        CashBackSettings().threshold = "1"
+        transfer = do_cash_back(fund.shop_user, to_decimal("5"), order_id="hb1")
+        entry = HoldFundEntry.objects.get(transfer=transfer)
+        self.assertEqual(entry.order_id, "hb1")
+        self.assertEqual(entry.fund_id, fund.id)
+
+    def test_hold_column(self):
+        self.assertEquals(self.fund.hold, HoldFund.objects.total_amount(self.fund))
+
+        HoldFundFactory(fund=self.fund)
+        self.fund.refresh_from_db()
+        self.assertEquals(self.fund.hold, HoldFund.objects.total_amount(self.fund))
+
+        delta = self.hold_fund.amount + to_decimal("0.1")
+        remain = HoldFund.objects.decr_hold(self.fund, delta)
+        self.fund.refresh_from_db()
+        self.assertEquals(remain, d0)
+        self.assertEquals(self.fund.hold, HoldFund.objects.total_amount(self.fund))
+
+        # break the column and recompute it from HoldFund
+        Fund.objects.filter(id=self.fund.id).update(hold=d0)
+        out = StringIO()
+        call_command("check_fund_hold", stdout=out)
+        self.assertIn(f"fund:{self.fund.id} ", out.getvalue())
+        self.fund.refresh_from_db()
+        self.assertEquals(self.fund.hold, d0)
+
+        call_command("check_fund_hold", "--fix", stdout=out)
+        self.fund.refresh_from_db()
+        self.assertEquals(self.fund.hold, HoldFund.objects.total_amount(self.fund))
+        self.assertEquals(Fund.objects.check_hold(), [])
+
+    def test_deduct_hold_fifo(self):
+        fund = FundFactory()
+        now = utc_now()
+        holds = [
+            HoldFundFactory(fund=fund, amount=to_decimal(a), expired_at=now + d)
+            for a, d in [("3", timedelta(days=2)), ("1", timedelta(days=1))]
+            + [("2", timedelta(days=3 + i)) for i in range(50)]
+        ]
+
+        # whatever the number of holds
+        with self.assertNumQueries(1):
+            remain = HoldFund.objects.deduct(fund, to_decimal("5"))
+        self.assertEqual(remain, d0)
+        self.assertFalse(HoldFund.objects.filter(id__in=[h.id for h in holds[:2]]))
+        self.assertEqual(HoldFund.objects.get(id=holds[2].id).amount, to_decimal("1"))
+        self.assertEqual(HoldFund.objects.filter(fund=fund).count(), 50)
+
+        self.assertEqual(
+            HoldFund.objects.deduct(fund, to_decimal("100")), to_decimal("1")
+        )
+        self.assertFalse(HoldFund.objects.filter(fund=fund).exists())
+        self.assertEqual(HoldFund.objects.deduct(fund, to_decimal("1")), 1)
+
     def test_transfer(self):
         old_amount = self.fund.amount_d
         old_amount2 = self.fund2.amount_d
@@ -253,7 +892,101 @@ class WalletTests(JSONWebTokenTestCase):
         self.assertEquals(self.fund.amount_d, old_amount)
         self.assertEquals(self.fund2.amount_d, old_amount2)
 
-    @FakeRedis("common.utils.get_redis_connection")
+    def test_batch_transfer(self):
+        shop_user3 = ShopUserFactory()
+        old_amount = self.fund.amount_d
+        old_amount2 = self.fund2.amount_d
+        items = [
+            (self.shop_user2, to_decimal("1")),
+            (shop_user3, to_decimal("2")),
+            (self.shop_user2, to_decimal("0.5")),
+        ]
+
+        transfers = do_batch_transfer(self.shop_user, items, note="salary")
+        self.assertEqual([t.amount for t in transfers], [a for _, a in items])
+
+        self.fund.refresh_from_db()
+        self.fund2.refresh_from_db()
+        fund3 = shop_user3.get_user_fund()
+        self.assertEqual(self.fund.total, old_amount["total"] - to_decimal("3.5"))
+        self.assertEqual(self.fund2.cash, old_amount2["cash"] + to_decimal("1.5"))
+        self.assertEqual(fund3.cash, to_decimal("2"))
+
+        # one journal row per leg, with running balances
+        actions = list(FundAction.objects.filter(fund=self.fund).order_by("seq"))
+        self.assertEqual([a.transfer for a in actions[-3:]], transfers)
+        self.assertEqual(actions[-1].amount_d, self.fund.amount_d)
+        for prev, action in zip(actions, actions[1:]):
+            self.assertEqual(action.total, prev.total + action.amount)
+        action = FundAction.objects.filter(fund=self.fund2).latest("seq")
+        self.assertEqual(action.amount_d, self.fund2.amount_d)
+
+        # insufficient balance changes nothing
+        with self.assertRaises(exceptions.NotEnoughBalance):
+            do_batch_transfer(
+                self.shop_user, [(self.shop_user2, self.fund.total + to_decimal("1"))]
+            )
+        self.fund.refresh_from_db()
+        self.assertEqual(self.fund.total, old_amount["total"] - to_decimal("3.5"))
+
+        # the cost does not grow with the number of recipients
+        do_deposit(self.shop_user, to_decimal("100"), order_id="batch")
+        users = [FundFactory().shop_user for _ in range(50)]
+        with CaptureQueriesContext(connection) as small:
+            do_batch_transfer(self.shop_user, [(u, to_decimal("1")) for u in users[:2]])
+        with CaptureQueriesContext(connection) as large:
+            do_batch_transfer(self.shop_user, [(u, to_decimal("1")) for u in users])
+        self.assertEqual(len(small), len(large))
+
+    @FakeRedis("common.redis_client.get_redis_connection")
+    def test_batch_transfer_api(self):
+        self.client.authenticate(self.user)
+        self.shop_user.set_payment_password("654321")
+        gql = """
+        mutation _($input: BatchTransferInput!){
+          batchTransfer(input: $input){
+            success
+          }
+        }"""
+        variables = {
+            "input": {
+                "items": [
+                    {"to": str(self.shop_user2.uuid), "amount": "0.1"},
+                    {"to": str(uuid.uuid4()), "amount": "0.1"},
+                ],
+                "requestId": uuid.uuid4().hex,
+                "paymentPassword": "654321",
+            }
+        }
+        data = self.client.execute(gql, variables)
+        self.assertEquals("no_exist_user", data.errors[0].message)
+
+        old_amount = self.fund.amount_d
+        old_amount2 = self.fund2.amount_d
+
+        # the failed request is released, it can be retried
+        variables["input"]["items"][1]["to"] = str(self.shop_user2.uuid)
+        data = self.client.execute(gql, variables)
+        self.assertIsNone(data.errors)
+
+        self.fund.refresh_from_db()
+        self.fund2.refresh_from_db()
+        self.assertEquals(self.fund.total, old_amount["total"] - to_decimal("0.2"))
+        self.assertEquals(self.fund2.cash, old_amount2["cash"] + to_decimal("0.2"))
+
+        # the retry replays the result without transferring again
+        data = self.client.execute(gql, variables)
+        self.assertIsNone(data.errors)
+        self.assertTrue(data.data["batchTransfer"]["success"])
+        self.fund.refresh_from_db()
+        self.assertEquals(self.fund.total, old_amount["total"] - to_decimal("0.2"))
+
+        variables["input"]["items"] = []
+        variables["input"]["requestId"] = uuid.uuid4().hex
+        data = self.client.execute(gql, variables)
+        self.assertEquals("invalid_batch_size", data.errors[0].message)
+
+    @FakeRedis("common.redis_client.get_redis_connection")
     def test_transfer_api(self):
         self.client.authenticate(self.user)
         gql = """
@@ -277,16 +1010,15 @@ class WalletTests(JSONWebTokenTestCase):
         self.assertIsNotNone(data.errors)
         self.assertEquals("need_set_payment_password", data.errors[0].message)
 
-        # test resbumitted
+        # the failed request released its request_id for the retry
         data = self.client.execute(gql, variables)
         self.assertIsNotNone(data.errors)
-        self.assertEquals("resubmitted", data.errors[0].message)
+        self.assertEquals("need_set_payment_password", data.errors[0].message)
 
         self.shop_user.set_payment_password("654321")
 
         # test wrong paymentpassword
         variables["input"]["paymentPassword"] = "123456"
-        variables["input"]["requestId"] = uuid.uuid4().hex
         data = self.client.execute(gql, variables)
         self.assertIsNotNone(data.errors)
         self.assertEquals("wrong_password", data.errors[0].message)
@@ -307,6 +1039,36 @@ class WalletTests(JSONWebTokenTestCase):
         self.assertEquals(self.fund.total, old_amount["total"] - to_decimal("0.1"))
         self.assertEquals(self.fund2.cash, old_amount2["cash"] + to_decimal("0.1"))
 
+        # the retry replays the result without transferring again
+        data = self.client.execute(gql, variables)
+        self.assertIsNone(data.errors)
+        self.assertTrue(data.data["transfer"]["success"])
+        self.fund.refresh_from_db()
+        self.assertEquals(self.fund.total, old_amount["total"] - to_decimal("0.1"))
+
+    @FakeRedis("common.redis_client.get_redis_connection")
+    def test_action_queries(self):
+        csettings = CashBackSettings()
+        csettings.threshold = "1"
+        # as committed, the settings are then read from the cache
+        quota_cache.committed()
+        csettings.threshold
+
+        # each balance change is one UPDATE ... RETURNING without re-reading
+        # the fund, which also appends the FundAction, the rest are
+        # savepoints and the transfer write
+        with self.assertNumQueries(5):
+            do_deposit(self.shop_user, to_decimal("1.1"), order_id="q1")
+
+        with self.assertNumQueries(5):
+            do_withdraw(self.shop_user, to_decimal("1.1"), order_id="q2")
+
+        with self.assertNumQueries(8):
+            do_cash_back(self.shop_user, to_decimal("1.1"), order_id="q3")
+
+        with self.assertNumQueries(9):
+            do_transfer(self.shop_user, self.shop_user2, to_decimal("1.1"))
+
     def test_withdraw(self):
 
         user_old_cash = self.fund.cash
@@ -335,13 +1097,19 @@ class WalletTests(JSONWebTokenTestCase):
 
         self.assertEquals(self.fund.cash, user_old_cash)
 
-    @FakeRedis("common.utils.get_redis_connection")
+    @FakeRedis("common.redis_client.get_redis_connection")
     def test_withdraw_api(self):
+        self.shop_user.wechat_id = "openid"
+        self.shop_user.save()
         self.client.authenticate(self.user)
         gql = """
         mutation _($input: WithdrawInput!){
           withdraw(input: $input){
             success
+            withdrawal {
+              id
+              status
+            }
           }
         }"""
         test_request_uuid = uuid.uuid4().hex
@@ -357,28 +1125,43 @@ class WalletTests(JSONWebTokenTestCase):
         self.assertIsNotNone(data.errors)
         self.assertEquals("not_enough_balance", data.errors[0].message)
 
-        # test resbumitted
+        # the retry of the failed request runs again
         data = self.client.execute(gql, variables)
         self.assertIsNotNone(data.errors)
-        self.assertEquals("resubmitted", data.errors[0].message)
+        self.assertEquals("not_enough_balance", data.errors[0].message)
 
         variables["input"]["amount"] = "0.1"
-        variables["input"]["requestId"] = uuid.uuid4().hex
 
         old_fund_cash = self.fund.cash
 
-        # test fail and revert
+        poll = """
+        query _($id: UUID!){
+          withdrawal(id: $id){
+            status
+          }
+        }"""
+
+        # refused by the provider, the withdrawal is reversed
         def withdraw_fail(*args, **kw):
             raise exceptions.WithdrawError("fail")
 
+        data = self.client.execute(gql, variables)
+        self.assertIsNone(data.errors)
+        withdrawal = data.data["withdraw"]["withdrawal"]
+        self.assertEqual(withdrawal["status"], "PENDING")
+        self.fund.refresh_from_db()
+        self.assertEqual(old_fund_cash - to_decimal("0.1"), self.fund.cash)
+
         with patch.object(WeChatProvider, "withdraw") as mock_withdraw:
             mock_withdraw.side_effect = withdraw_fail
+            self.assertEqual(send_withdrawals()["reversed"], 1)
 
-            data = self.client.execute(gql, variables)
-            self.assertIsNotNone(data.errors)
-            self.assertEqual("fail", data.errors[0].message)
-            self.fund.refresh_from_db()
-            self.assertEqual(old_fund_cash, self.fund.cash)
+        data = self.client.execute(poll, {"id": withdrawal["id"]})
+        self.assertEqual(data.data["withdrawal"]["status"], "REVERSED")
+        self.fund.refresh_from_db()
+        self.assertEqual(old_fund_cash, self.fund.cash)
+        refund = FundTransfer.objects.get(type="REFUND", order_id=withdrawal["id"])
+        self.assertEqual(refund.amount, to_decimal("0.1"))
 
         # test withdraw success
         variables["input"]["requestId"] = uuid.uuid4().hex
@@ -393,17 +1176,47 @@ class WalletTests(JSONWebTokenTestCase):
             "return_code": "SUCCESS",
             "return_msg": None,
         }
+        data = self.client.execute(gql, variables)
+        self.assertIsNone(data.errors)
+        replay = self.client.execute(gql, variables)
+        self.assertEqual(replay.data, data.data)
+        withdrawal = data.data["withdraw"]["withdrawal"]
+
+        # not sent while the breaker is open, no attempt is counted
         with patch.object(WeChatProvider, "withdraw") as mock_withdraw:
-            mock_withdraw.return_value = mocked_result
+            mock_withdraw.side_effect = exceptions.ProviderUnavailable("open")
+            self.assertEqual(send_withdrawals()["deferred"], 1)
+        outbox = WithdrawOutbox.objects.get(transfer__uuid=withdrawal["id"])
+        self.assertEqual((outbox.status, outbox.attempts), ("PENDING", 0))
+        self.assertGreater(outbox.next_attempt_at, utc_now())
+        WithdrawOutbox.objects.filter(id=outbox.id).update(next_attempt_at=utc_now())
+
+        # the outcome is unknown, sent again later with the same out_trade_no
+        with patch.object(WeChatProvider, "withdraw") as mock_withdraw:
+            mock_withdraw.side_effect = ConnectionError
+            self.assertEqual(send_withdrawals()["retry"], 1)
+        outbox = WithdrawOutbox.objects.get(transfer__uuid=withdrawal["id"])
+        self.assertEqual((outbox.status, outbox.attempts), ("PENDING", 1))
+        self.assertGreater(outbox.next_attempt_at, utc_now())
 
-            data = self.client.execute(gql, variables)
-            self.assertIsNone(data.errors)
+        WithdrawOutbox.objects.filter(id=outbox.id).update(next_attempt_at=utc_now())
+        with patch.object(WeChatProvider, "withdraw") as mock_withdraw:
+            mock_withdraw.return_value = mocked_result
+            self.assertEqual(send_withdrawals()["success"], 1)
+            self.assertEqual(
+                mock_withdraw.call_args[1]["out_trade_no"],
+                uuid.UUID(withdrawal["id"]).hex,
+            )
+            # settled once
+            self.assertEqual(send_withdrawals()["success"], 0)
 
+        data = self.client.execute(poll, {"id": withdrawal["id"]})
+        self.assertEqual(data.data["withdrawal"]["status"], "SUCCESS")
+        transfer = FundTransfer.objects.get(uuid=withdrawal["id"])
+        self.assertEqual(transfer.order_id, mocked_result["payment_no"])
         self.fund.refresh_from_db()
         self.assertEqual(old_fund_cash - to_decimal("0.1"), self.fund.cash)
 
-        self.assertTrue(data.data["withdraw"]["success"])
-
     def test_get_qr_code_info(self):
         self.client.authenticate(self.user)
 
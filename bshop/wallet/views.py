@@ -1,3 +1,64 @@
-# from django.shortcuts import render
+from django.db.models import F
+from django.contrib.auth import authenticate
+from django.http import HttpResponseBadRequest, HttpResponseForbidden
+from django.views.decorators.http import require_GET
+from graphql_jwt.exceptions import JSONWebTokenError
 
-# Create your views here.
+from wallet.models import FundAction
+from wallet.export import (
+    CHUNK_SIZE,
+    InvalidExportParams,
+    filter_transfers,
+    streaming_export,
+)
+
+LEDGER_EXPORT_FIELDS = [
+    "id",
+    "created_at",
+    "type",
+    "status",
+    "amount",
+    "balance",
+    "order_id",
+    "note",
+]
+
+
+@require_GET
+def ledger_export(request):
+    """
+    Stream the ledger of the user's fund as csv or ndjson, with the JWT
+    of the graphql api. Filters: type, status, since, until.
+    """
+    try:
+        user = authenticate(request=request)
+    except JSONWebTokenError:
+        user = None
+    if user is None or not hasattr(user, "shop_user"):
+        return HttpResponseForbidden()
+
+    fund = user.shop_user.get_user_fund()
+    actions = FundAction.objects.filter(
+        fund=fund, transfer__isnull=False, seq__isnull=False
+    ).order_by("seq")
+
+    try:
+        actions = filter_transfers(actions, request.GET, prefix="transfer__")
+        rows = (
+            dict(zip(LEDGER_EXPORT_FIELDS, row))
+            for row in actions.values_list(
+                "transfer__uuid",
+                "transfer__created_at",
+                "transfer__type",
+                "transfer__status",
+                "amount",
+                F("cash") + F("hold"),
+                "transfer__order_id",
+                "transfer__note",
+            ).iterator(chunk_size=CHUNK_SIZE)
+        )
+        return streaming_export(
+            rows, LEDGER_EXPORT_FIELDS, request.GET.get("format", "csv"), "ledger"
+        )
+    except InvalidExportParams as e:
+        return HttpResponseBadRequest(str(e))